@@ -1,10 +1,25 @@
-from fastapi import FastAPI , Request , UploadFile, File , Form
+from fastapi import FastAPI , Request , UploadFile, File , Form, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
 app = FastAPI()
 import json
 from src.bedrock import text_to_sql_and_result
 from src.text_csv_results import text_csv_results
+from src.out_of_core import remove_dataset
+from src.upload_formats import UnsupportedUpload, load_upload
+from src import metrics
+from src.render_pool import shutdown_render_pool
+from src import warmup
+from src.render_graph import render_graph
+from src.response_formats import (
+    parse_formats, serialize_result, json_response, negotiate_binary, binary_response,
+)
+from src import result_store
+from src.compression import CompressionMiddleware
+from src import admission, cancellation, conversations, replica, rollups, single_flight, tracing
+from src.csv_tables import table_name_from_filename
 import pandas as pd
 import io
 from fastapi.responses import JSONResponse  
@@ -15,30 +30,181 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods (GET, POST, etc.)
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Trace-Id"],
 )
+# zstd/brotli/gzip for responses above COMPRESSION_MIN_BYTES, negotiated per request
+app.add_middleware(CompressionMiddleware)
+# Outermost: per-request spans, slow requests go to the JSONL slow log
+app.add_middleware(tracing.TracingMiddleware)
+
+@app.on_event("startup")
+def start_replica():
+    # No-op unless REPLICA_ENABLED; the first snapshot is taken in the background
+    replica.start()
+
+@app.on_event("startup")
+def start_rollups():
+    # No-op unless ROLLUPS_ENABLED; the rollups are built in the background
+    rollups.start()
+
+@app.on_event("shutdown")
+def stop_replica():
+    replica.stop()
+
+@app.on_event("shutdown")
+def stop_rollups():
+    rollups.stop()
+
+@app.on_event("shutdown")
+def stop_render_pool():
+    shutdown_render_pool()
+
+@app.on_event("shutdown")
+def clear_result_store():
+    # Removes results spilled to disk
+    result_store.store.clear()
+
+@app.on_event("shutdown")
+def stop_pipeline():
+    admission.pipeline.shutdown()
+
+@app.on_event("shutdown")
+def flush_slow_log():
+    tracing.close()
+
+@app.exception_handler(admission.Overloaded)
+async def overloaded(request: Request, exc: admission.Overloaded):
+    # 429 when the wait queue is full, 503 when the wait for a slot timed out
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"error": str(exc), "stage": exc.limiter},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(cancellation.Cancelled)
+async def cancelled(request: Request, exc: cancellation.Cancelled):
+    # Nobody reads this, the client is gone; 499 as in nginx's "client closed request"
+    return JSONResponse(status_code=499, content={"error": str(exc)})
 
 @app.get("/")
 def read_root():
     return {"message": "Hello, FastAPI!"}
 
-# Need to change the type of output['sql_result'] in string
-@app.post("/get_user_data")
-async def get_user_data(request: Request):
-    data = await request.json()
-    output = text_to_sql_and_result(data['query'], data['chat_history'])
-    print("output", output)
-    
-    if output['response_type'] == 'conversation':
-        return output
-    
-    print("Output is: ", output)
-    
-    # Convert DataFrame to different formats
-    result_str = output['sql_result'].to_json(orient="records")
-    
-    # Create CSV string from DataFrame
-    csv_string = output['sql_result'].to_csv(index=False)
-    
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+@app.get("/replica")
+def get_replica_status():
+    """Age of the local warehouse replica and how many queries it answered or sent to Snowflake."""
+    return replica.status()
+
+@app.get("/rollups")
+def get_rollup_status():
+    """Rows and age of the SALES rollups, their hit ratio and the warehouse time they saved."""
+    return rollups.status()
+
+@app.get("/warmup")
+def warm_up(components: List[str] = Query(default=[])):
+    """
+    Load what is otherwise loaded by the first question: the semantic model, LangChain and
+    the Bedrock client, the Snowflake connector and, with `components=render` or when charts
+    are rendered server-side, the chart rendering processes.
+    """
+    try:
+        timings = warmup.warm(components)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return {"warmed": timings}
+
+# Registered before /results/{result_id} so the extension is not taken as part of the id
+@app.get("/results/{result_id}.csv")
+def download_result_csv(
+    result_id: str,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    filter: List[str] = Query(default=[]),
+):
+    try:
+        chunks = result_store.iter_csv(result_id, sort, order == "desc", filter)
+    except result_store.ResultNotFound:
+        return JSONResponse(status_code=404, content={"error": "Result not found or expired"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return StreamingResponse(
+        chunks,
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="result-{result_id}.csv"'},
+    )
+
+@app.get("/results/{result_id}.arrow")
+def download_result_arrow(
+    result_id: str,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    filter: List[str] = Query(default=[]),
+):
+    return binary_result(result_id, "arrow", sort, order, filter)
+
+@app.get("/results/{result_id}.parquet")
+def download_result_parquet(
+    result_id: str,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    filter: List[str] = Query(default=[]),
+):
+    return binary_result(result_id, "parquet", sort, order, filter)
+
+def binary_result(result_id, kind, sort, order, filters):
+    try:
+        table = result_store.result_table(result_id, sort, order == "desc", filters)
+    except result_store.ResultNotFound:
+        return JSONResponse(status_code=404, content={"error": "Result not found or expired"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return binary_response(table, kind, {"result_id": result_id}, filename=f"result-{result_id}")
+
+@app.get("/results/{result_id}")
+def get_result_page(
+    result_id: str,
+    offset: int = 0,
+    limit: int = result_store.DEFAULT_PAGE_SIZE,
+    sort: Optional[str] = None,
+    order: str = "asc",
+    filter: List[str] = Query(default=[]),
+):
+    """
+    A page of a stored result. `filter` takes `column:op:value` (op is eq, ne, lt, le, gt,
+    ge or contains) and can be repeated; `order` is asc or desc.
+    """
+    try:
+        page, total = result_store.query_page(result_id, offset, limit, sort, order == "desc", filter)
+    except result_store.ResultNotFound:
+        return JSONResponse(status_code=404, content={"error": "Result not found or expired"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return json_response({
+        "result_id": result_id,
+        "offset": offset,
+        "limit": len(page),
+        "total_rows": total,
+        "columns": [str(col) for col in page.columns],
+        **serialize_result(page, ["json"]),
+    })
+
+async def query_response(output, formats, chart_format, binary=None, conversation=None, source="warehouse", **extra):
+    """
+    Response for a query result: its first page in the representations listed in `formats`,
+    the analysis and its chart, serialized in a single pass. The whole result stays in the
+    result store; clients page and sort it through `/results/{id}` and download it from
+    `/results/{id}.csv`.
+
+    With `binary` set to 'arrow' or 'parquet' the body is the whole result in that format
+    instead, with the SQL, result id and analysis text in the schema metadata.
+
+    The stored result becomes the `conversation`'s previous result, for follow-up questions
+    about the same `source` ('warehouse' or 'upload').
+    """
     # Safely extract analysis and plot data with proper checks
     analysis_statement = ""
     analysis_plot = ""
@@ -47,37 +213,92 @@ async def get_user_data(request: Request):
         # Get analysis text if available
         analysis_statement = output['analysis'].get('analysis', "")
         
-        # Check if graph_plots exists and has image data
+        # Check if graph_plots exists and has a chart spec or image data
         if 'graph_plots' in output['analysis'] and isinstance(output['analysis']['graph_plots'], dict):
             graph_data = output['analysis']['graph_plots']
-            if graph_data.get('image'):
+            if chart_format == 'png' and graph_data.get('spec'):
+                # Client opted in to a server-rendered image
+                graph_data = await run_in_threadpool(render_graph, output['sql_result'], output['analysis'], 'png')
+            if graph_data.get('spec') or graph_data.get('image'):
                 analysis_plot = graph_data
             elif graph_data.get('html_tag'):
                 analysis_plot = graph_data.get('html_tag')
-    style = """
-    <style>
-        table {csv_string
-            width: 100%;
-            border-collapse: collapse;
-        }
-        th, td {
-            padding: 12px;
-            text-align: left;
-            border: 1px solid #DEE2E6;
+    
+    tracing.annotate(rows=len(output['sql_result']))
+    # Kept server-side for paging, sorting, filtering and downloads under /results/{id}
+    with tracing.span("result_store.put"):
+        result_id = await run_in_threadpool(result_store.store.put, output['sql_result'])
+    if conversation is not None:
+        conversation.keep_result(result_id, output['sql_query'], source)
+        extra["conversation_id"] = conversation.conversation_id
+    
+    if binary:
+        metadata = {
+            "response_type": output['response_type'],
+            "sql_query": output['sql_query'],
+            "result_id": result_id,
+            "analysis_statement": analysis_statement,
+            **extra,
         }
-    </style>
-    """
-    html_table = style + output['sql_result'].to_html(index=False, classes='table table-bordered')
+        with tracing.span("serialize", formats=[binary]):
+            return await run_in_threadpool(binary_response, output['sql_result'], binary, metadata)
+    
+    # Only the first page, in the requested representations; later pages come from /results/{id}
+    page = output['sql_result'].head(result_store.DEFAULT_PAGE_SIZE)
+    with tracing.span("serialize", formats=formats):
+        fields = await run_in_threadpool(serialize_result, page, formats)
     
-    return {
+    return json_response({
         "response_type": output['response_type'],
-        "result": result_str,
         "sql_query": output['sql_query'],
-        'table': JSONResponse(content=html_table),
+        "result_id": result_id,
+        "total_rows": len(output['sql_result']),
+        "offset": 0,
+        "limit": len(page),
+        "columns": [str(col) for col in page.columns],
         'analysis_statement': analysis_statement,
         'analysis_plot': analysis_plot,
-        'csv_data': csv_string  # Add CSV data to the response
-    }
+        **fields,
+        **extra,
+    })
+
+# Need to change the type of output['sql_result'] in string
+@app.post("/get_user_data")
+async def get_user_data(request: Request):
+    data = await request.json()
+    # Charts come back as Vega-Lite specs unless the client asks for 'png'
+    chart_format = data.get('chart_format')
+    try:
+        formats = parse_formats(data.get('formats'))
+        # Arrow IPC or Parquet instead of JSON, by response_format or the Accept header
+        binary = negotiate_binary(request.headers.get("accept"), data.get('response_format'))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    tracing.annotate(question=data['query'])
+    # History is kept server-side; chat_history only seeds a conversation the server does not know
+    conversation = conversations.store.session(data.get('conversation_id'), data.get('chat_history'))
+    tracing.annotate(conversation_id=conversation.conversation_id)
+    # Everything below stops early if the client disconnects
+    async with cancellation.cancel_on_disconnect(request):
+        # On the bounded pipeline executor, off the event loop; rejected with 429/503 when saturated
+        # Follow-ups that only refine the last result are answered from it, see src/follow_up.py
+        history = conversation.history()
+        previous = conversation.previous_result()
+        # The same question with the same context asked concurrently runs once, see src/single_flight.py
+        question_key = single_flight.key(
+            data['query'], history, previous and (previous.sql, previous.columns, previous.rows)
+        )
+        output = await single_flight.questions.run(
+            question_key, admission.pipeline.run, text_to_sql_and_result, data['query'], None, history, previous
+        )
+        tracing.annotate(response_type=output['response_type'], sql=output.get('sql_query'))
+        
+        cancellation.check()
+        conversation.record(data['query'], output)
+        if output['response_type'] == 'conversation':
+            return {**output, "conversation_id": conversation.conversation_id}
+        
+        return await query_response(output, formats, chart_format, binary, conversation)
 
 
 
@@ -90,26 +311,54 @@ async def get_csv_results(request: Request):
     df=""
     query=""
     chat_history=""
+    conversation_id = None
+    chart_format = None
+    formats = parse_formats(None)
+    binary = None
+    temp_paths = []
     if "multipart/form-data" in content_type:
         form_data = await request.form()
         
-        # Get the file
-        uploaded_file = form_data.get("file")
+        # Get the files, several files are queried as separate tables
+        uploaded_files = [f for f in form_data.getlist("file") if not isinstance(f, str)]
         
         # Get the JSON data
         json_data = json.loads(form_data.get("json_data"))
         query = json_data.get("query")
         chat_history = json_data.get("chat_history", [])
-        # Process the uploaded CSV file
-        if uploaded_file:
-            # Read the file content
-            contents = await uploaded_file.read()
-            
-            # Convert bytes to string
-            csv_content = contents.decode("utf-8")
-            
-            # Convert CSV string to DataFrame
-            df = pd.read_csv(io.StringIO(csv_content))
+        conversation_id = json_data.get("conversation_id")
+        chart_format = json_data.get("chart_format")
+        try:
+            formats = parse_formats(json_data.get("formats"))
+            # Arrow IPC or Parquet instead of JSON, by response_format or the Accept header
+            binary = negotiate_binary(request.headers.get("accept"), json_data.get("response_format"))
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        # Process the uploaded files
+        if uploaded_files:
+            tables = {}
+            for uploaded_file in uploaded_files:
+                # A single upload keeps the historical table name 'df'
+                if len(uploaded_files) == 1:
+                    table_name = "df"
+                else:
+                    table_name = table_name_from_filename(uploaded_file.filename, tables)
+                
+                # CSV (plain or compressed), Parquet, Arrow IPC/Feather or Excel
+                try:
+                    source, paths = await run_in_threadpool(
+                        load_upload, uploaded_file.file, uploaded_file.filename, uploaded_file.size
+                    )
+                except UnsupportedUpload as e:
+                    remove_dataset(*temp_paths)
+                    return JSONResponse(status_code=400, content={"error": str(e)})
+                except BaseException:
+                    # Earlier files of the request, on any other error or a disconnect
+                    remove_dataset(*temp_paths)
+                    raise
+                tables[table_name] = source
+                temp_paths += paths
+            df = tables["df"] if len(tables) == 1 else tables
         else:
             # If no file but csv_data exists in json_data
             csv_data = json_data.get('csv_data')
@@ -120,61 +369,29 @@ async def get_csv_results(request: Request):
                     status_code=400,
                     content={"error": "No CSV data provided"}
                 )
-    print("Data" , df, query, chat_history)
-    # Call the text_to_sql function
-    output = text_csv_results(df , query, chat_history)
-    print("output", output)
-    
-    if output['response_type'] == 'conversation':
-        return output
-    
-    print("Output is: ", output)
-    
-    # Convert DataFrame to different formats
-    result_str = output['sql_result'].to_json(orient="records")
-    
-    # Create CSV string from DataFrame
-    csv_string = output['sql_result'].to_csv(index=False)
-    
-    analysis_statement = output['analysis']['analysis'] if output['analysis'] else ""
-    
-    # Safely extract analysis and plot data with proper checks
-    analysis_statement = ""
-    analysis_plot = ""
-    
-    if output.get('analysis') and isinstance(output['analysis'], dict):
-        # Get analysis text if available
-        analysis_statement = output['analysis'].get('analysis', "")
+    tracing.annotate(question=query)
+    # History is kept server-side; chat_history only seeds a conversation the server does not know
+    conversation = conversations.store.session(conversation_id, chat_history)
+    tracing.annotate(conversation_id=conversation.conversation_id)
+    # Everything below stops early if the client disconnects
+    async with cancellation.cancel_on_disconnect(request):
+        # Call the text_to_sql function
+        try:
+            # Keep the event loop free while the LLM and the query run, within the pipeline's limits
+            output = await admission.pipeline.run(text_csv_results, df , query, None, conversation.history())
+        finally:
+            remove_dataset(*temp_paths)
+        tracing.annotate(response_type=output['response_type'], sql=output.get('sql_query'))
         
-        # Check if graph_plots exists and has image data
-        if 'graph_plots' in output['analysis'] and isinstance(output['analysis']['graph_plots'], dict):
-            graph_data = output['analysis']['graph_plots']
-            if graph_data.get('image'):
-                analysis_plot = graph_data
-            elif graph_data.get('html_tag'):
-                analysis_plot = graph_data.get('html_tag')
-    
-    style = """
-    <style>
-        table {
-            width: 100%;
-            border-collapse: collapse;
-        }
-        th, td {
-            padding: 12px;
-            text-align: left;
-            border: 1px solid #DEE2E6;
-        }
-    </style>
-    """
-    html_table = style + output['sql_result'].to_html(index=False, classes='table table-bordered')
-    
-    return {
-        "response_type": output['response_type'],
-        "result": result_str,
-        "sql_query": output['sql_query'],
-        'table': JSONResponse(content=html_table),
-        'analysis_statement': analysis_statement,
-        'analysis_plot': analysis_plot,
-        'csv_data': csv_string  # Add CSV data to the response
-    }
\ No newline at end of file
+        cancellation.check()
+        conversation.record(query, output)
+        if output['response_type'] == 'conversation':
+            return {**output, "conversation_id": conversation.conversation_id}
+        
+        return await query_response(
+            output, formats, chart_format, binary,
+            truncated=output['sql_result'].attrs.get('truncated', False),
+            conversation=conversation,
+            # Never refined by a warehouse follow-up, see Conversation.previous_result
+            source="upload",
+        )
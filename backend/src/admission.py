@@ -0,0 +1,269 @@
+"""
+Admission control and backpressure for the request pipeline.
+
+A question can hold a worker for tens of seconds of chained LLM, warehouse
+and rendering calls. Without a limit a spike queues unbounded work and every
+request slows down together. Two layers bound the work in flight:
+
+- `pipeline` runs whole request pipelines on a bounded thread pool, off the
+  event loop. At most PIPELINE_QUEUE_SIZE requests wait for a worker. A
+  request that finds the queue full is rejected at once with 429. A request
+  that waits longer than PIPELINE_QUEUE_TIMEOUT_SECONDS is dropped from the
+  queue with 503.
+- `stage(name)` limits concurrent calls to one downstream stage ('llm',
+  'warehouse', 'render'), with its own bounded wait queue and timeout. It
+  rejects the same way.
+
+Rejections raise `Overloaded`, which carries the status code and a
+Retry-After estimate taken from the recent service time and queue depth of
+the limiter that refused. Every limiter exports its limit, active count and
+queue depth as gauges. It exports wait and service time as summaries, and
+admitted, rejected and timed-out requests as counters.
+
+Both layers honour the request's cancellation token (see src/cancellation.py).
+A cancelled request leaves any queue it waits in. A cancelled stage job is
+counted in `cancelled_{stage}_total`. When a pipeline is cancelled, the
+pipeline's average service time minus the time it had already run is added
+to `cancelled_seconds_saved_estimate`.
+"""
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from src import cancellation, metrics, tracing
+from src.render_pool import RENDER_POOL_WORKERS
+
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+def _setting(name, default):
+    return int(os.environ.get(name, str(default)))
+
+
+class Overloaded(Exception):
+    """Raised when a limiter's wait queue is full (429) or a request waited too long for a slot (503)."""
+
+    def __init__(self, limiter, status_code, retry_after, message):
+        super().__init__(message)
+        self.limiter = limiter
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _Limiter:
+    """Accounting shared by the stage limits and the pipeline executor."""
+
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        # Moving average of how long a slot is held, for Retry-After
+        self._service_seconds = None
+        metrics.set_gauge(f"admission_{name}_limit", self.limit)
+        metrics.set_gauge(f"admission_{name}_queue_limit", self.max_queue)
+
+    def expected_service_seconds(self):
+        """Recent average time a slot is held, or None before any call completed."""
+        with self._lock:
+            return self._service_seconds
+
+    def _report(self):
+        # Called with the lock held
+        metrics.set_gauge(f"admission_{self.name}_active", self._active)
+        metrics.set_gauge(f"admission_{self.name}_queue_depth", self._queued)
+
+    def _retry_after(self):
+        # Called with the lock held: time for the queue ahead to drain through the slots
+        service = self._service_seconds or 1.0
+        estimate = math.ceil(service * (self._queued + 1) / self.limit)
+        return min(max(1, estimate), MAX_RETRY_AFTER_SECONDS)
+
+    def _reject(self, status_code):
+        # Called with the lock held
+        if status_code == 429:
+            metrics.increment(f"admission_{self.name}_rejected_total")
+            message = f"Too many requests waiting for {self.name}, please retry shortly."
+        else:
+            metrics.increment(f"admission_{self.name}_timeouts_total")
+            message = f"Timed out after {self.queue_timeout:g}s waiting for {self.name}, please retry shortly."
+        return Overloaded(self.name, status_code, self._retry_after(), message)
+
+    def _started(self, waited):
+        # Called with the lock held once a slot is taken
+        self._active += 1
+        self._report()
+        metrics.increment(f"admission_{self.name}_admitted_total")
+        metrics.observe(f"admission_{self.name}_wait_seconds", waited)
+        tracing.annotate(**{f"{self.name}_wait_ms": round(waited * 1000, 3)})
+
+    def _finished(self, held, completed=True):
+        with self._lock:
+            self._active -= 1
+            # Cancelled runs would drag the service time estimate down
+            if completed and self._service_seconds is None:
+                self._service_seconds = held
+            elif completed:
+                self._service_seconds = 0.8 * self._service_seconds + 0.2 * held
+            expected = self._service_seconds
+            self._report()
+        if completed:
+            metrics.observe(f"admission_{self.name}_service_seconds", held)
+        return expected
+
+
+class Stage(_Limiter):
+    """Concurrency limit with a bounded wait queue for calls to one downstream stage, used from worker threads."""
+
+    def __init__(self, name, limit, max_queue, queue_timeout=QUEUE_TIMEOUT_SECONDS):
+        super().__init__(name, limit, max_queue, queue_timeout)
+        self._slot_freed = threading.Condition(self._lock)
+
+    @contextmanager
+    def slot(self):
+        """Hold one slot of the stage for the duration of the block."""
+        self._acquire()
+        started = time.monotonic()
+        completed = False
+        try:
+            yield
+            completed = True
+        except cancellation.Cancelled:
+            cancellation.dropped(self.name)
+            raise
+        finally:
+            self._finished(time.monotonic() - started, completed)
+            # All waiters: the first one woken may be leaving because its request was cancelled
+            self._wake()
+
+    def _wake(self):
+        with self._lock:
+            self._slot_freed.notify_all()
+
+    def _acquire(self):
+        token = cancellation.current()
+        requested = time.monotonic()
+        deadline = requested + self.queue_timeout
+        # Registered outside the lock: the callback takes it to wake the waiters
+        with token.on_cancel(self._wake), self._lock:
+            if token.cancelled:
+                cancellation.dropped(self.name)
+                token.check()
+            if self._active >= self.limit:
+                if self._queued >= self.max_queue:
+                    raise self._reject(429)
+                self._queued += 1
+                self._report()
+                try:
+                    while self._active >= self.limit:
+                        if token.cancelled:
+                            cancellation.dropped(self.name)
+                            token.check()
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._reject(503)
+                        self._slot_freed.wait(remaining)
+                finally:
+                    self._queued -= 1
+            self._started(time.monotonic() - requested)
+
+
+class PipelineExecutor(_Limiter):
+    """Bounded thread pool for request pipelines, with a bounded queue and a queueing timeout."""
+
+    def __init__(self, name, workers, max_queue, queue_timeout=QUEUE_TIMEOUT_SECONDS):
+        super().__init__(name, workers, max_queue, queue_timeout)
+        self._pool = ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix=name)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn` on the pool and await its result without blocking the event loop.
+
+        `fn` runs in a copy of the caller's context, so it sees the request's cancellation token.
+        """
+        token = cancellation.current()
+        token.check()
+        with self._lock:
+            # Submissions beyond the free workers wait in the pool's queue
+            if self._active + self._queued >= self.limit + self.max_queue:
+                raise self._reject(429)
+            self._queued += 1
+            self._report()
+        submitted = time.monotonic()
+
+        def job():
+            with self._lock:
+                self._queued -= 1
+                self._started(time.monotonic() - submitted)
+            started = time.monotonic()
+            completed = False
+            try:
+                result = fn(*args, **kwargs)
+                completed = True
+                return result
+            finally:
+                held = time.monotonic() - started
+                expected = self._finished(held, completed)
+                if token.cancelled and not completed:
+                    cancellation.dropped(self.name)
+                    metrics.increment("cancelled_seconds_saved_estimate", max(0.0, (expected or 0.0) - held))
+
+        future = self._pool.submit(contextvars.copy_context().run, job)
+        waiter = asyncio.wrap_future(future)
+        # A request cancelled while queued is taken off the queue
+        with token.on_cancel(future.cancel):
+            done, _ = await asyncio.wait({waiter}, timeout=self.queue_timeout)
+            if not done and future.cancel():
+                # Still queued after the timeout: it never runs
+                with self._lock:
+                    self._queued -= 1
+                    self._report()
+                    raise self._reject(503)
+            try:
+                return await waiter
+            except asyncio.CancelledError:
+                if not (future.cancelled() and token.cancelled):
+                    raise
+        with self._lock:
+            self._queued -= 1
+            self._report()
+            expected = self._service_seconds
+        cancellation.dropped(self.name)
+        metrics.increment("cancelled_seconds_saved_estimate", expected or 0.0)
+        token.check()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+pipeline = PipelineExecutor(
+    "pipeline",
+    _setting("PIPELINE_WORKERS", 16),
+    _setting("PIPELINE_QUEUE_SIZE", 32),
+    float(os.environ.get("PIPELINE_QUEUE_TIMEOUT_SECONDS", str(QUEUE_TIMEOUT_SECONDS))),
+)
+
+stages = {
+    # Bedrock calls: SQL generation, analysis and fallback chart code
+    "llm": Stage("llm", _setting("LLM_CONCURRENCY", 8), _setting("LLM_QUEUE_SIZE", 16)),
+    # Snowflake queries
+    "warehouse": Stage("warehouse", _setting("WAREHOUSE_CONCURRENCY", 8), _setting("WAREHOUSE_QUEUE_SIZE", 16)),
+    # Server-side PNG charts and sandboxed chart code
+    "render": Stage(
+        "render", _setting("RENDER_CONCURRENCY", RENDER_POOL_WORKERS), _setting("RENDER_QUEUE_SIZE", 2 * RENDER_POOL_WORKERS)
+    ),
+}
+
+
+def stage(name):
+    """Context manager holding a slot of the named stage, raising `Overloaded` when none is available in time."""
+    return stages[name].slot()
@@ -6,71 +6,70 @@ pip install langchain langchain-aws boto3 pydantic
 """
 import os
 import json
-import yaml
-from langchain_aws import BedrockLLM
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.chat_models.bedrock import BedrockChat
-from langchain.chains import LLMChain
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+import logging
 from typing import Optional
 from src.call_snowflake import get_data
 from typing import List, Dict
 from src.output_analysis import output_analyser
+from src import admission, cancellation, conversations, follow_up, tracing
+from src.llm import chat_model
+from src import semantic_model
 
-with open("/home/nishantkumar.jha/projects/experiments/phaser/backend/src/semantic.yml", "r") as file:
-        semantic = yaml.safe_load(file)
+logger = logging.getLogger(__name__)
 
 
-def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None):
+def text_to_sql_and_result(
+    query: str,
+    chat_history: List[Dict[str, str]] = None,
+    history: Optional[str] = None,
+    previous: Optional[follow_up.Previous] = None,
+):
     """
     Process user query to generate SQL or conversational responses, with chat history context.
     
     Args:
         query (str): The user's current query
         chat_history (List[Dict[str, str]], optional): List of previous messages with 'role' and 'content'
+        history (str, optional): Conversation history already rendered for the prompt (see
+            src/conversations.py); replaces chat_history when given
+        previous (follow_up.Previous, optional): The conversation's last query result, which
+            follow-up questions may refine locally instead of querying Snowflake again
     
     Returns:
         dict: Response containing response_type and appropriate content
     """
-    # Initialize chat history if None
-    if chat_history is None:
-        chat_history = []
-    
-    # Create memory for LLM context
-    memory = ConversationBufferMemory()
-    
-    # Process recent history (last 4 messages to avoid token limits)
-    recent_history = chat_history[-4:] if chat_history else []
-    
-    # Add messages to memory
-    for msg in recent_history:
-        role = msg.get('role', '').lower()
-        content = msg.get('content', '')
-        
-        if content:  # Skip empty messages
-            if role == 'user':
-                memory.chat_memory.add_user_message(content)
-            elif role == 'assistant':
-                memory.chat_memory.add_ai_message(content)
-    
-    # Format history for prompt
-    history_text = ""
-    for msg in recent_history:
-        role = msg.get('role', '').upper()
-        content = msg.get('content', '')
-        if role and content:
-            history_text += f"{role}: {content}\n\n"
+    # One version of the schema for the whole request, even if it is reloaded meanwhile
+    semantic = semantic_model.current()
+    tracing.annotate(semantic_version=semantic.version)
+
+    # "only store 2", "sort that by sales": no LLM call and no warehouse query
+    if previous is not None:
+        refinement = follow_up.local_refinement(query, previous, semantic)
+        if refinement:
+            try:
+                return _refined(query, previous, refinement, "Refined the previous result.", "local")
+            except (admission.Overloaded, cancellation.Cancelled):
+                raise
+            except Exception as e:
+                logger.info("Local refinement failed, asking the LLM: %s", e)
+
+    # LangChain is imported on the first question, not when the app starts
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+
+    # Token-bounded history: the server-side conversation's, else built from the client's messages
+    history_text = history if history is not None else conversations.format_messages(chat_history)
 
     # Define response schemas
     response_schemas = [
         ResponseSchema(
             name="response_type",
-            description="A string indicating the type of response: 'sql' for SQL queries, 'conversation' for normal chat, or 'unauthorized' for inappropriate questions"
+            description="A string indicating the type of response: 'sql' for SQL queries, 'refine' for a query over the previous result, 'conversation' for normal chat, or 'unauthorized' for inappropriate questions"
         ),
         ResponseSchema(
             name="content",
-            description="The actual response content - either SQL query or conversational text depending on response_type"
+            description="The actual response content - either SQL query, refinement query or conversational text depending on response_type"
         ),
         ResponseSchema(
             name="explanation",
@@ -85,15 +84,7 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
 
     # print("format instr: ", ana_format_instructions)
     # Initialize the Bedrock LLM
-    llm = BedrockChat(
-            model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",  
-            model_kwargs={
-                "temperature": 0.4,
-                "max_tokens": 2000,  
-                "top_p": 0.7,
-            },
-            region_name="us-east-1"  # Changed from "region" to "region_name"
-        )
+    llm = chat_model()
 
     prompt = PromptTemplate(
         input_variables=["user_input", "history"],
@@ -105,6 +96,9 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
         CONVERSATION HISTORY(it may help you understand the previous context, if in current user input there is no cotext to history, you can ignore it):
         {history}
         
+        PREVIOUS RESULT (the result of the last query, if any):
+        {previous_result}
+
         CURRENT USER INPUT:
         "{user_input}"
 
@@ -133,6 +127,11 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
         - Set content to "I am not authorized to perform this question."
         - Leave explanation as an empty string
 
+        5. If there is a previous result and the input only filters, sorts, limits or aggregates it, using only its columns:
+        - Set response_type to "refine"
+        - Generate a DuckDB SQL query that reads only from the table previous_result in the content field
+        - Explain what the query does in the explanation field
+
         ## SQL BEST PRACTICES (When generating SQL):
         - Use clear table aliases (e.g., f for Features, s for Sales)
         - Format dates consistently using standard Snowflake SQL functions
@@ -145,7 +144,11 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
 
         {format_instructions}
         """,
-        partial_variables={"format_instructions": format_instructions, "semantic": semantic},
+        partial_variables={
+            "format_instructions": format_instructions,
+            "semantic": semantic.prompt("sql"),
+            "previous_result": previous.describe() if previous is not None else "None",
+        },
     )
 
     # Create a chain
@@ -160,10 +163,15 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
         
         # Run the chain with user input and chat history
         
-        raw_output = chain.run(user_input=query, history=history_text)
-        
-        # Parse the output
-        parsed_output = parser.parse(raw_output)
+        with tracing.span("llm.generate_sql", attempt=i + 1):
+            with admission.stage("llm"):
+                raw_output = chain.run(
+                    user_input=query, history=history_text, callbacks=cancellation.llm_callbacks()
+                )
+            
+            # Parse the output
+            parsed_output = parser.parse(raw_output)
+            tracing.annotate(response_type=parsed_output.get('response_type'), sql=parsed_output.get('content'))
         
         # Handle conversational response
         if parsed_output['response_type'] == 'conversation' or parsed_output['response_type'] == 'unauthorized':
@@ -177,12 +185,9 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
             sql_query = parsed_output['content']
             # Execute SQL query and get results
             try:
-                print("SQL Query:", sql_query)
                 sql_result = get_data(sql_query)
-                print("SQL Result:", type(sql_result))
 
                 analysis_results = output_analyser(sql_result , sql_query , query )
-                print("analysis results: ", analysis_results)
                 return {
                     "response_type": "sql",
                     "sql_query": sql_query,
@@ -190,11 +195,26 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
                     "sql_result": sql_result,   
                     "analysis": analysis_results
                 }
+            except (admission.Overloaded, cancellation.Cancelled):
+                # Not a problem with the SQL, retrying would only add load
+                raise
             except Exception as e:
-                print("Error post final result is: ", e)
+                logger.info("Query attempt %d failed, asking for a corrected query: %s", i + 1, e)
                 history_text += "ai: " + sql_query + "\n\n" + "human: I am getting this error- " + str(e) + "Please fix this and give correct snowflake sql query.\n\n"
                 continue
         
+        # Refinement of the previous result, run locally
+        elif parsed_output['response_type'] == 'refine' and previous is not None:
+            refinement = parsed_output['content']
+            try:
+                return _refined(query, previous, refinement, parsed_output['explanation'], "llm")
+            except (admission.Overloaded, cancellation.Cancelled):
+                raise
+            except Exception as e:
+                logger.info("Refinement attempt %d failed, asking for a corrected query: %s", i + 1, e)
+                history_text += "ai: " + refinement + "\n\n" + "human: I am getting this error- " + str(e) + "Please fix this and give correct DuckDB sql query over previous_result.\n\n"
+                continue
+        
         # Fallback for unexpected response types
         else:
             return {
@@ -202,6 +222,21 @@ def text_to_sql_and_result(query: str, chat_history: List[Dict[str, str]] = None
                 "output": "Received an unexpected response type."
             }
                 
+
+
+def _refined(query, previous, refinement, explanation, source):
+    """Response for a follow-up answered from the previous result."""
+    sql_result = follow_up.run(refinement, previous, source)
+    sql_query = follow_up.composed_sql(previous, refinement)
+    analysis_results = output_analyser(sql_result, sql_query, query)
+    return {
+        "response_type": "sql",
+        "sql_query": sql_query,
+        "explanation": explanation,
+        "sql_result": sql_result,
+        "analysis": analysis_results,
+    }
+
             
 if __name__ == "__main__":
     # Example usage
@@ -1,10 +1,68 @@
-from src.connection import get_secret, get_snowflake_connection
+from src import admission, cancellation, replica, rollups, single_flight, tracing
 import pandas as pd
 
 
 def get_data(query):
-    secrets = get_secret()
-    conn_snf = get_snowflake_connection(secrets)
-    data = pd.read_sql(query, conn_snf)
-    #print("result", data , type(data))
-    return data
\ No newline at end of file
+    # Identical queries running at the same time share one run, see src/single_flight.py
+    return single_flight.queries.do(single_flight.key(query.strip()), _get_data, query)
+
+
+def _get_data(query):
+    # Aggregates of SALES a rollup covers read the rollup instead, see src/rollups.py
+    data = rollups.query(query)
+    if data is not None:
+        return data
+
+    # Answered locally when the replica is enabled, fresh enough and can run the query
+    data = replica.query(query)
+    if data is not None:
+        return data
+
+    # Bounded number of concurrent warehouse queries, see src/admission.py
+    # The Snowflake connector and boto3 are imported on the first warehouse query
+    from src.connection import get_secret, get_snowflake_connection
+
+    with tracing.span("warehouse.query"), admission.stage("warehouse"):
+        secrets = get_secret()
+        conn_snf = get_snowflake_connection(secrets)
+        try:
+            data = _run_cancellable(conn_snf, query)
+        finally:
+            conn_snf.close()
+        tracing.annotate(rows=len(data), bytes=int(data.memory_usage(index=False).sum()))
+        return data
+
+
+def _run_cancellable(conn_snf, query):
+    """Run a query, aborting it in the warehouse if the request is cancelled while it runs."""
+    token = cancellation.current()
+    token.check()
+    cursor = conn_snf.cursor()
+    # Submitted asynchronously so the query id is known while it runs
+    cursor.execute_async(query)
+    query_id = cursor.sfqid
+    tracing.annotate(query_id=query_id)
+    try:
+        with token.on_cancel(lambda: conn_snf.cursor().abort_query(query_id)):
+            cursor.get_results_from_sfqid(query_id)
+            rows = cursor.fetchall()
+    except Exception:
+        # An aborted query fails with a warehouse error, report the cancellation instead
+        token.check()
+        raise
+    token.check()
+    columns = [col[0] for col in cursor.description]
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def fetch_arrow(conn_snf, query):
+    """Run a query and return its whole result as one Arrow table."""
+    import pyarrow as pa
+
+    cursor = conn_snf.cursor()
+    cursor.execute(query)
+    # Batches may type the same NUMBER column with different integer widths
+    batches = list(cursor.fetch_arrow_batches())
+    if batches:
+        return pa.concat_tables(batches, promote_options="permissive")
+    return pa.table({col[0]: pa.array([], type=pa.string()) for col in cursor.description})
@@ -0,0 +1,156 @@
+"""
+Request cancellation, propagated from a client disconnect to the work in flight.
+
+Each pipeline request gets a `CancelToken` in a context variable. The
+endpoint watches the connection and cancels the token when the client goes
+away (a closed tab, a re-asked question). The pipeline code then stops at
+the next stage boundary:
+
+- waits for an LLM, warehouse or render slot are abandoned;
+- a streaming Bedrock call stops at its next token;
+- a running Snowflake query is aborted server-side, and a DuckDB query is
+  interrupted;
+- a sandboxed chart snippet has its process killed.
+
+Code that can abort an operation from another thread registers it with
+`on_cancel` for the duration of the operation. Everything else calls
+`check()` between steps. Both raise `Cancelled`, which ends the request.
+Stages skipped or aborted this way are counted per stage; the pipeline
+estimates the seconds of work saved (see src/admission.py).
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+from src import metrics
+
+
+class Cancelled(Exception):
+    """Raised inside a request's pipeline once its client has disconnected."""
+
+
+class CancelToken:
+    """Cancellation flag plus the callbacks that abort whatever is running when it is set."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.increment("cancelled_requests_total")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # Aborting is best effort; the pipeline still stops at its next check
+                pass
+
+    def check(self):
+        """Raise `Cancelled` if the request was cancelled."""
+        if self._event.is_set():
+            raise Cancelled("The client disconnected.")
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """Call `callback` if the request is cancelled while the block runs (immediately if it already is)."""
+        with self._lock:
+            registered = not self._event.is_set()
+            if registered:
+                self._callbacks.append(callback)
+        if not registered:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+# Never cancelled, for work running outside a request (scripts, warmup)
+_NOT_CANCELLABLE = CancelToken()
+
+_current = contextvars.ContextVar("cancel_token", default=_NOT_CANCELLABLE)
+
+
+def current():
+    """The token of the request being processed."""
+    return _current.get()
+
+
+def bind(token):
+    """Make `token` the current request's token in this context."""
+    _current.set(token)
+
+
+def check():
+    """Raise `Cancelled` if the current request was cancelled."""
+    current().check()
+
+
+def dropped(stage):
+    """Count a stage skipped or aborted because its request was cancelled."""
+    metrics.increment(f"cancelled_{stage}_total")
+
+
+async def watch_disconnect(request, token):
+    """Cancel `token` once the client of `request` disconnects; run as a task for the request's lifetime."""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            token.cancel()
+            return
+
+
+@functools.lru_cache(maxsize=None)
+def _callback_handler_class():
+    # LangChain is only imported once an LLM call needs the handler
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class CancelOnDisconnect(BaseCallbackHandler):
+        # Exceptions raised in a handler only propagate with raise_error set
+        raise_error = True
+
+        def __init__(self, token):
+            self.token = token
+
+        def on_llm_start(self, *args, **kwargs):
+            self.token.check()
+
+        def on_chat_model_start(self, *args, **kwargs):
+            self.token.check()
+
+        def on_llm_new_token(self, *args, **kwargs):
+            # Stops reading the response stream, which closes it
+            self.token.check()
+
+    return CancelOnDisconnect
+
+
+def llm_callbacks():
+    """LangChain callbacks that abort a streaming LLM call of the current request once it is cancelled."""
+    return [_callback_handler_class()(current())]
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(request):
+    """Give the request a fresh token, bound in the current context, cancelled if its client disconnects."""
+    token = CancelToken()
+    bind(token)
+    watcher = asyncio.ensure_future(watch_disconnect(request, token))
+    try:
+        yield token
+    finally:
+        watcher.cancel()
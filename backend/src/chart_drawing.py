@@ -0,0 +1,125 @@
+"""
+Chart drawing with the object-oriented matplotlib API.
+
+Every chart is drawn on its own `Figure` without touching pyplot's global
+state, so this module is safe to use from several threads and is what the
+render pool workers in `src.render_pool` execute.
+"""
+import io
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+import seaborn as sns
+
+from src.downsample import (
+    MAX_SCATTER_POINTS, bin_2d, reduce_categories, reduce_heatmap, reduce_line,
+)
+
+
+def draw_chart(df, visualization_info):
+    """
+    Draw the chart described by `visualization_info` from the full result.
+
+    The data is reduced per chart type (LTTB/min-max for lines, top-N plus "Other" for
+    bar and pie, 2-D binning for scatter and heatmap) before plotting.
+
+    Returns:
+        bytes: The PNG image
+    """
+    # Extract visualization parameters
+    viz_type = visualization_info.get('visualization_type', 'bar')
+    viz_config = visualization_info.get('visualization_config', {})
+    
+    x_column = viz_config.get('x_axis')
+    y_column = viz_config.get('y_axis')
+    title = viz_config.get('title', 'Data Visualization')
+    
+    # y_axis may list several measures; lines plot them all, other charts the first
+    y_columns = y_column if isinstance(y_column, list) else [y_column] if y_column else []
+    y_column = y_columns[0] if y_columns else None
+    
+    # Create figure and axis objects, a standalone Figure keeps no global pyplot state
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    
+    # Generate the appropriate plot based on visualization type
+    if viz_type == 'bar':
+        if x_column and y_column:
+            df = reduce_categories(df, x_column, y_column, viz_type)
+            df.plot(kind='bar', x=x_column, y=y_column, ax=ax)
+        else:
+            # Fall back to simple bar chart of first two columns
+            df.iloc[:, :2].plot(kind='bar', ax=ax)
+            
+    elif viz_type == 'line':
+        if x_column and y_columns:
+            df = reduce_line(df, x_column, y_columns)
+            df.plot(kind='line', x=x_column, y=y_columns, ax=ax)
+        else:
+            numeric_cols = df.iloc[:, :2].select_dtypes(include=['number']).columns.tolist()
+            if numeric_cols:
+                df = reduce_line(df, None, numeric_cols)
+            df.iloc[:, :2].plot(kind='line', ax=ax)
+            
+    elif viz_type == 'scatter':
+        if not (x_column and y_column):
+            # Try to find two numeric columns
+            numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
+            if len(numeric_cols) >= 2:
+                x_column, y_column = numeric_cols[0], numeric_cols[1]
+            else:
+                x_column, y_column = df.columns[0], df.columns[1]
+        if len(df) > MAX_SCATTER_POINTS:
+            # Too dense for individual markers: draw point density on a 2-D grid
+            counts, x_edges, y_edges = bin_2d(df[x_column], df[y_column])
+            mesh = ax.pcolormesh(x_edges, y_edges, counts.T, cmap='viridis')
+            fig.colorbar(mesh, ax=ax, label='points')
+        else:
+            df.plot(kind='scatter', x=x_column, y=y_column, ax=ax)
+                
+    elif viz_type == 'pie':
+        if not (x_column and y_column):
+            # Use the first column as labels and second as values
+            label_column, value_column = df.columns[0], df.columns[1]
+        else:
+            label_column, value_column = x_column, y_column
+        df = reduce_categories(df, label_column, value_column, viz_type)
+        df[value_column].plot(kind='pie', labels=df[label_column], ax=ax)
+            
+    elif viz_type == 'heatmap':
+        # For heatmap we need matrix-like data
+        pivot_columns = viz_config.get('pivot_columns', [])
+        if len(pivot_columns) >= 3:  # We need row, col, and value columns
+            # Coarsened to a bounded grid, averaging repeated cells
+            pivot_df = reduce_heatmap(df, pivot_columns[0], pivot_columns[1], pivot_columns[2])
+            sns.heatmap(pivot_df, annot=pivot_df.size <= 400, ax=ax)
+        else:
+            # Try correlation matrix as fallback for heatmap
+            numeric_df = df.select_dtypes(include=['number'])
+            if not numeric_df.empty:
+                sns.heatmap(numeric_df.corr(), annot=True, ax=ax)
+            else:
+                df.iloc[:, :5].plot(kind='bar', ax=ax)  # Fallback
+    
+    else:  # Default plot if type not recognized
+        df.plot(kind='bar', ax=ax)
+    
+    # Add title and labels using the axis object
+    ax.set_title(title)
+    if x_column:
+        ax.set_xlabel(x_column)
+    if y_columns:
+        ax.set_ylabel(", ".join(str(col) for col in y_columns))
+        
+    # Rotate x-axis labels if there are many categories
+    ax.tick_params(axis='x', rotation=45)
+    
+    # Tight layout to ensure all elements are visible
+    fig.tight_layout()
+    
+    # Save plot to a bytes buffer
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+    
@@ -0,0 +1,247 @@
+"""
+Declarative Vega-Lite chart specs, rendered in the browser.
+
+Instead of rasterizing a PNG on the server, `build_spec` describes the chart
+as a small Vega-Lite JSON document. When the chart plots the result rows as
+they are, and the response carries all of them (the result fits in its first
+page), the spec references those rows (the `result` dataset) instead of
+repeating them. Otherwise only the rows the chart needs are inlined: reduced
+ones (decimated lines, top-N categories, binned scatter, histogram and
+heatmap grids) or the plotted columns.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from src.downsample import (
+    MAX_SCATTER_POINTS, bin_2d, reduce_categories, reduce_heatmap, reduce_line,
+)
+from src.result_digest import date_columns
+from src.result_store import DEFAULT_PAGE_SIZE
+
+VEGA_LITE_SCHEMA = "https://vega.github.io/schema/vega-lite/v5.json"
+
+# Name of the dataset the client binds to the result rows of the response
+RESULT_DATASET = "result"
+
+MAX_HISTOGRAM_BINS = 30
+
+
+def _records(df):
+    # Through pandas' JSON writer so NaN becomes null and dates become ISO strings; six
+    # decimals are plenty for a chart and keep inlined values short
+    return json.loads(df.to_json(orient="records", date_format="iso", double_precision=6))
+
+
+def _field_type(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "temporal"
+    if pd.api.types.is_numeric_dtype(series):
+        return "quantitative"
+    return "nominal"
+
+
+def _with_dates(df, columns):
+    """
+    Parse text date columns among `columns` so the browser gets ISO dates.
+
+    Returns:
+        tuple: (frame, True if a column had to be converted)
+    """
+    parsed = date_columns(df[[col for col in columns if col in df.columns]])
+    converted = {col: values for col, values in parsed.items() if not pd.api.types.is_datetime64_any_dtype(df[col])}
+    if not converted:
+        return df, False
+    return df.assign(**converted), True
+
+
+def _encoding(df, column, **extra):
+    return {"field": str(column), "type": _field_type(df[column]), **extra}
+
+
+def _spec(title, data, mark, encoding, **extra):
+    spec = {
+        "$schema": VEGA_LITE_SCHEMA,
+        "title": title,
+        "width": "container",
+        "height": 360,
+        "data": data,
+        "mark": mark,
+        "encoding": encoding,
+    }
+    spec.update(extra)
+    return spec
+
+
+def _returned(df):
+    # The query response carries the first page of the result, see result_store.DEFAULT_PAGE_SIZE
+    return len(df) <= DEFAULT_PAGE_SIZE
+
+
+def _data(chart_df, reduced):
+    """Reference the returned rows when the chart uses all of them unchanged, otherwise inline the reduced rows."""
+    if reduced is chart_df and _returned(chart_df):
+        return {"name": RESULT_DATASET}
+    return {"values": _records(reduced)}
+
+
+def _line(df, x_column, y_columns, title):
+    chart_df, converted = _with_dates(df, [x_column])
+    reduced = reduce_line(chart_df, x_column, y_columns)
+    data = {"values": _records(reduced)} if converted else _data(chart_df, reduced)
+    x = _encoding(chart_df, x_column)
+    if len(y_columns) == 1:
+        return _spec(title, data, {"type": "line", "tooltip": True}, {"x": x, "y": _encoding(chart_df, y_columns[0])})
+    # Several measures share the y axis, one colored line each
+    return _spec(
+        title, data, {"type": "line", "tooltip": True},
+        {
+            "x": x,
+            "y": {"field": "value", "type": "quantitative"},
+            "color": {"field": "series", "type": "nominal"},
+        },
+        transform=[{"fold": [str(col) for col in y_columns], "as": ["series", "value"]}],
+    )
+
+
+def _categories(df, x_column, y_column, chart_type, title):
+    reduced = reduce_categories(df, x_column, y_column, chart_type)
+    data = _data(df, reduced)
+    if chart_type == "pie":
+        return _spec(
+            title, data, {"type": "arc", "tooltip": True},
+            {
+                "theta": _encoding(reduced, y_column),
+                "color": {"field": str(x_column), "type": "nominal", "sort": None},
+            },
+        )
+    return _spec(
+        title, data, {"type": "bar", "tooltip": True},
+        {
+            "x": {"field": str(x_column), "type": "nominal", "sort": None},
+            "y": _encoding(reduced, y_column),
+        },
+    )
+
+
+def _scatter(df, x_column, y_column, title):
+    if len(df) <= MAX_SCATTER_POINTS:
+        data = {"name": RESULT_DATASET} if _returned(df) else {"values": _records(df[[x_column, y_column]])}
+        return _spec(
+            title, data, {"type": "point", "tooltip": True},
+            {"x": _encoding(df, x_column), "y": _encoding(df, y_column)},
+        )
+    # Too dense for individual marks: point density on a 2-D grid. Only non-empty cells are
+    # sent, as columns of small integers (bin indices and counts) that the browser flattens
+    # back into rows and maps to cell edges with the uniform bin widths
+    counts, x_edges, y_edges = bin_2d(df[x_column], df[y_column])
+    ix, iy = counts.nonzero()
+    x_step, y_step = x_edges[1] - x_edges[0], y_edges[1] - y_edges[0]
+    cells = {"ix": ix.tolist(), "iy": iy.tolist(), "points": counts[ix, iy].astype(int).tolist()}
+    return _spec(
+        title, {"values": [cells]}, {"type": "rect", "tooltip": True},
+        {
+            "x": {"field": "x", "type": "quantitative", "title": str(x_column)},
+            "x2": {"field": "x2"},
+            "y": {"field": "y", "type": "quantitative", "title": str(y_column)},
+            "y2": {"field": "y2"},
+            "color": {"field": "points", "type": "quantitative", "scale": {"scheme": "viridis"}},
+        },
+        transform=[
+            {"flatten": ["ix", "iy", "points"]},
+            {"calculate": f"{x_edges[0]!r} + datum.ix * {x_step!r}", "as": "x"},
+            {"calculate": f"datum.x + {x_step!r}", "as": "x2"},
+            {"calculate": f"{y_edges[0]!r} + datum.iy * {y_step!r}", "as": "y"},
+            {"calculate": f"datum.y + {y_step!r}", "as": "y2"},
+        ],
+    )
+
+
+def _heatmap(df, pivot_columns, title):
+    if len(pivot_columns) >= 3:
+        row_column, col_column, value_column = pivot_columns[:3]
+        matrix = reduce_heatmap(df, row_column, col_column, value_column)
+    else:
+        # Correlation matrix of the numeric columns
+        matrix = df.select_dtypes(include=["number"]).corr()
+        row_column, col_column, value_column = "row", "column", "correlation"
+    cells = matrix.rename_axis(index=row_column, columns=col_column).stack().rename(value_column).reset_index()
+    cells[[row_column, col_column]] = cells[[row_column, col_column]].astype(str)
+    return _spec(
+        title, {"values": _records(cells)}, {"type": "rect", "tooltip": True},
+        {
+            "x": {"field": str(col_column), "type": "nominal", "sort": None},
+            "y": {"field": str(row_column), "type": "nominal", "sort": None},
+            "color": {"field": str(value_column), "type": "quantitative"},
+        },
+    )
+
+
+def _histogram(df, column, title):
+    if _returned(df):
+        # Binned in the browser from the returned rows
+        return _spec(
+            title, {"name": RESULT_DATASET}, "bar",
+            {
+                "x": {"field": str(column), "type": "quantitative", "bin": {"maxbins": MAX_HISTOGRAM_BINS}},
+                "y": {"aggregate": "count", "type": "quantitative"},
+            },
+        )
+    # Binned here: only the bin counts are sent
+    values = pd.to_numeric(df[column], errors="coerce").dropna().to_numpy()
+    counts, edges = np.histogram(values, bins=MAX_HISTOGRAM_BINS)
+    bins = pd.DataFrame({"bin_start": edges[:-1], "bin_end": edges[1:], "count": counts})
+    return _spec(
+        title, {"values": _records(bins)}, "bar",
+        {
+            "x": {"field": "bin_start", "type": "quantitative", "bin": {"binned": True}, "title": str(column)},
+            "x2": {"field": "bin_end"},
+            "y": {"field": "count", "type": "quantitative"},
+        },
+    )
+
+
+def build_spec(df, visualization_info):
+    """
+    Describe the chart in `visualization_info` as a Vega-Lite spec over the full result.
+
+    Args:
+        df (pd.DataFrame): The full query result; its first page is returned to the client as the `result` rows
+        visualization_info (dict): visualization_type and visualization_config (x_axis, y_axis,
+            title, pivot_columns) as produced by the analysis step
+
+    Returns:
+        dict: The Vega-Lite spec
+    """
+    viz_type = visualization_info.get('visualization_type', 'bar')
+    viz_config = visualization_info.get('visualization_config', {}) or {}
+    x_column = viz_config.get('x_axis')
+    y_column = viz_config.get('y_axis')
+    title = viz_config.get('title', 'Data Visualization')
+
+    y_columns = y_column if isinstance(y_column, list) else [y_column] if y_column else []
+    numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
+
+    if viz_type == 'line':
+        if not (x_column and y_columns):
+            x_column, y_columns = df.columns[0], [col for col in numeric_cols if col != df.columns[0]][:1]
+        return _line(df, x_column, y_columns, title)
+
+    if viz_type == 'scatter':
+        if not (x_column and y_columns):
+            pair = numeric_cols[:2] if len(numeric_cols) >= 2 else list(df.columns[:2])
+            x_column, y_columns = pair[0], [pair[1]]
+        return _scatter(df, x_column, y_columns[0], title)
+
+    if viz_type == 'heatmap':
+        return _heatmap(df, viz_config.get('pivot_columns', []), title)
+
+    if viz_type == 'histogram':
+        return _histogram(df, x_column or numeric_cols[0], title)
+
+    # Bar, pie and anything unrecognized
+    if not (x_column and y_columns):
+        x_column, y_columns = df.columns[0], [df.columns[1]]
+    chart_type = 'pie' if viz_type == 'pie' else 'bar'
+    return _categories(df, x_column, y_columns[0], chart_type, title)
@@ -0,0 +1,122 @@
+"""
+Sandboxed execution of LLM-generated plotting code.
+
+Each snippet runs in a fresh child process with CPU-time and address-space
+limits (RLIMIT_CPU, RLIMIT_AS) and a wall-clock timeout enforced by the
+parent, so a slow, looping or memory-hungry snippet only kills its own
+process. The snippet sees `df`, `plt`, `sns`, `pd`, `np` and a ready
+`fig`/`ax` pair, but none of the server's globals, and only the PNG bytes of
+the resulting figure come back. The process is killed if the request is
+cancelled while the snippet runs.
+
+Snippets that drew successfully are cached by the schema of the data they
+were written for (column names and dtypes) and the visualization type, so a
+later fallback for a result of the same shape reuses the code without
+another LLM call.
+"""
+import json
+import multiprocessing
+import os
+import traceback
+
+from src import cancellation
+from src.render_pool import RENDER_START_METHOD
+from src.result_cache import ResultCache
+
+SANDBOX_TIMEOUT_SECONDS = float(os.environ.get("SANDBOX_TIMEOUT_SECONDS", "15"))
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", "10"))
+SANDBOX_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", "2048"))
+
+snippet_cache = ResultCache("snippet", ttl=float(os.environ.get("SNIPPET_CACHE_TTL_SECONDS", "86400")))
+
+
+class SandboxError(Exception):
+    """Raised when a snippet fails or exceeds one of its resource limits."""
+
+
+def _limit_resources(cpu_seconds, memory_mb):
+    import resource
+
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    memory = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def _sandbox_main(conn, code, df, cpu_seconds, memory_mb):
+    try:
+        _limit_resources(cpu_seconds, memory_mb)
+
+        import io
+
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import numpy as np
+        import pandas as pd
+        import seaborn as sns
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        namespace = {"df": df, "plt": plt, "sns": sns, "pd": pd, "np": np, "fig": fig, "ax": ax}
+        exec(code, namespace)
+
+        # Use the figure the snippet created if it made its own
+        fig = namespace.get("fig", fig)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png")
+        conn.send(("ok", buf.getvalue()))
+    except BaseException as e:
+        # MemoryError and SystemExit included, the parent only needs the reason
+        conn.send(("error", f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}"))
+    finally:
+        conn.close()
+
+
+def run_snippet(code, df, timeout=None):
+    """
+    Execute plotting code against `df` in a resource-limited child process.
+
+    Args:
+        code (str): Python code using matplotlib/seaborn/pandas on `df`
+        df (pd.DataFrame): The data to plot
+        timeout (float, optional): Wall-clock limit, SANDBOX_TIMEOUT_SECONDS by default
+
+    Returns:
+        bytes: The PNG image of the figure the code drew
+    """
+    timeout = timeout or SANDBOX_TIMEOUT_SECONDS
+    ctx = multiprocessing.get_context(RENDER_START_METHOD)
+    conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_sandbox_main,
+        args=(child_conn, code, df, SANDBOX_CPU_SECONDS, SANDBOX_MEMORY_MB),
+        daemon=True,
+    )
+    process.start()
+    child_conn.close()
+    token = cancellation.current()
+    try:
+        with token.on_cancel(process.kill):
+            ready = conn.poll(timeout)
+        token.check()
+        if not ready:
+            raise SandboxError(f"Visualization code exceeded {timeout:g}s and was stopped.")
+        try:
+            status, payload = conn.recv()
+        except EOFError:
+            # Killed by the CPU limit or crashed without reporting
+            process.join(timeout=5)
+            raise SandboxError(f"Visualization code was terminated (exit code {process.exitcode}).")
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=5)
+        conn.close()
+    if status != "ok":
+        raise SandboxError(payload)
+    return payload
+
+
+def snippet_key(df, visualization_type):
+    """Cache key for a snippet: the column names and dtypes it was written for, plus the chart type."""
+    schema = [[str(col), str(dtype)] for col, dtype in df.dtypes.items()]
+    return json.dumps([schema, visualization_type])
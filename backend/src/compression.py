@@ -0,0 +1,232 @@
+"""
+Negotiated response compression: zstd, brotli or gzip.
+
+`CompressionMiddleware` picks the best encoding the client accepts and
+compresses compressible responses above a size threshold; small responses
+and already-compressed payloads (Parquet, images, archives) are sent as is.
+Streaming responses (the CSV download) are compressed chunk by chunk,
+flushing after every chunk, so nothing is buffered in full. Large bodies are
+compressed in a worker thread to keep the event loop free. Bytes in and out
+and the time spent per encoding are reported on `/metrics`.
+"""
+import os
+import time
+import zlib
+
+import anyio
+import zstandard
+
+from src import metrics
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+# Brotli above ~5 costs far more CPU than it saves in bytes for dynamic responses
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+
+# Bodies above this size are compressed off the event loop
+THREAD_COMPRESSION_BYTES = 256 * 1024
+
+# Content types that are already compressed or do not shrink
+_INCOMPRESSIBLE_PREFIXES = ("image/png", "image/jpeg", "image/gif", "image/webp", "video/", "audio/")
+_INCOMPRESSIBLE_TYPES = ("application/vnd.apache.parquet", "application/zip", "application/gzip", "application/zstd")
+
+
+def _levels():
+    levels = {"zstd": ZSTD_LEVEL, "gzip": GZIP_LEVEL}
+    if brotli is not None:
+        levels["br"] = BROTLI_QUALITY
+    return levels
+
+
+# Server preference when the client accepts several encodings equally
+ENCODING_PREFERENCE = [enc for enc in ("zstd", "br", "gzip") if enc in _levels()]
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Best supported encoding in an Accept-Encoding header, honouring q-values.
+
+    Returns:
+        str: 'zstd', 'br', 'gzip' or None
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    candidates = [
+        (accepted.get(enc, accepted.get("*", 0.0)), -rank, enc)
+        for rank, enc in enumerate(ENCODING_PREFERENCE)
+    ]
+    q, _, encoding = max(candidates, default=(0.0, 0, None))
+    return encoding if q > 0 else None
+
+
+def compress(data, encoding):
+    """Compress a complete body."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return zlib.compress(data, GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+
+
+class StreamCompressor:
+    """Incremental compressor that flushes after every chunk, so clients receive data as it is produced."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data):
+        if self.encoding == "zstd":
+            return self._obj.compress(data) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "zstd":
+            return self._obj.flush()
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def _compressible(headers):
+    if b"content-encoding" in headers:
+        return False
+    content_type = headers.get(b"content-type", b"").decode("latin-1").lower()
+    if content_type.startswith(_INCOMPRESSIBLE_PREFIXES):
+        return False
+    return not any(content_type.startswith(t) for t in _INCOMPRESSIBLE_TYPES)
+
+
+def _record(encoding, bytes_in, bytes_out, seconds):
+    metrics.increment("compression_bytes_in_total", bytes_in)
+    metrics.increment("compression_bytes_out_total", bytes_out)
+    metrics.increment(f"compression_{encoding}_responses_total")
+    metrics.observe(f"compression_{encoding}_seconds", seconds)
+    metrics.set_gauge(f"compression_{encoding}_level", _levels()[encoding])
+    in_total = metrics.get_counter("compression_bytes_in_total")
+    if in_total:
+        metrics.set_gauge("compression_ratio", metrics.get_counter("compression_bytes_out_total") / in_total)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing HTTP responses with the encoding negotiated from Accept-Encoding."""
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope.get("headers") or [])
+        encoding = negotiate_encoding(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressingResponder(send, encoding, self.minimum_size)
+        await self.app(scope, receive, responder)
+
+
+class _CompressingResponder:
+    def __init__(self, send, encoding, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            # Held back until the first body chunk shows whether and how to compress
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = dict(start.get("headers") or [])
+            small = not more_body and len(body) < self.minimum_size
+            if small or not _compressible(headers):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            if not more_body:
+                # Complete body: compress in one go
+                compressed = await self._compress(body)
+                _record(self.encoding, len(body), len(compressed), self.seconds)
+                await self.send(self._headers(start, len(compressed)))
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            # Streaming response: compress chunk by chunk
+            self.compressor = StreamCompressor(self.encoding)
+            await self.send(self._headers(start, None))
+
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        started = time.perf_counter()
+        out = self.compressor.chunk(body) if body else b""
+        if not more_body:
+            out += self.compressor.finish()
+        self.seconds += time.perf_counter() - started
+        self.bytes_in += len(body)
+        self.bytes_out += len(out)
+        await self.send({"type": "http.response.body", "body": out, "more_body": more_body})
+        if not more_body:
+            _record(self.encoding, self.bytes_in, self.bytes_out, self.seconds)
+
+    async def _compress(self, body):
+        started = time.perf_counter()
+        if len(body) >= THREAD_COMPRESSION_BYTES:
+            compressed = await anyio.to_thread.run_sync(compress, body, self.encoding)
+        else:
+            compressed = compress(body, self.encoding)
+        self.seconds = time.perf_counter() - started
+        return compressed
+
+    def _headers(self, start, content_length):
+        headers = [
+            (name, value) for name, value in start.get("headers") or []
+            if name not in (b"content-length", b"vary")
+        ]
+        vary = dict(start.get("headers") or []).get(b"vary")
+        headers.append((b"vary", (vary + b", Accept-Encoding") if vary else b"Accept-Encoding"))
+        headers.append((b"content-encoding", self.encoding.encode()))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode()))
+        return {**start, "headers": headers}
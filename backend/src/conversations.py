@@ -0,0 +1,272 @@
+"""
+Server-side conversation sessions and the token-bounded history put in prompts.
+
+Clients used to send the whole `chat_history` with every question. Now the
+first response carries a `conversation_id`, and later requests send only that
+id. The server keeps each conversation's turns and renders what the prompt
+needs from them:
+
+- the last CONVERSATION_RECENT_TURNS exchanges, verbatim;
+- the SQL of the last CONVERSATION_SQL_CONTEXT queries, each with the
+  question it answered, its result columns and its row count;
+- older exchanges folded into a rolling summary of one line per exchange,
+  made locally without an LLM call.
+
+The rendered history never exceeds CONVERSATION_HISTORY_TOKENS (estimated at
+about four characters per token). The newest context is kept first: recent
+turns, then prior SQL, then the summary. Prompt tokens per turn therefore
+stay flat however long the conversation gets.
+
+A conversation also remembers the result of its last query, by its id in the
+result store, so follow-ups can refine it without the warehouse (see
+src/follow_up.py). The result is tagged with its source, the warehouse or an
+upload. A follow-up only refines a result from the source it asks about, so a
+warehouse question is never answered from an uploaded file's result.
+
+Sessions live in the worker process and expire after
+CONVERSATION_TTL_SECONDS without a question. A request with an unknown or
+expired id starts a new session, seeded from its `chat_history` if it sent
+one.
+"""
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from src import follow_up, metrics, result_store
+
+CONVERSATION_HISTORY_TOKENS = int(os.environ.get("CONVERSATION_HISTORY_TOKENS", "1000"))
+CONVERSATION_RECENT_TURNS = int(os.environ.get("CONVERSATION_RECENT_TURNS", "2"))
+CONVERSATION_SQL_CONTEXT = int(os.environ.get("CONVERSATION_SQL_CONTEXT", "3"))
+CONVERSATION_TTL_SECONDS = float(os.environ.get("CONVERSATION_TTL_SECONDS", "21600"))
+CONVERSATION_MAX_ENTRIES = int(os.environ.get("CONVERSATION_MAX_ENTRIES", "10000"))
+
+# Lines of rolling summary kept; the token budget usually cuts it shorter
+MAX_SUMMARY_LINES = 50
+# Longest question, answer and SQL text kept per turn
+MAX_TEXT_CHARS = 1200
+MAX_SUMMARY_TEXT_CHARS = 160
+MAX_COLUMNS_LISTED = 12
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """Rough token count of `text`, without loading a tokenizer."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _shorten(text, limit):
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+class Turn:
+    """One question and what was answered."""
+
+    def __init__(self, question, answer="", sql=None, columns=None, rows=None):
+        self.question = _shorten(question, MAX_TEXT_CHARS)
+        self.answer = _shorten(answer, MAX_TEXT_CHARS)
+        self.sql = (sql or "").strip()[:MAX_TEXT_CHARS] or None
+        self.columns = [str(col) for col in columns or []]
+        self.rows = rows
+
+    @classmethod
+    def from_output(cls, question, output):
+        """The turn for a pipeline output (see `text_to_sql_and_result`)."""
+        if output.get("response_type") != "sql":
+            return cls(question, output.get("output", ""))
+        analysis = output.get("analysis")
+        answer = analysis.get("analysis", "") if isinstance(analysis, dict) else ""
+        result = output.get("sql_result")
+        return cls(
+            question,
+            answer or output.get("explanation", ""),
+            output.get("sql_query"),
+            list(result.columns) if result is not None else None,
+            len(result) if result is not None else None,
+        )
+
+    def exchange_text(self):
+        text = f"USER: {self.question}\n\n"
+        if self.answer:
+            text += f"ASSISTANT: {self.answer}\n\n"
+        return text
+
+    def sql_text(self):
+        columns = ", ".join(self.columns[:MAX_COLUMNS_LISTED])
+        if len(self.columns) > MAX_COLUMNS_LISTED:
+            columns += ", ..."
+        shape = f"{self.rows} rows" if self.rows is not None else "result"
+        return f"- Question: {_shorten(self.question, MAX_SUMMARY_TEXT_CHARS)}\n  SQL: {self.sql}\n  Returned: {shape} ({columns})\n"
+
+    def summary_line(self):
+        line = f"- Asked: {_shorten(self.question, MAX_SUMMARY_TEXT_CHARS)}"
+        if self.sql:
+            line += f" -> queried {self.rows if self.rows is not None else 'some'} rows"
+        if self.answer:
+            line += f"; answer: {_shorten(self.answer, MAX_SUMMARY_TEXT_CHARS)}"
+        return line + "\n"
+
+
+class Conversation:
+    """The turns of one conversation: recent ones verbatim, older ones summarized."""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.recent = []
+        self.sql_turns = []
+        self.summary = []
+        self.turns = 0
+        # Last query result in the result store, the SQL that produced it and what it ran on
+        self.result_id = None
+        self.result_sql = None
+        self.result_source = None
+        self.expires_at = time.monotonic() + CONVERSATION_TTL_SECONDS
+        self._lock = threading.Lock()
+
+    def add(self, turn):
+        """Append a turn, folding exchanges beyond the recent window into the summary."""
+        with self._lock:
+            self.turns += 1
+            self.recent.append(turn)
+            if turn.sql:
+                self.sql_turns = (self.sql_turns + [turn])[-CONVERSATION_SQL_CONTEXT:]
+            while len(self.recent) > CONVERSATION_RECENT_TURNS:
+                folded = self.recent.pop(0)
+                self.summary = (self.summary + [folded.summary_line()])[-MAX_SUMMARY_LINES:]
+                metrics.increment("conversation_turns_summarized_total")
+
+    def record(self, question, output):
+        """Append the turn answering `question` with the pipeline `output`."""
+        self.add(Turn.from_output(question, output))
+
+    def keep_result(self, result_id, sql, source="warehouse"):
+        """Remember a stored query result for follow-up questions; `source` is 'warehouse' or 'upload'."""
+        with self._lock:
+            self.result_id = result_id
+            self.result_sql = sql
+            self.result_source = source
+
+    def previous_result(self, source="warehouse"):
+        """
+        The last query result as a `follow_up.Previous`, or None if there is none, it expired
+        or it came from another `source`.
+        """
+        with self._lock:
+            result_id, sql, result_source = self.result_id, self.result_sql, self.result_source
+        if result_id is None or not sql or result_source != source:
+            return None
+        try:
+            entry = result_store.store.get(result_id)
+        except result_store.ResultNotFound:
+            return None
+        return follow_up.Previous(sql, entry)
+
+    def history(self, budget=None):
+        """
+        The conversation as prompt text within `budget` tokens (CONVERSATION_HISTORY_TOKENS by default).
+
+        Newest context wins: recent exchanges, then prior SQL, then the summary, each from
+        the newest entry back until the budget is spent.
+        """
+        remaining = CONVERSATION_HISTORY_TOKENS if budget is None else budget
+        with self._lock:
+            recent = [turn.exchange_text() for turn in self.recent]
+            # SQL of the recent exchanges is listed with the rest of the prior SQL
+            sql = [turn.sql_text() for turn in self.sql_turns]
+            summary = list(self.summary)
+        sections = []
+        for title, entries in (
+            ("Recent messages:\n", recent),
+            ("SQL of previous questions:\n", sql),
+            ("Summary of the earlier conversation:\n", summary),
+        ):
+            kept = []
+            # The title plus the newline joining the sections
+            cost = estimate_tokens(title) + 1
+            for entry in reversed(entries):
+                tokens = estimate_tokens(entry)
+                if cost + tokens > remaining:
+                    break
+                kept.insert(0, entry)
+                cost += tokens
+            if kept:
+                sections.append(title + "".join(kept))
+                remaining -= cost
+        # Oldest context first, as the prompt reads top to bottom
+        text = "\n".join(reversed(sections))
+        metrics.observe("conversation_history_tokens", estimate_tokens(text))
+        return text
+
+
+def format_messages(chat_history, budget=None):
+    """Prompt history for a client-sent `chat_history`, within the same token budget."""
+    conversation = Conversation(None)
+    for turn in _turns_from_messages(chat_history):
+        conversation.add(turn)
+    return conversation.history(budget)
+
+
+def _turns_from_messages(chat_history):
+    # Pairs each user message with the assistant messages that follow it
+    turns = []
+    for message in chat_history or []:
+        role = str(message.get("role", "")).lower()
+        content = message.get("content", "")
+        if not content:
+            continue
+        if role == "user":
+            turns.append(Turn(content))
+        elif role == "assistant" and turns:
+            previous = turns[-1]
+            turns[-1] = Turn(previous.question, f"{previous.answer} {content}".strip())
+    return turns
+
+
+class ConversationStore:
+    """Conversations by id, least recently used dropped beyond CONVERSATION_MAX_ENTRIES."""
+
+    def __init__(self, max_entries=CONVERSATION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def session(self, conversation_id=None, chat_history=None):
+        """
+        The conversation with `conversation_id`, or a new one if the id is missing, unknown or
+        expired. A new conversation starts from the client's `chat_history`, if any.
+        """
+        now = time.monotonic()
+        with self._lock:
+            conversation = self._entries.get(conversation_id) if conversation_id else None
+            if conversation is not None and conversation.expires_at >= now:
+                self._entries.move_to_end(conversation_id)
+                conversation.expires_at = now + CONVERSATION_TTL_SECONDS
+                metrics.increment("conversations_resumed_total")
+                return conversation
+            conversation = Conversation(uuid.uuid4().hex)
+            self._entries[conversation.conversation_id] = conversation
+            self._expire(now)
+            metrics.set_gauge("conversations_active", len(self._entries))
+        metrics.increment("conversations_started_total")
+        for turn in _turns_from_messages(chat_history):
+            conversation.add(turn)
+        return conversation
+
+    def _expire(self, now):
+        # Called with the lock held; least recently used first, so the first live entry ends the scan
+        for key in list(self._entries):
+            if self._entries[key].expires_at >= now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            metrics.set_gauge("conversations_active", 0)
+
+
+store = ConversationStore()
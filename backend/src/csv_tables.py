@@ -0,0 +1,186 @@
+"""
+Helpers for querying several uploaded files at once.
+
+Each uploaded file becomes its own named table. Candidate join keys between the
+tables are detected from column names and overlapping values and described to
+the LLM next to the schema, so it can join the files at query time instead of
+users pre-joining them before the upload.
+"""
+import os
+import re
+from itertools import combinations
+
+import pandas as pd
+
+from src.out_of_core import describe_source, distinct_values, source_schema
+
+# Distinct values sampled per column when measuring value overlap
+JOIN_SAMPLE_SIZE = 10000
+
+# Share of the smaller column's values that must appear in the other column
+MIN_NAME_MATCH_OVERLAP = 0.1
+MIN_VALUE_MATCH_OVERLAP = 0.8
+
+# Value-only matches on small domains (flags, 1..5 codes) are coincidences
+MIN_VALUE_MATCH_DISTINCT = 10
+
+# Join key candidates listed in the prompt
+MAX_JOIN_CANDIDATES = 10
+
+_KEY_SUFFIXES = ("_id", "_key", "_code", "_no", "id", "key")
+_COMPRESSION_EXTENSIONS = (".gz", ".zst", ".zstd", ".bz2", ".xz")
+
+
+def table_name_from_filename(filename, taken=()):
+    """Turn an uploaded file name into a SQL-safe table name that is not in `taken`."""
+    stem, ext = os.path.splitext(os.path.basename(filename or ""))
+    # Strip the inner extension of compressed files such as sales.csv.gz
+    if ext.lower() in _COMPRESSION_EXTENSIONS:
+        stem = os.path.splitext(stem)[0]
+    name = re.sub(r"\W+", "_", stem).strip("_").lower() or "table"
+    if name[0].isdigit():
+        name = "t_" + name
+    candidate, i = name, 2
+    while candidate in taken:
+        candidate = f"{name}_{i}"
+        i += 1
+    return candidate
+
+
+def _is_dataframe(source):
+    return isinstance(source, pd.DataFrame)
+
+
+def infer_schema(source):
+    """
+    Column names and types of a table.
+
+    Args:
+        source (pd.DataFrame | str | pa.Table): DataFrame, Parquet dataset directory or Arrow table
+
+    Returns:
+        dict: column name -> type name
+    """
+    if _is_dataframe(source):
+        return {col: str(dtype) for col, dtype in source.dtypes.items()}
+    return source_schema(source)
+
+
+def _normalize(column):
+    name = column.lower()
+    for suffix in _KEY_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)].rstrip("_")
+    return name
+
+
+def _name_score(left, right):
+    if left.lower() == right.lower():
+        return 1.0
+    if _normalize(left) == _normalize(right):
+        return 0.8
+    return 0.0
+
+
+def _kind(type_name):
+    type_name = type_name.lower()
+    if "float" in type_name or "double" in type_name or "decimal" in type_name:
+        return "float"
+    if "int" in type_name:
+        return "int"
+    if "date" in type_name or "time" in type_name:
+        return "datetime"
+    if "bool" in type_name:
+        return "bool"
+    return "text"
+
+
+def _distinct(source, column):
+    if _is_dataframe(source):
+        values = source[column].dropna().unique()[:JOIN_SAMPLE_SIZE]
+    else:
+        values = distinct_values(source, column, JOIN_SAMPLE_SIZE)
+    # Compare keys as text so 1 and "1" from differently typed files still match
+    return {str(value) for value in values}
+
+
+def detect_join_keys(tables):
+    """
+    Find column pairs that look like join keys between the uploaded tables.
+
+    A pair is a candidate when the names match (ignoring case and id/key suffixes)
+    and some values overlap, or when the names differ but almost all values of one
+    column appear in the other.
+
+    Args:
+        tables (dict): Table name -> DataFrame, Parquet dataset directory or Arrow table
+
+    Returns:
+        list: dicts with left/right table and column, the match reason and value overlap,
+        best candidates first
+    """
+    schemas = {name: infer_schema(source) for name, source in tables.items()}
+    distinct_cache = {}
+
+    def distinct(table, column):
+        if (table, column) not in distinct_cache:
+            distinct_cache[(table, column)] = _distinct(tables[table], column)
+        return distinct_cache[(table, column)]
+
+    candidates = []
+    for left, right in combinations(tables, 2):
+        for left_col, left_type in schemas[left].items():
+            for right_col, right_type in schemas[right].items():
+                kind = _kind(left_type)
+                if kind != _kind(right_type) or kind in ("float", "bool"):
+                    continue
+                name_score = _name_score(left_col, right_col)
+                left_values, right_values = distinct(left, left_col), distinct(right, right_col)
+                smaller = min(len(left_values), len(right_values))
+                if smaller < 2:
+                    continue
+                overlap = len(left_values & right_values) / smaller
+                if name_score and overlap >= MIN_NAME_MATCH_OVERLAP:
+                    reason = "same column name"
+                elif overlap >= MIN_VALUE_MATCH_OVERLAP and smaller >= MIN_VALUE_MATCH_DISTINCT:
+                    reason = "overlapping values"
+                else:
+                    continue
+                candidates.append({
+                    "left_table": left,
+                    "left_column": left_col,
+                    "right_table": right,
+                    "right_column": right_col,
+                    "reason": reason,
+                    "overlap": round(overlap, 2),
+                    "score": name_score + overlap,
+                })
+    candidates.sort(key=lambda c: c["score"], reverse=True)
+    return candidates[:MAX_JOIN_CANDIDATES]
+
+
+def describe_tables(tables):
+    """
+    Schema text for the SQL prompt: statistics per table plus the candidate join keys.
+
+    Args:
+        tables (dict): Table name -> DataFrame, Parquet dataset directory or Arrow table
+    """
+    sections = []
+    for name, source in tables.items():
+        columns = ", ".join(f"{col} ({dtype})" for col, dtype in infer_schema(source).items())
+        stats = source.describe(include='all') if _is_dataframe(source) else describe_source(source)
+        sections.append(f"Table '{name}':\nColumns: {columns}\n{stats}\n")
+
+    if len(tables) > 1:
+        join_keys = detect_join_keys(tables)
+        if join_keys:
+            lines = [
+                f"- {k['left_table']}.{k['left_column']} = {k['right_table']}.{k['right_column']} "
+                f"({k['reason']}, {int(k['overlap'] * 100)}% of values match)"
+                for k in join_keys
+            ]
+            sections.append("Candidate join keys between the tables:\n" + "\n".join(lines))
+        else:
+            sections.append("No join keys were detected between the tables.")
+    return "\n".join(sections)
@@ -0,0 +1,184 @@
+"""
+Visual-fidelity-preserving data reduction applied before plotting.
+
+A chart is at most a few thousand pixels wide, so drawing millions of points
+only costs time and memory. Lines are decimated with LTTB (or min-max when
+several series share an axis), bar and pie charts keep the top categories plus
+an "Other" bucket, and dense scatter/heatmap data is binned on a 2-D grid.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+MAX_LINE_POINTS = int(os.environ.get("CHART_MAX_LINE_POINTS", "2000"))
+MAX_BAR_CATEGORIES = int(os.environ.get("CHART_MAX_BAR_CATEGORIES", "30"))
+MAX_PIE_SLICES = int(os.environ.get("CHART_MAX_PIE_SLICES", "8"))
+MAX_SCATTER_POINTS = int(os.environ.get("CHART_MAX_SCATTER_POINTS", "5000"))
+GRID_BINS = int(os.environ.get("CHART_GRID_BINS", "100"))
+MAX_HEATMAP_AXIS = int(os.environ.get("CHART_MAX_HEATMAP_AXIS", "40"))
+
+OTHER_LABEL = "Other"
+
+
+def as_numeric_axis(values):
+    """
+    Float view of an x axis for bucketing, or None if the axis is categorical.
+
+    Datetimes (and text that parses as dates) become nanoseconds since the epoch.
+    """
+    series = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=float)
+    if not pd.api.types.is_datetime64_any_dtype(series):
+        for options in ({"format": "ISO8601"}, {"dayfirst": True}):
+            parsed = pd.to_datetime(series, errors="coerce", **options)
+            if parsed.notna().mean() > 0.9:
+                series = parsed
+                break
+        else:
+            return None
+    return series.astype("int64").to_numpy(dtype=float)
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of one series sorted by x.
+
+    Returns:
+        np.ndarray: Indices of the `n_out` points to keep, always including the first and last
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # Bucket edges for the n - 2 inner points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        # Average of the next bucket is the third vertex of the triangle
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        bx, by = x[start:end], y[start:end]
+        area = np.abs((x[a] - avg_x) * (by - y[a]) - (x[a] - bx) * (avg_y - y[a]))
+        a = start + int(np.nanargmax(area)) if np.isfinite(area).any() else start
+        keep[i + 1] = a
+    return keep
+
+
+def minmax(y_columns, n_out):
+    """
+    Min-max decimation of several series sharing one sorted x axis.
+
+    Every bucket keeps the rows holding the minimum and maximum of each series,
+    so peaks and dips survive the reduction.
+
+    Returns:
+        np.ndarray: Sorted indices of the rows to keep
+    """
+    n = len(y_columns[0])
+    if n <= n_out:
+        return np.arange(n)
+    n_buckets = max(1, n_out // (2 * len(y_columns)))
+    bucket_size = int(np.ceil(n / n_buckets))
+    pad = n_buckets * bucket_size - n
+    offsets = np.arange(n_buckets) * bucket_size
+    keep = [np.array([0, n - 1])]
+    for y in y_columns:
+        values = np.asarray(y, dtype=float)
+        padded_min = np.concatenate([values, np.full(pad, np.inf)]).reshape(n_buckets, bucket_size)
+        padded_max = np.concatenate([values, np.full(pad, -np.inf)]).reshape(n_buckets, bucket_size)
+        keep.append(offsets + np.argmin(np.nan_to_num(padded_min, nan=np.inf), axis=1))
+        keep.append(offsets + np.argmax(np.nan_to_num(padded_max, nan=-np.inf), axis=1))
+    return np.unique(np.clip(np.concatenate(keep), 0, n - 1))
+
+
+def reduce_line(df, x_column, y_columns, max_points=None):
+    """Sort by x and decimate to at most `max_points` rows, LTTB for one series and min-max for several."""
+    max_points = max_points or MAX_LINE_POINTS
+    if len(df) <= max_points:
+        return df
+    x = as_numeric_axis(df[x_column]) if x_column else None
+    if x is not None:
+        order = np.argsort(x, kind="stable")
+        df = df.iloc[order]
+        x = x[order]
+    else:
+        x = np.arange(len(df), dtype=float)
+    ys = [df[col].to_numpy(dtype=float) for col in y_columns]
+    keep = lttb(x, ys[0], max_points) if len(ys) == 1 else minmax(ys, max_points)
+    return df.iloc[keep]
+
+
+def top_n_with_other(df, x_column, y_column, top_n):
+    """
+    Aggregate `y_column` by `x_column`, keep the `top_n` largest categories and fold the
+    rest into a single "Other" row.
+    """
+    totals = df.groupby(x_column, sort=False, dropna=False)[y_column].sum()
+    if len(totals) <= top_n:
+        return totals.reset_index()
+    ordered = totals.sort_values(ascending=False)
+    top = ordered.iloc[: top_n - 1]
+    other = pd.Series([ordered.iloc[top_n - 1:].sum()], index=[OTHER_LABEL])
+    reduced = pd.concat([top, other])
+    reduced.index.name = x_column
+    return reduced.rename(y_column).reset_index()
+
+
+def reduce_categories(df, x_column, y_column, chart_type):
+    """Top-N plus "Other" for bar and pie charts, applied when categories repeat or are too many."""
+    top_n = MAX_PIE_SLICES if chart_type == "pie" else MAX_BAR_CATEGORIES
+    if df[x_column].is_unique and len(df) <= top_n:
+        return df
+    return top_n_with_other(df, x_column, y_column, top_n)
+
+
+def bin_2d(x, y, bins=None):
+    """
+    Count points on a `bins` x `bins` grid.
+
+    Returns:
+        tuple: (counts with shape (bins, bins) indexed [x, y], x edges, y edges)
+    """
+    bins = bins or GRID_BINS
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    mask = np.isfinite(x) & np.isfinite(y)
+    return np.histogram2d(x[mask], y[mask], bins=bins)
+
+
+def _bin_axis(values, max_labels):
+    """
+    Coarsen one heatmap axis into at most `max_labels` categories: numeric values go
+    into equal-width bins, other values keep the most frequent labels plus "Other".
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        if values.nunique() <= max_labels:
+            return values
+        binned = pd.cut(values, bins=max_labels)
+        return binned.cat.rename_categories([f"{iv.left:.3g} to {iv.right:.3g}" for iv in binned.cat.categories])
+    codes, uniques = pd.factorize(values)
+    if len(uniques) <= max_labels:
+        return values
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    top = np.argsort(counts)[::-1][: max_labels - 1]
+    mapping = np.full(len(uniques), max_labels - 1)
+    mapping[top] = np.arange(len(top))
+    new_codes = np.where(codes >= 0, mapping[codes], -1)
+    return pd.Categorical.from_codes(new_codes, categories=[str(u) for u in uniques[top]] + [OTHER_LABEL])
+
+
+def reduce_heatmap(df, row_column, col_column, value_column):
+    """Pivot to a matrix of at most MAX_HEATMAP_AXIS x MAX_HEATMAP_AXIS cells, averaging values per cell."""
+    binned = pd.DataFrame({
+        row_column: _bin_axis(df[row_column], MAX_HEATMAP_AXIS),
+        col_column: _bin_axis(df[col_column], MAX_HEATMAP_AXIS),
+        value_column: df[value_column].to_numpy(),
+    })
+    return binned.groupby([row_column, col_column], observed=True)[value_column].mean().unstack()
@@ -0,0 +1,166 @@
+"""
+Follow-up questions answered from the previous result instead of the warehouse.
+
+A conversation remembers the result of its last query (kept in the result
+store, see src/conversations.py). A follow-up that only narrows or reshapes
+that result runs on it locally, in DuckDB, not as new SQL against Snowflake.
+Examples are "now only for store 2", "sort that by sales" and "top 5 by
+sales". A follow-up is recognised as a refinement in one of two ways:
+
+- a local rule matches a simple filter, sort or top-N phrasing and builds the
+  query itself, without an LLM call;
+- otherwise the SQL prompt describes the previous result, and the LLM may
+  answer with response_type 'refine' and a query over `previous_result`,
+  which can also aggregate.
+
+The SQL returned to the client wraps the previous query in a
+`WITH previous_result AS (...)` clause, so it still reads as one query over
+the warehouse. The next follow-up refines the refined result.
+"""
+import re
+import time
+
+from src import metrics, query_pool, tracing
+
+# Name of the previous result in refinement queries
+TABLE = "previous_result"
+
+# Columns described to the LLM at most
+MAX_DESCRIBED_COLUMNS = 50
+MAX_DESCRIBED_SQL_CHARS = 1500
+
+_LEAD = r"(?:(?:ok|okay|now|and|then|so|please|can you|could you)[, ]+)*(?:show |give me |keep )?"
+_COLUMN = r"(?P<column>[a-z]\w*(?: [a-z]\w*){0,2}?)"
+_VALUE = r"(?P<value>-?\d+(?:\.\d+)?|'[^']*'|\"[^\"]*\"|\w+)"
+
+_FILTER = re.compile(
+    _LEAD + r"(?:only|just)(?: the)?(?: rows)?(?: for| with| where| in)?(?: the)? " + _COLUMN
+    + r"(?: is| =| equal to| of)? " + _VALUE + r"$",
+    re.IGNORECASE,
+)
+_SORT = re.compile(
+    _LEAD + r"(?P<verb>sort|order|rank)(?: (?:that|it|this|them|these|those|the results?|the table))? by(?: the)? "
+    + _COLUMN + r"(?: (?P<direction>asc|ascending|desc|descending|highest first|lowest first|largest first|smallest first))?$",
+    re.IGNORECASE,
+)
+_TOP = re.compile(
+    _LEAD + r"(?:only |just )?(?:the )?(?P<end>top|first|bottom|last) (?P<n>\d+)"
+    r"(?: (?:rows|results|ones|of (?:them|those|these)))?(?: by(?: the)? " + _COLUMN + r")?$",
+    re.IGNORECASE,
+)
+_DESCENDING = ("desc", "descending", "highest first", "largest first")
+
+
+class Previous:
+    """The last result of a conversation: the SQL that produced it and its stored copy."""
+
+    def __init__(self, sql, entry):
+        self.sql = sql
+        self.columns = list(entry.columns)
+        self.rows = entry.rows
+        # DataFrame, or the Parquet directory once the result store spilled it
+        self.source = entry.source
+        df = entry.df
+        self.types = {str(col): str(dtype) for col, dtype in df.dtypes.items()} if df is not None else {}
+
+    def describe(self):
+        """The previous result for the SQL prompt."""
+        columns = [f"{col} ({self.types[col]})" if col in self.types else col for col in self.columns]
+        if len(columns) > MAX_DESCRIBED_COLUMNS:
+            columns = columns[:MAX_DESCRIBED_COLUMNS] + ["..."]
+        sql = self.sql if len(self.sql) <= MAX_DESCRIBED_SQL_CHARS else self.sql[:MAX_DESCRIBED_SQL_CHARS] + "..."
+        return (
+            f"Table {TABLE}, {self.rows} rows, columns: {', '.join(columns)}\n"
+            f"It is the result of this query:\n{sql}"
+        )
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _column(term, columns, semantic):
+    """The result column a word refers to: by name, by synonym, or the one alias containing it."""
+    wanted = re.sub(r"\s+", "_", term.strip()).lower()
+    candidates = [wanted] + ([wanted[:-1]] if wanted.endswith("s") else [])
+    by_name = {col.lower(): col for col in columns}
+    for candidate in candidates:
+        if candidate in by_name:
+            return by_name[candidate]
+    for candidate in candidates:
+        for _, col in semantic.resolve(candidate):
+            if col.lower() in by_name:
+                return by_name[col.lower()]
+    # Computed columns such as TOTAL_SALES for "sales"
+    matches = [
+        col for col in columns
+        if any(candidate in re.split(r"[^a-z0-9]+", col.lower()) for candidate in candidates)
+    ]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _condition(column, value):
+    if re.fullmatch(r"-?\d+(?:\.\d+)?", value):
+        return f"{_quote(column)} = {value}"
+    if value[:1] in ("'", '"'):
+        value = value[1:-1]
+    literal = "'" + value.replace("'", "''") + "'"
+    # Case-insensitive, "type a" means TYPE 'A'
+    return f"LOWER(CAST({_quote(column)} AS VARCHAR)) = LOWER({literal})"
+
+
+def local_refinement(question, previous, semantic):
+    """
+    A query over `previous_result` for a follow-up phrased as a simple filter, sort or top-N,
+    or None when the question is not one (or names a column the result does not have).
+
+    A phrasing that fits a pattern but names no result column is tried against the next one:
+    "only the top 2" reads as a filter on a column "top" before it reads as a top-N.
+    """
+    text = " ".join(question.strip().rstrip(".!?").split())
+    match = _FILTER.match(text)
+    if match:
+        column = _column(match["column"], previous.columns, semantic)
+        if column is not None:
+            return f"SELECT * FROM {TABLE} WHERE {_condition(column, match['value'])}"
+    match = _SORT.match(text)
+    if match:
+        column = _column(match["column"], previous.columns, semantic)
+        if column is not None:
+            direction = (match["direction"] or "").lower()
+            descending = direction in _DESCENDING or (not direction and match["verb"].lower() == "rank")
+            return f"SELECT * FROM {TABLE} ORDER BY {_quote(column)} {'DESC' if descending else 'ASC'} NULLS LAST"
+    match = _TOP.match(text)
+    if match:
+        end = match["end"].lower()
+        if match["column"] is None:
+            # The previous result's own order; "last N" would need it reversed
+            return f"SELECT * FROM {TABLE} LIMIT {int(match['n'])}" if end in ("top", "first") else None
+        column = _column(match["column"], previous.columns, semantic)
+        if column is None:
+            return None
+        order = "DESC" if end in ("top", "first") else "ASC"
+        return f"SELECT * FROM {TABLE} ORDER BY {_quote(column)} {order} NULLS LAST LIMIT {int(match['n'])}"
+    return None
+
+
+def composed_sql(previous, refinement):
+    """The refinement as one query over the warehouse, for display and for the conversation."""
+    return f"WITH {TABLE} AS (\n{previous.sql.strip().rstrip(';')}\n)\n{refinement.strip().rstrip(';')}"
+
+
+def run(refinement, previous, source):
+    """
+    Run a refinement query on the previous result.
+
+    Args:
+        refinement (str): SQL reading from `previous_result`
+        previous (Previous): The conversation's previous result
+        source (str): 'local' for the rule-based refinement, 'llm' for one the LLM wrote
+    """
+    started = time.perf_counter()
+    with tracing.span("follow_up", source=source, sql=refinement):
+        result = query_pool.run_query(refinement, {TABLE: previous.source})
+    metrics.increment(f"follow_up_{source}_total")
+    metrics.observe("follow_up_seconds", time.perf_counter() - started)
+    return result
@@ -0,0 +1,30 @@
+"""
+The Bedrock chat model shared by SQL generation, analysis and chart code.
+
+LangChain and the AWS SDK take seconds to import, so they are only imported
+when the first prompt is sent (or on `/warmup`). The client is built once per
+process and reused; every call passes its own callbacks.
+"""
+import functools
+import os
+
+BEDROCK_MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "anthropic.claude-3-5-sonnet-20240620-v1:0")
+BEDROCK_REGION = os.environ.get("BEDROCK_REGION", "us-east-1")
+
+
+@functools.lru_cache(maxsize=None)
+def chat_model():
+    """The process-wide BedrockChat client."""
+    from langchain.chat_models.bedrock import BedrockChat
+
+    return BedrockChat(
+        model_id=BEDROCK_MODEL_ID,
+        model_kwargs={
+            "temperature": 0.4,
+            "max_tokens": 2000,
+            "top_p": 0.7,
+        },
+        region_name=BEDROCK_REGION,
+        # Streamed, so a cancelled request stops the response at its next token
+        streaming=True,
+    )
@@ -0,0 +1,49 @@
+"""
+In-process metrics shared by the request pipeline.
+
+Counters, gauges and simple summaries (count/total/max) kept in memory per
+worker and exposed as JSON on `/metrics`.
+"""
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_summaries = {}
+
+
+def increment(name, value=1):
+    """Add `value` to a counter."""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    """Set a gauge to its current value."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, value):
+    """Record one observation (a latency, a size) in a summary."""
+    with _lock:
+        summary = _summaries.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["total"] += value
+        summary["max"] = max(summary["max"], value)
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Copy of every metric, summaries include their mean."""
+    with _lock:
+        summaries = {
+            name: dict(s, mean=s["total"] / s["count"] if s["count"] else 0.0)
+            for name, s in _summaries.items()
+        }
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "summaries": summaries}
@@ -0,0 +1,171 @@
+"""
+Out-of-core query support for uploads that are too large to hold in memory.
+
+Oversized CSV uploads are streamed to disk, converted once into a directory of
+Parquet files and queried in place with DuckDB. DuckDB only reads the columns
+and row groups a query needs (projection and predicate pushdown), memory-maps
+the files and spills to disk once it hits its memory limit, so only the final
+(small) result is materialized as a pandas DataFrame.
+"""
+import os
+import shutil
+import tempfile
+import uuid
+
+import duckdb
+import pandas as pd
+
+# Uploads above this size skip pandas and go through the Parquet path
+OUT_OF_CORE_THRESHOLD_BYTES = int(os.environ.get("CSV_OUT_OF_CORE_THRESHOLD_MB", "200")) * 1024 * 1024
+
+# Memory limit handed to DuckDB, anything above this spills to PARQUET_ROOT
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT", "1GB")
+
+# Target size of a single Parquet partition written from an upload
+PARQUET_FILE_SIZE = os.environ.get("PARQUET_FILE_SIZE", "256MB")
+
+PARQUET_ROOT = os.environ.get("CSV_PARQUET_DIR", os.path.join(tempfile.gettempdir(), "phaser_parquet"))
+
+
+def is_oversized(size):
+    """True if an upload of `size` bytes should be queried out of core."""
+    return size is not None and size > OUT_OF_CORE_THRESHOLD_BYTES
+
+
+def connect(memory_limit=None):
+    """Open a private in-memory DuckDB database with a memory limit and spill directory."""
+    os.makedirs(PARQUET_ROOT, exist_ok=True)
+    conn = duckdb.connect(database=":memory:")
+    conn.execute(f"SET memory_limit = '{memory_limit or DUCKDB_MEMORY_LIMIT}'")
+    conn.execute(f"SET temp_directory = '{os.path.join(PARQUET_ROOT, 'spill')}'")
+    return conn
+
+
+def _parquet_glob(parquet_dir):
+    return os.path.join(parquet_dir, "*.parquet").replace("'", "''")
+
+
+def new_dataset_dir():
+    """Create an empty directory for the Parquet files of one dataset."""
+    parquet_dir = os.path.join(PARQUET_ROOT, f"dataset-{uuid.uuid4().hex}")
+    os.makedirs(parquet_dir)
+    return parquet_dir
+
+
+def save_upload(file_obj, suffix=".csv", directory=None):
+    """Stream an uploaded file object to local disk without reading it into memory."""
+    directory = directory or PARQUET_ROOT
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"upload-{uuid.uuid4().hex}{suffix}")
+    file_obj.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file_obj, out, length=8 * 1024 * 1024)
+    return path
+
+
+def csv_to_parquet(csv_path):
+    """
+    Convert a CSV file on disk into a directory of Parquet partitions.
+
+    The conversion is streamed by DuckDB, so it never needs the whole file in memory.
+    Gzip and zstd compressed files are detected from the .gz / .zst extension.
+
+    Returns:
+        str: Path of the directory holding the Parquet files
+    """
+    parquet_dir = os.path.join(PARQUET_ROOT, f"dataset-{uuid.uuid4().hex}")
+    source = csv_path.replace("'", "''")
+    conn = connect()
+    try:
+        conn.execute(
+            f"COPY (SELECT * FROM read_csv_auto('{source}', sample_size = 100000)) "
+            f"TO '{parquet_dir}' (FORMAT PARQUET, FILE_SIZE_BYTES '{PARQUET_FILE_SIZE}', COMPRESSION ZSTD)"
+        )
+    except BaseException:
+        # Partitions written before the failure
+        remove_dataset(parquet_dir)
+        raise
+    finally:
+        conn.close()
+    return parquet_dir
+
+
+def _source_connection(source):
+    conn = connect()
+    register_tables(conn, {"source": source})
+    return conn
+
+
+def describe_source(source):
+    """
+    Column statistics of a Parquet dataset or Arrow table, the out-of-core counterpart
+    of `DataFrame.describe`.
+    """
+    conn = _source_connection(source)
+    try:
+        return conn.execute('SUMMARIZE SELECT * FROM "source"').df()
+    finally:
+        conn.close()
+
+
+def source_schema(source):
+    """Column name -> type of a Parquet dataset (read from the file footers only) or Arrow table."""
+    conn = _source_connection(source)
+    try:
+        rows = conn.execute('DESCRIBE SELECT * FROM "source"').fetchall()
+    finally:
+        conn.close()
+    return {row[0]: row[1] for row in rows}
+
+
+def distinct_values(source, column, limit=10000):
+    """Up to `limit` distinct non-null values of one column, read without loading the other columns."""
+    conn = _source_connection(source)
+    try:
+        rows = conn.execute(
+            f'SELECT DISTINCT "{column}" FROM "source" WHERE "{column}" IS NOT NULL LIMIT {int(limit)}'
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def register_tables(conn, tables):
+    """
+    Expose uploaded tables on a DuckDB connection.
+
+    Args:
+        conn: DuckDB connection from `connect`
+        tables (dict): Table name -> Parquet dataset directory, pandas DataFrame or Arrow table
+    """
+    for table_name, source in tables.items():
+        if isinstance(source, str):
+            conn.execute(f'CREATE VIEW "{table_name}" AS SELECT * FROM read_parquet(\'{_parquet_glob(source)}\')')
+        else:
+            # DataFrames and Arrow tables are scanned in place, without a copy
+            conn.register(table_name, source)
+
+
+def restrict_to_tables(conn, tables):
+    """
+    Lock a connection down to the tables registered on it: no other files, network,
+    extensions or attached databases, and no setting can be changed back.
+
+    Call after `register_tables`; Parquet datasets stay readable through their directories.
+    """
+    directories = [os.path.join(source, "") for source in tables.values() if isinstance(source, str)]
+    if directories:
+        conn.execute("SET allowed_directories = ?", [directories])
+    conn.execute("SET enable_external_access = false")
+    conn.execute("SET lock_configuration = true")
+
+
+def remove_dataset(*paths):
+    """Delete uploaded files and Parquet directories created for a request."""
+    for path in paths:
+        if not path:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
@@ -1,25 +1,52 @@
-import yaml
 import json
-from langchain_aws import BedrockLLM
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.chat_models.bedrock import BedrockChat
-from langchain.chains import LLMChain
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+import logging
 from typing import Optional
-from src.call_snowflake import get_data
 from typing import List, Dict
 from src.render_graph import render_graph
+from src.result_digest import build_digest
+from src.quick_analysis import quick_analysis
+from src.result_cache import analysis_cache
+from src import admission, cancellation, tracing
+from src.llm import chat_model
+from src import semantic_model
 
-with open("/home/nishantkumar.jha/projects/experiments/phaser/backend/src/semantic.yml", "r") as file:
-        semantic = yaml.safe_load(file)
-
-def truncate_data(data, max_length=1000):
-    data_str = json.dumps(data)
-    return data_str[:max_length] + "..." if len(data_str) > max_length else data_str
+logger = logging.getLogger(__name__)
 
 def output_analyser(sql_result , sql_query , user_query):
+    """
+    Analyze a query result for the user's question, reusing the cached analysis when the
+    same question was already asked about an identical result under the same semantic model.
+    """
+    # Nobody is waiting for the analysis of a cancelled request
+    cancellation.check()
+    with tracing.span("analysis", rows=len(sql_result)):
+        # The prompt includes the schema, so a new semantic model version invalidates the entry
+        semantic = semantic_model.current()
+        cache_key = analysis_cache.key(sql_result, user_query, semantic.version)
+        cached = analysis_cache.get(cache_key)
+        tracing.annotate(cached=cached is not None)
+        if cached is not None:
+            return cached
+        analysis = _output_analyser(sql_result, sql_query, user_query, semantic)
+        # Failed analyses carry no visualization decision and are not cached
+        if "visualization_recommended" in analysis:
+            analysis_cache.put(cache_key, analysis)
+        return analysis
+
+def _output_analyser(sql_result , sql_query , user_query, semantic):
 
+    # Step 0: Clearly shaped results are analyzed locally, without an LLM call
+    local_output = quick_analysis(sql_result, user_query)
+    tracing.annotate(local=local_output is not None)
+    if local_output is not None:
+        if local_output['visualization_recommended']:
+            local_output["graph_plots"] = render_graph(sql_result, local_output)
+        return local_output
+
+    # LangChain is imported on the first LLM analysis, not when the app starts
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
 
     # Step 1: Define the semantic schema used in output parser
     ana_response_schemas = [
@@ -50,10 +77,10 @@ def output_analyser(sql_result , sql_query , user_query):
 
     User Query: {user_query}
 
-    Data for Analysis:
+    Data for Analysis (a statistical digest computed over the full query result; small results include every row):
     {data}
 
-    If the data contains a summary (e.g., sample rows, shape, or columns), use it to infer insights. Generate an insightful analysis that accurately satisfies the user query. Keep the response clear, concise, and **limited to a maximum of 200 words**.
+    Base your insights on the statistics, totals, trends, top/bottom rows and outliers in the digest, they cover all rows of the result. Generate an insightful analysis that accurately satisfies the user query. Keep the response clear, concise, and **limited to a maximum of 200 words**.
     
     Additionally, determine if the data is suitable for visualization:
     1. If the data contains numerical values that can be plotted (e.g., trends, comparisons, distributions), set visualization_recommended to true.
@@ -65,21 +92,17 @@ def output_analyser(sql_result , sql_query , user_query):
     {ana_format_instructions}
     """
     # Initialize prompt template
-    analysis_prompt = PromptTemplate(input_variables=["user_query", "data"], template=analysis_template, partial_variables={"ana_format_instructions": ana_format_instructions, "semantic": semantic},)
-    llm = BedrockChat(
-            model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",  
-            model_kwargs={
-                "temperature": 0.4,
-                "max_tokens": 2000,  
-                "top_p": 0.7,
-            },
-            region_name="us-east-1"  # Changed from "region" to "region_name"
-        )
+    analysis_prompt = PromptTemplate(input_variables=["user_query", "data"], template=analysis_template, partial_variables={"ana_format_instructions": ana_format_instructions, "semantic": semantic.prompt("analysis")},)
+    llm = chat_model()
 
     analysis_chain = LLMChain(llm=llm, prompt=analysis_prompt)
-    if sql_result.shape[0] <= 100:
-        dict_sql_result = sql_result.to_dict()
-        analysis_output = analysis_chain.run(user_query=user_query, data=dict_sql_result)
+    # Compact, token-budgeted summary of the whole result instead of raw rows
+    digest = build_digest(sql_result)
+    try:
+        with tracing.span("llm.analysis"), admission.stage("llm"):
+            analysis_output = analysis_chain.run(
+                user_query=user_query, data=digest, callbacks=cancellation.llm_callbacks()
+            )
         analysis_parsed_output = analysis_parser.parse(analysis_output)
         visualization_data = {
             "visualization_recommended": analysis_parsed_output.get("visualization_recommended", False),
@@ -88,33 +111,12 @@ def output_analyser(sql_result , sql_query , user_query):
         }
         if analysis_parsed_output.get('visualization_recommended') == True:
             graph_plots = render_graph(sql_result, visualization_data)
-            print("Graph plot type and graph plot: ", type(graph_plots), " ", graph_plots)
             analysis_parsed_output["graph_plots"] = graph_plots
         return analysis_parsed_output
-    else:
-        dict_sql_result = {
-            "sample_rows": sql_result.head(10).to_dict(orient="records"),
-            "data_shape": sql_result.shape,
-            "columns": sql_result.columns.tolist()
-        }
-        truncated_data = truncate_data(dict_sql_result)
-        try:
-            analysis_output = analysis_chain.run(user_query=user_query, data=truncated_data)
-            ana_parsed_output = analysis_parser.parse(analysis_output)
-            visualization_data = {
-                "visualization_recommended": ana_parsed_output.get("visualization_recommended", False),
-                "visualization_type": ana_parsed_output.get("visualization_type", "none"),
-                "visualization_config": ana_parsed_output.get("visualization_config", {})
-            }
-            if ana_parsed_output.get('visualization_recommended') == True:
-                graph_plots = render_graph(truncated_data, visualization_data)
-                print("Graph plot type and graph plot: ", type(graph_plots), " ", graph_plots)
-                ana_parsed_output["graph_plots"] = graph_plots
-
-            return ana_parsed_output
-        except Exception as e:
-            print("Error in analysis chain: ", e)
-            ana_parsed_output = {
-                "analysis": "Unable to generate analysis due to an error."
-            }
-            return ana_parsed_output
\ No newline at end of file
+    except (admission.Overloaded, cancellation.Cancelled):
+        raise
+    except Exception as e:
+        logger.warning("Analysis failed: %s", e)
+        return {
+            "analysis": "Unable to generate analysis due to an error."
+        }
\ No newline at end of file
@@ -3,17 +3,15 @@ LangChain with AWS Bedrock Integration Example
 This script shows how to use LangChain with AWS Bedrock LLMs and OutputParser for SQL generation,
 with added visualization capabilities.
 Requirements:
-pip install langchain langchain-aws boto3 pydantic pandas matplotlib seaborn plotly
+pip install langchain langchain-aws boto3 pydantic pandas matplotlib seaborn
 """
 import os
 import json
 import pandas as pd
 import base64
 from io import BytesIO
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
-import plotly.express as px
-import plotly.io as pio
 from langchain_aws import BedrockLLM
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
@@ -21,53 +19,11 @@ from langchain.chains import LLMChain
 from langchain.output_parsers import ResponseSchema, StructuredOutputParser
 from typing import Optional, Dict, Any, List, Union
 from src.call_snowflake import get_data
+from src.quick_analysis import detect_chart_type, generate_insights
+from src.chart_specs import build_spec
+from src.render_graph import CHART_OUTPUT
 
-def detect_chart_type(df: pd.DataFrame, query: str) -> str:
-    """
-    Determine the most appropriate chart type based on data and query.
-    
-    Args:
-        df: The DataFrame containing the query results
-        query: The user's original text query
-        
-    Returns:
-        String indicating the appropriate chart type
-    """
-    # Check for time series data
-    date_cols = [col for col in df.columns if 'date' in col.lower() or 'time' in col.lower()]
-    
-    # Check for numeric columns (potential metrics)
-    numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-    
-    # Check for categorical columns
-    categorical_cols = df.select_dtypes(include=['object', 'category', 'bool']).columns.tolist()
-    
-    # Keywords suggesting certain chart types
-    trend_keywords = ['trend', 'over time', 'history', 'changes']
-    comparison_keywords = ['compare', 'comparison', 'versus', 'vs']
-    distribution_keywords = ['distribution', 'spread', 'frequency']
-    
-    # Check query intent
-    if any(keyword in query.lower() for keyword in trend_keywords) and date_cols and numeric_cols:
-        return 'line'
-    elif any(keyword in query.lower() for keyword in comparison_keywords) and categorical_cols and numeric_cols:
-        return 'bar'
-    elif any(keyword in query.lower() for keyword in distribution_keywords) and numeric_cols:
-        return 'histogram'
-    elif 'correlation' in query.lower() and len(numeric_cols) >= 2:
-        return 'scatter'
-    elif df.shape[1] == 2 and len(numeric_cols) == 1 and len(categorical_cols) == 1:
-        return 'pie'
-    elif date_cols and numeric_cols:
-        return 'line'
-    elif categorical_cols and numeric_cols:
-        return 'bar'
-    elif len(numeric_cols) >= 2:
-        return 'scatter'
-    else:
-        return 'table'  # Default to table if no clear visualization type
-
-def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[str, Any]:
+def create_visualization(df: pd.DataFrame, chart_type: str, query: str, output: Optional[str] = None) -> Dict[str, Any]:
     """
     Create a visualization based on the data and chart type.
     
@@ -75,17 +31,24 @@ def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[
         df: The DataFrame containing the query results
         chart_type: The type of chart to create
         query: The original user query
+        output: 'spec' for a Vega-Lite spec rendered by the client, 'png' for a server-side
+            image; CHART_OUTPUT by default
         
     Returns:
-        Dictionary with base64 encoded image and HTML
+        Dictionary with a Vega-Lite spec, or a base64 encoded image when output is 'png'
     """
+    output = output or CHART_OUTPUT
     result = {'chart_type': chart_type}
     
     if df.empty or df.shape[0] == 0:
         return {'chart_type': 'none', 'message': 'No data available for visualization'}
     
-    # For matplotlib/seaborn charts
-    plt.figure(figsize=(10, 6))
+    # Chart described once, then either handed to the client as a spec or drawn as a PNG
+    viz_info = None
+    
+    # For matplotlib/seaborn charts, drawn on a standalone Figure instead of global pyplot state
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
     
     try:
         if chart_type == 'line':
@@ -95,18 +58,17 @@ def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[
                 x_col = date_cols[0]
                 numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
                 if numeric_cols:
-                    # Create a Plotly line chart
-                    fig = px.line(df, x=x_col, y=numeric_cols, title=f"Trend Analysis: {', '.join(numeric_cols)}")
-                    result['plotly_html'] = pio.to_html(fig, full_html=False)
+                    title = f"Trend Analysis: {', '.join(numeric_cols)}"
+                    viz_info = _viz_info('line', x_col, numeric_cols, title)
                     
-                    # Create a Matplotlib version as fallback
-                    for col in numeric_cols:
-                        plt.plot(df[x_col], df[col], label=col)
-                    plt.xlabel(x_col)
-                    plt.ylabel('Value')
-                    plt.title(f"Trend Analysis: {', '.join(numeric_cols)}")
-                    plt.legend()
-                    plt.xticks(rotation=45)
+                    if output == 'png':
+                        for col in numeric_cols:
+                            ax.plot(df[x_col], df[col], label=col)
+                        ax.set_xlabel(x_col)
+                        ax.set_ylabel('Value')
+                        ax.set_title(title)
+                        ax.legend()
+                        ax.tick_params(axis='x', rotation=45)
                     
         elif chart_type == 'bar':
             # Identify categorical column and numeric column
@@ -116,56 +78,46 @@ def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[
             if categorical_cols and numeric_cols:
                 x_col = categorical_cols[0]
                 y_col = numeric_cols[0]
+                viz_info = _viz_info('bar', x_col, y_col, f"{y_col} by {x_col}")
                 
-                # Create a Plotly bar chart
-                fig = px.bar(df, x=x_col, y=y_col, title=f"{y_col} by {x_col}")
-                result['plotly_html'] = pio.to_html(fig, full_html=False)
-                
-                # Create a Matplotlib version as fallback
-                sns.barplot(x=x_col, y=y_col, data=df)
-                plt.xlabel(x_col)
-                plt.ylabel(y_col)
-                plt.title(f"{y_col} by {x_col}")
-                plt.xticks(rotation=45)
+                if output == 'png':
+                    sns.barplot(x=x_col, y=y_col, data=df, ax=ax)
+                    ax.set_xlabel(x_col)
+                    ax.set_ylabel(y_col)
+                    ax.set_title(f"{y_col} by {x_col}")
+                    ax.tick_params(axis='x', rotation=45)
                 
         elif chart_type == 'histogram':
             numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
             if numeric_cols:
-                # Create a Plotly histogram
-                fig = px.histogram(df, x=numeric_cols[0], title=f"Distribution of {numeric_cols[0]}")
-                result['plotly_html'] = pio.to_html(fig, full_html=False)
+                viz_info = _viz_info('histogram', numeric_cols[0], None, f"Distribution of {numeric_cols[0]}")
                 
-                # Create a Matplotlib version as fallback
-                sns.histplot(df[numeric_cols[0]])
-                plt.xlabel(numeric_cols[0])
-                plt.ylabel('Count')
-                plt.title(f"Distribution of {numeric_cols[0]}")
+                if output == 'png':
+                    sns.histplot(df[numeric_cols[0]], ax=ax)
+                    ax.set_xlabel(numeric_cols[0])
+                    ax.set_ylabel('Count')
+                    ax.set_title(f"Distribution of {numeric_cols[0]}")
                 
         elif chart_type == 'scatter':
             numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
             if len(numeric_cols) >= 2:
-                # Create a Plotly scatter plot
-                fig = px.scatter(df, x=numeric_cols[0], y=numeric_cols[1], 
-                                 title=f"Relationship between {numeric_cols[0]} and {numeric_cols[1]}")
-                result['plotly_html'] = pio.to_html(fig, full_html=False)
+                title = f"Relationship between {numeric_cols[0]} and {numeric_cols[1]}"
+                viz_info = _viz_info('scatter', numeric_cols[0], numeric_cols[1], title)
                 
-                # Create a Matplotlib version as fallback
-                plt.scatter(df[numeric_cols[0]], df[numeric_cols[1]])
-                plt.xlabel(numeric_cols[0])
-                plt.ylabel(numeric_cols[1])
-                plt.title(f"Relationship between {numeric_cols[0]} and {numeric_cols[1]}")
+                if output == 'png':
+                    ax.scatter(df[numeric_cols[0]], df[numeric_cols[1]])
+                    ax.set_xlabel(numeric_cols[0])
+                    ax.set_ylabel(numeric_cols[1])
+                    ax.set_title(title)
                 
         elif chart_type == 'pie':
             categorical_col = df.select_dtypes(include=['object', 'category', 'bool']).columns.tolist()[0]
             numeric_col = df.select_dtypes(include=['number']).columns.tolist()[0]
+            viz_info = _viz_info('pie', categorical_col, numeric_col, f"{numeric_col} by {categorical_col}")
             
-            # Create a Plotly pie chart
-            fig = px.pie(df, names=categorical_col, values=numeric_col, title=f"{numeric_col} by {categorical_col}")
-            result['plotly_html'] = pio.to_html(fig, full_html=False)
-            
-            # Create a Matplotlib version as fallback
-            plt.pie(df[numeric_col], labels=df[categorical_col], autopct='%1.1f%%')
-            plt.title(f"{numeric_col} by {categorical_col}")
+            if output == 'png':
+                ax.pie(df[numeric_col], labels=df[categorical_col], autopct='%1.1f%%')
+                ax.set_title(f"{numeric_col} by {categorical_col}")
             
         else:  # Default case or 'table'
             # For tables, we don't create a plot but return HTML representation
@@ -173,19 +125,22 @@ def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[
             result['table_html'] = df.to_html(classes='table table-striped', index=False)
             
             # Create a simple visualization of the data structure
-            plt.text(0.5, 0.5, f"Table with {df.shape[0]} rows and {df.shape[1]} columns", 
+            ax.text(0.5, 0.5, f"Table with {df.shape[0]} rows and {df.shape[1]} columns", 
                     horizontalalignment='center', verticalalignment='center', fontsize=12)
-            plt.axis('off')
+            ax.axis('off')
             
-        # Save matplotlib figure to base64
-        if chart_type != 'table':
+        if output != 'png':
+            # Rendered by the client from the returned records, no rasterization on the server
+            if viz_info:
+                result['spec'] = build_spec(df, viz_info)
+        elif chart_type != 'table':
+            # Save matplotlib figure to base64
             buffer = BytesIO()
-            plt.tight_layout()
-            plt.savefig(buffer, format='png')
+            fig.tight_layout()
+            fig.savefig(buffer, format='png')
             buffer.seek(0)
             image_base64 = base64.b64encode(buffer.getvalue()).decode()
             result['image_base64'] = image_base64
-            plt.close()
             
     except Exception as e:
         # If visualization fails, return the error and fallback to table
@@ -195,64 +150,12 @@ def create_visualization(df: pd.DataFrame, chart_type: str, query: str) -> Dict[
     
     return result
 
-def generate_insights(df: pd.DataFrame, query: str, sql_query: str) -> List[str]:
-    """
-    Generate insights about the data based on the query results.
-    
-    Args:
-        df: The DataFrame containing the query results
-        query: The original user query
-        sql_query: The SQL query used
-        
-    Returns:
-        List of insight strings
-    """
-    insights = []
-    
-    if df.empty:
-        return ["No data available to generate insights."]
-    
-    try:
-        # Basic stats
-        numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-        if numeric_cols:
-            for col in numeric_cols:
-                insights.append(f"The average {col} is {df[col].mean():.2f}")
-                insights.append(f"The maximum {col} is {df[col].max():.2f}")
-                
-                # Check for outliers
-                q1 = df[col].quantile(0.25)
-                q3 = df[col].quantile(0.75)
-                iqr = q3 - q1
-                outliers = df[(df[col] < (q1 - 1.5 * iqr)) | (df[col] > (q3 + 1.5 * iqr))][col]
-                if not outliers.empty:
-                    insights.append(f"There are {len(outliers)} outliers in {col}")
-        
-        # Time-based insights
-        date_cols = [col for col in df.columns if 'date' in col.lower() or 'time' in col.lower()]
-        if date_cols and numeric_cols:
-            # This would need actual date parsing which depends on your date format
-            insights.append("Time-based analysis would require converting the date columns to datetime format.")
-        
-        # Correlations
-        if len(numeric_cols) >= 2:
-            corr_matrix = df[numeric_cols].corr()
-            high_corrs = [(i, j, corr_matrix.loc[i, j]) 
-                        for i in corr_matrix.columns 
-                        for j in corr_matrix.columns 
-                        if i < j and abs(corr_matrix.loc[i, j]) > 0.7]
-            
-            for i, j, corr in high_corrs:
-                corr_type = "positive" if corr > 0 else "negative"
-                insights.append(f"There is a strong {corr_type} correlation ({corr:.2f}) between {i} and {j}")
-        
-        # Add general data summary
-        insights.append(f"The dataset contains {df.shape[0]} records with {df.shape[1]} fields.")
-        
-    except Exception as e:
-        insights.append(f"Error generating insights: {str(e)}")
-    
-    return insights[:5]  # Limit to top 5 insights
+def _viz_info(chart_type: str, x_col: str, y_col: Union[str, List[str], None], title: str) -> Dict[str, Any]:
+    """Chart description in the shape `chart_specs.build_spec` and `render_graph` take."""
+    return {
+        'visualization_type': chart_type,
+        'visualization_config': {'x_axis': x_col, 'y_axis': y_col, 'title': title},
+    }
 
 def text_to_sql_and_result(query, expected_output=None):
     """
@@ -0,0 +1,126 @@
+"""
+Isolated, resource-limited execution of SQL queries on uploaded data.
+
+Every query gets its own private in-memory DuckDB database, so concurrent users
+never see each other's tables. Queries run on a bounded thread pool (DuckDB
+releases the GIL while executing, so throughput scales with cores) with a
+wall-clock timeout, a cap on returned rows and a memory limit. A query that
+runs past its timeout is interrupted; the worker thread survives and picks up
+the next job. Queries of a cancelled request are dropped from the queue or
+interrupted the same way.
+
+Limits apply to each query, not to the pool: with every worker busy, DuckDB
+can use QUERY_POOL_WORKERS times the memory limit. The cores are shared out
+between the workers (QUERY_THREADS each) so a full pool does not run
+workers x cores threads.
+
+The SQL is generated by an LLM, so it runs sandboxed: only a single SELECT (or
+WITH ... SELECT) is accepted, and the connection can read nothing but the
+tables it was given. Other files, COPY ... TO, ATTACH, extensions and
+configuration changes are refused.
+"""
+import os
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import duckdb
+import pandas as pd
+
+from src import cancellation, tracing
+from src.out_of_core import connect, register_tables, restrict_to_tables
+
+_CORES = os.cpu_count() or 4
+QUERY_POOL_WORKERS = int(os.environ.get("QUERY_POOL_WORKERS", str(_CORES)))
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("QUERY_TIMEOUT_SECONDS", "30"))
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", "100000"))
+# DuckDB memory limit of each query (DUCKDB_MEMORY_LIMIT by default); with every worker busy
+# the pool can use QUERY_POOL_WORKERS times this
+QUERY_MEMORY_LIMIT = os.environ.get("QUERY_MEMORY_LIMIT", "")
+# DuckDB threads per query; by default the cores are shared out so a full pool does not oversubscribe them
+QUERY_THREADS = int(os.environ.get("QUERY_THREADS", "0")) or max(1, _CORES // QUERY_POOL_WORKERS)
+
+_pool = ThreadPoolExecutor(max_workers=QUERY_POOL_WORKERS, thread_name_prefix="csv-query")
+
+
+class QueryTimeout(Exception):
+    """Raised when a query is interrupted for running longer than its timeout."""
+
+
+class QueryRejected(ValueError):
+    """Raised for SQL that is not a single read-only query."""
+
+
+def _check_read_only(conn, sql_query):
+    statements = conn.extract_statements(sql_query)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise QueryRejected("Only a single SELECT query can be run on the data.")
+
+
+def _execute(sql_query, tables, timeout, max_rows, memory_limit, token):
+    conn = connect(memory_limit or None)
+    conn.execute(f"SET threads = {QUERY_THREADS}")
+    # The timer only starts once a worker picks the job up, queueing does not count
+    timer = threading.Timer(timeout, conn.interrupt)
+    timer.start()
+    try:
+        with token.on_cancel(conn.interrupt):
+            register_tables(conn, tables)
+            restrict_to_tables(conn, tables)
+            _check_read_only(conn, sql_query)
+            result = conn.sql(sql_query).limit(max_rows + 1).df()
+    except duckdb.InterruptException:
+        token.check()
+        raise QueryTimeout(f"Query exceeded the {timeout:g}s time limit and was cancelled.")
+    finally:
+        timer.cancel()
+        conn.close()
+
+    truncated = len(result) > max_rows
+    if truncated:
+        result = result.iloc[:max_rows]
+    result.attrs["truncated"] = truncated
+    return result
+
+
+def run_query(sql_query, tables, timeout=None, max_rows=None, memory_limit=None):
+    """
+    Run a query on the pool and wait for its result.
+
+    Args:
+        sql_query (str): The query to run
+        tables (dict): Table name -> DataFrame or Parquet dataset directory
+        timeout (float, optional): Wall-clock limit in seconds, QUERY_TIMEOUT_SECONDS by default
+        max_rows (int, optional): Row cap, QUERY_MAX_ROWS by default
+        memory_limit (str, optional): DuckDB memory limit such as '512MB'
+
+    Returns:
+        pd.DataFrame: The result, with `attrs["truncated"]` set when the row cap was hit
+
+    Raises:
+        QueryRejected: For anything but a single SELECT query
+        QueryTimeout: When the query ran past its timeout
+    """
+    token = cancellation.current()
+    token.check()
+    future = _pool.submit(
+        _execute,
+        sql_query,
+        tables,
+        timeout or QUERY_TIMEOUT_SECONDS,
+        max_rows or QUERY_MAX_ROWS,
+        memory_limit or QUERY_MEMORY_LIMIT,
+        token,
+    )
+    # A query still waiting for a worker is dropped, a running one interrupted in _execute
+    with tracing.span("duckdb.query"), token.on_cancel(future.cancel):
+        try:
+            result = future.result()
+        except CancelledError:
+            token.check()
+            raise
+        tracing.annotate(
+            rows=len(result),
+            bytes=int(result.memory_usage(index=False).sum()),
+            truncated=result.attrs.get("truncated", False),
+        )
+        return result
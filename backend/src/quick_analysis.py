@@ -0,0 +1,239 @@
+"""
+Rule-based first tier of the result analysis.
+
+Trivial or clearly shaped results (empty, a single value, a single row, one
+category against one metric, a time series) are analyzed locally in
+milliseconds with the chart heuristics below. Only ambiguous results fall
+through to the analysis LLM in `output_analysis.output_analyser`.
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from src import metrics
+from src.result_digest import date_columns, split_columns
+
+# Largest category x metric result charted without asking the LLM
+MAX_LOCAL_CATEGORIES = 50
+MAX_PIE_SLICES = 8
+
+
+def detect_chart_type(df: pd.DataFrame, query: str) -> str:
+    """
+    Determine the most appropriate chart type based on data and query.
+    
+    Args:
+        df: The DataFrame containing the query results
+        query: The user's original text query
+        
+    Returns:
+        String indicating the appropriate chart type
+    """
+    # Check for time series data
+    date_cols = [col for col in df.columns if 'date' in col.lower() or 'time' in col.lower()]
+    
+    # Check for numeric columns (potential metrics)
+    numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
+    
+    # Check for categorical columns
+    categorical_cols = df.select_dtypes(include=['object', 'category', 'bool']).columns.tolist()
+    
+    # Keywords suggesting certain chart types
+    trend_keywords = ['trend', 'over time', 'history', 'changes']
+    comparison_keywords = ['compare', 'comparison', 'versus', 'vs']
+    distribution_keywords = ['distribution', 'spread', 'frequency']
+    
+    # Check query intent
+    if any(keyword in query.lower() for keyword in trend_keywords) and date_cols and numeric_cols:
+        return 'line'
+    elif any(keyword in query.lower() for keyword in comparison_keywords) and categorical_cols and numeric_cols:
+        return 'bar'
+    elif any(keyword in query.lower() for keyword in distribution_keywords) and numeric_cols:
+        return 'histogram'
+    elif 'correlation' in query.lower() and len(numeric_cols) >= 2:
+        return 'scatter'
+    elif df.shape[1] == 2 and len(numeric_cols) == 1 and len(categorical_cols) == 1:
+        return 'pie'
+    elif date_cols and numeric_cols:
+        return 'line'
+    elif categorical_cols and numeric_cols:
+        return 'bar'
+    elif len(numeric_cols) >= 2:
+        return 'scatter'
+    else:
+        return 'table'  # Default to table if no clear visualization type
+
+def generate_insights(df: pd.DataFrame, query: str, sql_query: str) -> List[str]:
+    """
+    Generate insights about the data based on the query results.
+    
+    Args:
+        df: The DataFrame containing the query results
+        query: The original user query
+        sql_query: The SQL query used
+        
+    Returns:
+        List of insight strings
+    """
+    insights = []
+    
+    if df.empty:
+        return ["No data available to generate insights."]
+    
+    try:
+        # Basic stats
+        numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
+        if numeric_cols:
+            for col in numeric_cols:
+                insights.append(f"The average {col} is {df[col].mean():.2f}")
+                insights.append(f"The maximum {col} is {df[col].max():.2f}")
+                
+                # Check for outliers
+                q1 = df[col].quantile(0.25)
+                q3 = df[col].quantile(0.75)
+                iqr = q3 - q1
+                outliers = df[(df[col] < (q1 - 1.5 * iqr)) | (df[col] > (q3 + 1.5 * iqr))][col]
+                if not outliers.empty:
+                    insights.append(f"There are {len(outliers)} outliers in {col}")
+        
+        # Time-based insights
+        date_cols = [col for col in df.columns if 'date' in col.lower() or 'time' in col.lower()]
+        if date_cols and numeric_cols:
+            # This would need actual date parsing which depends on your date format
+            insights.append("Time-based analysis would require converting the date columns to datetime format.")
+        
+        # Correlations
+        if len(numeric_cols) >= 2:
+            corr_matrix = df[numeric_cols].corr()
+            high_corrs = [(i, j, corr_matrix.loc[i, j]) 
+                        for i in corr_matrix.columns 
+                        for j in corr_matrix.columns 
+                        if i < j and abs(corr_matrix.loc[i, j]) > 0.7]
+            
+            for i, j, corr in high_corrs:
+                corr_type = "positive" if corr > 0 else "negative"
+                insights.append(f"There is a strong {corr_type} correlation ({corr:.2f}) between {i} and {j}")
+        
+        # Add general data summary
+        insights.append(f"The dataset contains {df.shape[0]} records with {df.shape[1]} fields.")
+        
+    except Exception as e:
+        insights.append(f"Error generating insights: {str(e)}")
+    
+    return insights[:5]  # Limit to top 5 insights
+
+
+def _readable(column):
+    return str(column).replace("_", " ").lower()
+
+
+def _number(value):
+    if pd.isna(value):
+        return "null"
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def _result(analysis, chart_type="none", x_axis=None, y_axis=None, title=None):
+    recommended = chart_type != "none"
+    return {
+        "analysis": analysis,
+        "visualization_recommended": recommended,
+        "visualization_type": chart_type,
+        "visualization_config": {"x_axis": x_axis, "y_axis": y_axis, "title": title} if recommended else {},
+        "analysis_tier": "local",
+    }
+
+
+def _category_metric(df, category, measure, query):
+    values = df.set_index(category)[measure]
+    total = values.sum()
+    top, bottom = values.idxmax(), values.idxmin()
+    share = f" ({values[top] / total:.1%} of the total)" if total else ""
+    analysis = (
+        f"Across {len(values)} {_readable(category)} values the total {_readable(measure)} is {_number(total)} "
+        f"and the average is {_number(values.mean())}. {top} has the highest {_readable(measure)} with "
+        f"{_number(values[top])}{share}, while {bottom} has the lowest with {_number(values[bottom])}."
+    )
+    outliers = [insight for insight in generate_insights(df, query, "") if "outliers" in insight]
+    if outliers:
+        analysis += " " + outliers[0] + "."
+    chart_type = "pie" if detect_chart_type(df, query) == "pie" and len(values) <= MAX_PIE_SLICES else "bar"
+    return _result(analysis, chart_type, category, measure, f"{measure} by {category}")
+
+
+def _time_series(df, date_col, dates, measures):
+    sentences = []
+    ordered = df.assign(_date=dates).sort_values("_date")
+    for measure in measures:
+        series = ordered.set_index("_date")[measure].dropna()
+        if series.empty:
+            continue
+        first, last = series.iloc[0], series.iloc[-1]
+        change = f", a change of {(last - first) / abs(first):+.1%}" if first else ""
+        sentences.append(
+            f"{_readable(measure).capitalize()} went from {_number(first)} on {series.index[0]:%Y-%m-%d} "
+            f"to {_number(last)} on {series.index[-1]:%Y-%m-%d}{change}. It peaked at {_number(series.max())} "
+            f"on {series.idxmax():%Y-%m-%d} and was lowest at {_number(series.min())} on {series.idxmin():%Y-%m-%d}."
+        )
+    title = f"{', '.join(measures)} over {date_col}"
+    return _result(" ".join(sentences), "line", date_col, measures[0], title)
+
+
+def quick_analysis(df: pd.DataFrame, query: str) -> Optional[Dict[str, Any]]:
+    """
+    Analyze clearly shaped results without an LLM call.
+
+    Args:
+        df: The query result
+        query: The user's question
+
+    Returns:
+        Dict in the same shape as the LLM analysis (analysis, visualization_recommended,
+        visualization_type, visualization_config), or None when the result is ambiguous
+        and needs the LLM.
+    """
+    start = time.perf_counter()
+    analysis = _quick_analysis(df, query)
+    metrics.increment("analysis_requests_total")
+    if analysis is not None:
+        metrics.increment("analysis_local_total")
+        metrics.observe("analysis_local_seconds", time.perf_counter() - start)
+    metrics.set_gauge(
+        "analysis_local_share",
+        metrics.get_counter("analysis_local_total") / metrics.get_counter("analysis_requests_total"),
+    )
+    return analysis
+
+
+def _quick_analysis(df, query):
+    rows, cols = df.shape
+    if rows == 0:
+        return _result("The query returned no rows, so there is nothing to analyze.")
+    if rows == 1 and cols == 1:
+        column = df.columns[0]
+        value = df.iloc[0, 0]
+        shown = _number(value) if pd.api.types.is_number(value) else value
+        return _result(f"The {_readable(column)} is {shown}.")
+    if rows == 1:
+        row = df.iloc[0]
+        parts = [f"{_readable(c)}: {_number(v) if pd.api.types.is_number(v) else v}" for c, v in row.items()]
+        return _result("The result is a single record with " + "; ".join(parts) + ".")
+
+    dates = date_columns(df)
+    numeric, categorical = split_columns(df, dates)
+
+    # One category against one metric, one row per category
+    if (len(categorical) == 1 and len(numeric) == 1 and not dates
+            and rows <= MAX_LOCAL_CATEGORIES and df[categorical[0]].is_unique):
+        return _category_metric(df, categorical[0], numeric[0], query)
+
+    # A time series: one date column with one row per date and up to three metrics
+    if len(dates) == 1 and not categorical and 1 <= len(numeric) <= 3:
+        date_col, parsed = next(iter(dates.items()))
+        if parsed.is_unique:
+            return _time_series(df, date_col, parsed, numeric)
+
+    return None
@@ -1,19 +1,34 @@
+import os
+import logging
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import io
 import base64
 import json
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.chat_models import BedrockChat
+from src.render_pool import render_png
+from src.chart_specs import build_spec
+from src.result_cache import chart_cache
+from src.code_sandbox import SandboxError, run_snippet, snippet_cache, snippet_key
+from src import admission, cancellation, single_flight, tracing
+from src.llm import chat_model
 
-def render_graph(parsed_raw_data, visualization_info):
+# 'spec' returns a Vega-Lite spec drawn by the browser, 'png' rasterizes on the server
+CHART_OUTPUT = os.environ.get("CHART_OUTPUT", "spec")
+
+logger = logging.getLogger(__name__)
+
+def render_graph(parsed_raw_data, visualization_info, output=None):
     """
-    Generate a matplotlib/pandas visualization based on the data and visualization info.
-    Returns a base64 encoded image that can be directly embedded in HTML/frontend.
+    Generate a visualization based on the data and visualization info.
+
+    By default returns a Vega-Lite spec (`{"spec": ..., "image_type": "vega-lite"}`) that the
+    frontend renders over the result rows it already received. With output='png' returns a
+    base64 encoded image that can be directly embedded in HTML/frontend instead.
+
+    Expects the full query result; PNG charts are drawn by `chart_drawing.draw_chart` on the
+    render pool, which downsamples the data per chart type before plotting.
     """
+    output = output or CHART_OUTPUT
+    # Nobody is waiting for the chart of a cancelled request
+    cancellation.check()
     # If we have actual DataFrame data (not just metadata)
     if isinstance(parsed_raw_data, pd.DataFrame):
         df = parsed_raw_data
@@ -26,95 +41,45 @@ def render_graph(parsed_raw_data, visualization_info):
                 # Handle case where we only have dictionary data
                 df = pd.DataFrame(parsed_raw_data)
         except Exception as e:
-            print(f"Error converting data to DataFrame: {e}")
+            logger.warning("Error converting data to DataFrame: %s", e)
             return {"image": None, "error": "Could not convert data to DataFrame"}
     
+    # Identical results drawn with the same configuration reuse the earlier chart
+    with tracing.span("render", output=output, chart=visualization_info.get('visualization_type'), rows=len(df)):
+        cache_key = chart_cache.key(df, visualization_info, output)
+        graph = chart_cache.get(cache_key)
+        tracing.annotate(cached=graph is not None)
+        if graph is None:
+            # The same chart requested while it is being drawn waits for that drawing
+            graph = single_flight.renders.do(cache_key, _draw, cache_key, df, visualization_info, output)
+        tracing.annotate(image_type=graph.get("image_type"))
+        return graph
+
+
+def _draw(cache_key, df, visualization_info, output):
+    graph = _render_graph(df, visualization_info, output)
+    if not graph.get("error"):
+        chart_cache.put(cache_key, graph)
+    return graph
+
+
+def _render_graph(df, visualization_info, output):
     try:
-        # Extract visualization parameters
-        viz_type = visualization_info.get('visualization_type', 'bar')
-        viz_config = visualization_info.get('visualization_config', {})
-        
-        x_column = viz_config.get('x_axis')
-        y_column = viz_config.get('y_axis')
+        viz_config = visualization_info.get('visualization_config', {}) or {}
         title = viz_config.get('title', 'Data Visualization')
         
-        # Create figure and axis objects
-        fig, ax = plt.subplots(figsize=(10, 6))
-        
-        # Generate the appropriate plot based on visualization type
-        if viz_type == 'bar':
-            if x_column and y_column:
-                df.plot(kind='bar', x=x_column, y=y_column, ax=ax)
-            else:
-                # Fall back to simple bar chart of first two columns
-                df.iloc[:, :2].plot(kind='bar', ax=ax)
-                
-        elif viz_type == 'line':
-            if x_column and y_column:
-                df.plot(kind='line', x=x_column, y=y_column, ax=ax)
-            else:
-                df.iloc[:, :2].plot(kind='line', ax=ax)
-                
-        elif viz_type == 'scatter':
-            if x_column and y_column:
-                df.plot(kind='scatter', x=x_column, y=y_column, ax=ax)
-            else:
-                # Try to find two numeric columns
-                numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-                if len(numeric_cols) >= 2:
-                    df.plot(kind='scatter', x=numeric_cols[0], y=numeric_cols[1], ax=ax)
-                else:
-                    df.iloc[:, :2].plot(kind='scatter', ax=ax)
-                    
-        elif viz_type == 'pie':
-            if x_column and y_column:
-                df.plot(kind='pie', y=y_column, labels=df[x_column], ax=ax)
-            else:
-                # Use the first column as labels and second as values
-                df.iloc[:, 1].plot(kind='pie', labels=df.iloc[:, 0], ax=ax)
-                
-        elif viz_type == 'heatmap':
-            # For heatmap we need matrix-like data
-            pivot_columns = viz_config.get('pivot_columns', [])
-            if len(pivot_columns) >= 3:  # We need row, col, and value columns
-                pivot_df = df.pivot(
-                    index=pivot_columns[0],
-                    columns=pivot_columns[1], 
-                    values=pivot_columns[2]
-                )
-                sns.heatmap(pivot_df, annot=True, ax=ax)
-            else:
-                # Try correlation matrix as fallback for heatmap
-                numeric_df = df.select_dtypes(include=['number'])
-                if not numeric_df.empty:
-                    sns.heatmap(numeric_df.corr(), annot=True, ax=ax)
-                else:
-                    df.iloc[:, :5].plot(kind='bar', ax=ax)  # Fallback
-        
-        else:  # Default plot if type not recognized
-            df.plot(kind='bar', ax=ax)
-        
-        # Add title and labels using the axis object
-        ax.set_title(title)
-        if x_column:
-            ax.set_xlabel(x_column)
-        if y_column:
-            ax.set_ylabel(y_column)
-            
-        # Rotate x-axis labels if there are many categories
-        ax.tick_params(axis='x', rotation=45)
+        if output == "spec":
+            try:
+                return {"spec": build_spec(df, visualization_info), "image_type": "vega-lite"}
+            except Exception as e:
+                logger.warning("Error building chart spec, rendering a PNG instead: %s", e)
         
-        # Tight layout to ensure all elements are visible
-        fig.tight_layout()
-        
-        # Save plot to a bytes buffer
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png')
-        buf.seek(0)
+        # Drawn in a separate rendering process with the object-oriented matplotlib API
+        with admission.stage("render"):
+            png = render_png(df, visualization_info)
         
         # Convert to base64 encoded string for HTML embedding
-        img_str = base64.b64encode(buf.read()).decode('utf-8')
-        plt.close(fig)  # Close plot to free memory
+        img_str = base64.b64encode(png).decode('utf-8')
         
         # Return base64 encoded image ready for HTML embedding
         return {
@@ -123,8 +88,10 @@ def render_graph(parsed_raw_data, visualization_info):
             "html_tag": f'<img src="data:image/png;base64,{img_str}" alt="{title}" />'
         }
         
+    except (admission.Overloaded, cancellation.Cancelled):
+        raise
     except Exception as e:
-        print(f"Error generating visualization: {e}")
+        logger.warning("Error generating visualization, asking the LLM for plotting code: %s", e)
         # If we encounter an error during visualization, try an AI-assisted approach
         return generate_fallback_visualization(df, visualization_info)
 
@@ -133,7 +100,24 @@ def generate_fallback_visualization(df, visualization_info):
     """
     Fallback method that uses LLM to generate matplotlib code for visualization
     when the automatic methods fail.
+
+    The code runs in a resource-limited sandbox process. Code that worked is cached by
+    the result schema and visualization type and tried first for later results of the
+    same shape, before asking the LLM again.
     """
+    cache_key = snippet_key(df, visualization_info.get('visualization_type'))
+    cached_code = snippet_cache.get(cache_key)
+    if cached_code:
+        try:
+            return _snippet_image(cached_code, df)
+        except SandboxError as e:
+            logger.info("Cached visualization code failed, asking the LLM again: %s", e)
+    
+    # LangChain is imported the first time a fallback chart needs the LLM
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+
     prompt_template = """You are a data visualization expert. Given this dataset:
     
     Column names: {column_names}
@@ -162,15 +146,7 @@ def generate_fallback_visualization(df, visualization_info):
         )
     ]
     
-    llm = BedrockChat(
-        model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",  
-        model_kwargs={
-            "temperature": 0.4,
-            "max_tokens": 2000,  
-            "top_p": 0.7,
-        },
-        region_name="us-east-1"
-    )
+    llm = chat_model()
     
     try:
         # Prepare sample data for the prompt
@@ -194,51 +170,43 @@ def generate_fallback_visualization(df, visualization_info):
         
         # Create and run the chain
         analysis_chain = LLMChain(llm=llm, prompt=analysis_prompt)
-        response = analysis_chain.run(
-            column_names=json.dumps(column_names),
-            data_types=json.dumps(data_types),
-            sample_data=json.dumps(sample_data),
-            visualization_info=viz_info_str
-        )
+        with tracing.span("llm.chart_code"), admission.stage("llm"):
+            response = analysis_chain.run(
+                column_names=json.dumps(column_names),
+                data_types=json.dumps(data_types),
+                sample_data=json.dumps(sample_data),
+                visualization_info=viz_info_str,
+                callbacks=cancellation.llm_callbacks()
+            )
         
         # Parse the response to get the code
         parsed_response = parser.parse(response)
         code = parsed_response.get("visualization_code", "")
         
         if code:
-            # Execute the generated code in a controlled environment
-            local_vars = {"df": df, "plt": plt, "sns": sns, "pd": pd}
-            
-            # Add fig and ax variables to the local environment
-            fig, ax = plt.subplots(figsize=(10, 6))
-            local_vars["fig"] = fig
-            local_vars["ax"] = ax
-            
-            exec(code, globals(), local_vars)
-            
-            # Make sure we use the figure from local_vars in case it was modified
-            fig = local_vars.get("fig", fig)
-            
-            # Save the resulting plot to a bytes buffer
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png')
-            buf.seek(0)
-            
-            # Convert to base64 encoded string
-            img_str = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close(fig)
-            
-            return {
-                "image": img_str,
-                "image_type": "png",
-                "html_tag": f'<img src="data:image/png;base64,{img_str}" alt="AI Generated Visualization" />'
-            }
+            # Executed in a separate process with CPU, memory and wall-clock limits
+            graph = _snippet_image(code, df)
+            snippet_cache.put(cache_key, code)
+            return graph
         
+    except (admission.Overloaded, cancellation.Cancelled):
+        raise
     except Exception as e:
-        print(f"Error in AI-assisted visualization generation: {e}")
+        logger.warning("AI-assisted visualization failed: %s", e)
     
     # If all else fails, return a simple text message
     return {
         "image": None,
         "error": "Failed to generate visualization"
-    }
\ No newline at end of file
+    }
+
+
+def _snippet_image(code, df):
+    with tracing.span("render.sandbox"), admission.stage("render"):
+        png = run_snippet(code, df)
+    img_str = base64.b64encode(png).decode('utf-8')
+    return {
+        "image": img_str,
+        "image_type": "png",
+        "html_tag": f'<img src="data:image/png;base64,{img_str}" alt="AI Generated Visualization" />'
+    }
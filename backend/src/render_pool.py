@@ -0,0 +1,155 @@
+"""
+Out-of-process chart rendering.
+
+A fixed set of worker processes is started once; each imports matplotlib
+(Agg backend) and seaborn at startup, then draws charts sent to it over a pipe
+and sends the PNG bytes back. Chart rendering is CPU-heavy, so running it in
+separate processes lets concurrent requests scale across cores instead of
+contending for the GIL in the request worker. A job that runs past its timeout
+gets its worker process killed and replaced; the other workers keep serving.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+RENDER_POOL_WORKERS = int(os.environ.get("RENDER_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_TIMEOUT_SECONDS = float(os.environ.get("RENDER_TIMEOUT_SECONDS", "20"))
+RENDER_START_METHOD = os.environ.get(
+    "RENDER_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+
+
+class RenderError(Exception):
+    """Raised when a worker fails to draw a chart."""
+
+
+class RenderTimeout(RenderError):
+    """Raised when a chart takes longer than its timeout; the worker that drew it is replaced."""
+
+
+def _worker_main(conn):
+    # Heavy imports happen once per worker, before the first job arrives
+    from src.chart_drawing import draw_chart
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        df, visualization_info = job
+        try:
+            conn.send(("ok", draw_chart(df, visualization_info)))
+        except Exception as e:
+            conn.send(("error", f"{e}\n{traceback.format_exc()}"))
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class RenderPool:
+    """Pool of pre-started rendering processes, each handling one chart at a time."""
+
+    def __init__(self, size=RENDER_POOL_WORKERS):
+        self._ctx = multiprocessing.get_context(RENDER_START_METHOD)
+        self._idle = queue.Queue()
+        self._workers = []
+        for _ in range(size):
+            worker = _Worker(self._ctx)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def _replace(self, worker):
+        worker.kill()
+        fresh = _Worker(self._ctx)
+        self._workers[self._workers.index(worker)] = fresh
+        return fresh
+
+    def render(self, df, visualization_info, timeout=None):
+        """
+        Draw a chart on the next free worker.
+
+        Returns:
+            bytes: The PNG image
+        """
+        timeout = timeout or RENDER_TIMEOUT_SECONDS
+        worker = self._idle.get()
+        try:
+            worker.conn.send((df, visualization_info))
+            if not worker.conn.poll(timeout):
+                worker = self._replace(worker)
+                raise RenderTimeout(f"Chart rendering exceeded {timeout:g}s and was cancelled.")
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died (e.g. out of memory), start a new one in its place
+            worker = self._replace(worker)
+            raise RenderError(f"Render worker crashed: {e}")
+        finally:
+            self._idle.put(worker)
+        if status != "ok":
+            raise RenderError(payload)
+        return payload
+
+    def close(self):
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.kill()
+
+
+def chart_columns(df, visualization_info):
+    """Columns a chart reads, so only those need to be shipped to a render worker."""
+    viz_config = visualization_info.get('visualization_config', {}) or {}
+    wanted = []
+    # An axis can name several columns, as in a multi-series line
+    for axis in (viz_config.get('x_axis'), viz_config.get('y_axis')):
+        wanted += axis if isinstance(axis, list) else [axis]
+    wanted += list(viz_config.get('pivot_columns', []))
+    wanted = list(dict.fromkeys(col for col in wanted if isinstance(col, str) and col in df.columns))
+    # Fallback plots pick columns themselves and need the whole frame
+    return wanted if len(wanted) >= 2 else list(df.columns)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """The process-wide render pool, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+        return _pool
+
+
+def render_png(df, visualization_info, timeout=None):
+    """Render a chart on the pool, shipping only the columns the chart reads."""
+    columns = chart_columns(df, visualization_info)
+    return get_render_pool().render(df[columns], visualization_info, timeout)
+
+
+def shutdown_render_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
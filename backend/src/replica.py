@@ -0,0 +1,275 @@
+"""
+Optional local read replica of the warehouse tables.
+
+The tables of the semantic model (FEATURES, SALES, STORES) are small enough
+to copy. With REPLICA_ENABLED=1 a background thread snapshots them from
+Snowflake into Parquet every REPLICA_REFRESH_SECONDS. `query()` then answers
+warehouse queries locally:
+
+1. the generated Snowflake SQL is transpiled to DuckDB with sqlglot;
+2. it runs on the query pool (see src/query_pool.py) over the snapshot's
+   Parquet files.
+
+The query goes to Snowflake as before in any of these cases:
+
+- the replica is older than REPLICA_MAX_STALENESS_SECONDS, or has not been
+  taken yet;
+- the SQL does not transpile, or reads a table that is not replicated;
+- the local run fails, or its result hits the query pool's row cap.
+
+A new snapshot is written next to the current one and swapped in atomically.
+The snapshot before it is kept until the next swap, so queries in flight
+keep their files. Each worker keeps its own replica.
+
+`/metrics` reports the replica's age, the routed and fallback counts (with
+the fallback reasons), the routed ratio, and the refresh times. `/replica`
+gives the same as one status document.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from src import admission, cancellation, metrics, query_pool, tracing
+
+REPLICA_ENABLED = os.environ.get("REPLICA_ENABLED", "0") == "1"
+REPLICA_DIR = os.environ.get("REPLICA_DIR", os.path.join(tempfile.gettempdir(), "phaser_replica"))
+REPLICA_REFRESH_SECONDS = float(os.environ.get("REPLICA_REFRESH_SECONDS", "900"))
+REPLICA_MAX_STALENESS_SECONDS = float(os.environ.get("REPLICA_MAX_STALENESS_SECONDS", "3600"))
+# Comma-separated; the semantic model's tables by default
+REPLICA_TABLES = [name.strip().upper() for name in os.environ.get("REPLICA_TABLES", "").split(",") if name.strip()]
+
+logger = logging.getLogger(__name__)
+
+
+class TranspileError(ValueError):
+    """Raised for Snowflake SQL the replica cannot run."""
+
+
+class Snapshot:
+    """One copy of the replicated tables; treat as immutable."""
+
+    def __init__(self, snapshot_id, directory, tables, rows, taken_at):
+        self.snapshot_id = snapshot_id
+        self.directory = directory
+        # Table name -> Parquet dataset directory, as register_tables takes it
+        self.tables = tables
+        self.rows = rows
+        # When the copy started: data can be no older than this
+        self.taken_at = taken_at
+
+    def age(self):
+        return time.time() - self.taken_at
+
+
+def transpile(sql, tables):
+    """
+    Snowflake SQL as DuckDB SQL over the replicated tables.
+
+    Raises:
+        TranspileError: For anything but a single query, a table that is not replicated, or
+            syntax sqlglot cannot translate
+    """
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ErrorLevel, SqlglotError
+    from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="snowflake") if s is not None]
+        if len(statements) != 1 or not isinstance(statements[0], exp.Query):
+            raise TranspileError("Only a single SELECT query can run on the replica")
+        # Unquoted names are upper case in Snowflake, and so are its result columns
+        tree = normalize_identifiers(statements[0], dialect="snowflake")
+        ctes = {cte.alias_or_name.upper() for cte in tree.find_all(exp.CTE)}
+        for table in tree.find_all(exp.Table):
+            name = table.name.upper()
+            if name in ctes:
+                continue
+            if name not in tables:
+                raise TranspileError(f"Table {table.sql(dialect='snowflake')} is not replicated")
+            # PET_PROD_DB.HACKBOT_DEMO_SCHEMA.SALES -> "SALES"
+            table.set("catalog", None)
+            table.set("db", None)
+            table.set("this", exp.to_identifier(name, quoted=True))
+        return tree.sql(dialect="duckdb", unsupported_level=ErrorLevel.RAISE)
+    except SqlglotError as e:
+        raise TranspileError(str(e)) from e
+
+
+_lock = threading.Lock()
+_snapshot = None
+# Kept one refresh longer for queries still reading it
+_retired = None
+_stop = threading.Event()
+_thread = None
+# Per process, so workers never delete each other's files
+_process_dir = os.path.join(REPLICA_DIR, uuid.uuid4().hex)
+
+
+def current():
+    """The snapshot queries are answered from, or None before the first one is taken."""
+    return _snapshot
+
+
+def _tables():
+    if REPLICA_TABLES:
+        return REPLICA_TABLES
+    from src import semantic_model
+
+    return [name.upper() for name in semantic_model.current().tables]
+
+
+def _fetch(conn, table, directory):
+    """Copy one table into `directory`/part-0.parquet; returns its row count."""
+    import pyarrow.parquet as pq
+
+    from src.call_snowflake import fetch_arrow
+
+    data = fetch_arrow(conn, f'SELECT * FROM "{table}"')
+    os.makedirs(directory, exist_ok=True)
+    pq.write_table(data, os.path.join(directory, "part-0.parquet"), compression="zstd")
+    return data.num_rows
+
+
+def refresh():
+    """Take a new snapshot of the replicated tables and swap it in."""
+    global _snapshot, _retired
+    # The Snowflake connector and boto3 are imported on the first refresh
+    from src.connection import get_secret, get_snowflake_connection
+
+    snapshot_id = uuid.uuid4().hex[:12]
+    directory = os.path.join(_process_dir, snapshot_id)
+    taken_at = time.time()
+    started = time.perf_counter()
+    tables, rows = {}, {}
+    try:
+        with admission.stage("warehouse"):
+            conn = get_snowflake_connection(get_secret())
+            try:
+                for table in _tables():
+                    tables[table] = os.path.join(directory, table)
+                    rows[table] = _fetch(conn, table, tables[table])
+            finally:
+                conn.close()
+    except Exception:
+        metrics.increment("replica_refresh_errors_total")
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    snapshot = Snapshot(snapshot_id, directory, tables, rows, taken_at)
+    with _lock:
+        stale, _retired, _snapshot = _retired, _snapshot, snapshot
+    if stale is not None:
+        shutil.rmtree(stale.directory, ignore_errors=True)
+    seconds = time.perf_counter() - started
+    metrics.increment("replica_refreshes_total")
+    metrics.observe("replica_refresh_seconds", seconds)
+    metrics.set_gauge("replica_rows", sum(rows.values()))
+    metrics.set_gauge("replica_age_seconds", round(snapshot.age(), 3))
+    logger.info("Replica snapshot %s taken in %.1fs: %s", snapshot_id, seconds, rows)
+    return snapshot
+
+
+def _refresh_loop():
+    while not _stop.is_set():
+        try:
+            refresh()
+        except Exception as e:
+            # Queries keep using the last snapshot until it is too stale, then go to Snowflake
+            logger.warning("Replica refresh failed: %s", e)
+        _stop.wait(REPLICA_REFRESH_SECONDS)
+
+
+def start():
+    """Start refreshing the replica in the background, if REPLICA_ENABLED."""
+    global _thread
+    if not REPLICA_ENABLED or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_refresh_loop, name="replica-refresh", daemon=True)
+    _thread.start()
+
+
+def stop():
+    """Stop refreshing and delete this worker's snapshots."""
+    global _thread, _snapshot, _retired
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+        _thread = None
+    with _lock:
+        _snapshot = _retired = None
+    shutil.rmtree(_process_dir, ignore_errors=True)
+
+
+def _report():
+    routed = metrics.get_counter("replica_routed_total")
+    total = routed + metrics.get_counter("replica_fallback_total")
+    if total:
+        metrics.set_gauge("replica_routed_ratio", routed / total)
+
+
+def _fallback(reason):
+    metrics.increment("replica_fallback_total")
+    metrics.increment(f"replica_fallback_{reason}_total")
+    tracing.annotate(replica=f"fallback:{reason}")
+    _report()
+    return None
+
+
+def query(sql):
+    """
+    The result of a warehouse query, answered from the replica.
+
+    Returns:
+        pd.DataFrame: The result, or None when the query has to go to Snowflake
+    """
+    if not REPLICA_ENABLED:
+        return None
+    snapshot = _snapshot
+    if snapshot is None:
+        return _fallback("missing")
+    age = snapshot.age()
+    metrics.set_gauge("replica_age_seconds", round(age, 3))
+    if age > REPLICA_MAX_STALENESS_SECONDS:
+        return _fallback("stale")
+    try:
+        local_sql = transpile(sql, snapshot.tables)
+    except TranspileError as e:
+        logger.info("Not running on the replica: %s", e)
+        return _fallback("transpile")
+    with tracing.span("replica.query", snapshot=snapshot.snapshot_id, age_seconds=round(age, 1), sql=local_sql):
+        try:
+            result = query_pool.run_query(local_sql, snapshot.tables)
+        except cancellation.Cancelled:
+            raise
+        except Exception as e:
+            logger.info("Replica query failed, running it on Snowflake: %s", e)
+            return _fallback("error")
+    if result.attrs.get("truncated"):
+        return _fallback("truncated")
+    metrics.increment("replica_routed_total")
+    tracing.annotate(replica=snapshot.snapshot_id)
+    _report()
+    return result
+
+
+def status():
+    """The replica's state for `/replica`."""
+    snapshot = _snapshot
+    routed = metrics.get_counter("replica_routed_total")
+    fallback = metrics.get_counter("replica_fallback_total")
+    return {
+        "enabled": REPLICA_ENABLED,
+        "snapshot_id": snapshot.snapshot_id if snapshot else None,
+        "taken_at": snapshot.taken_at if snapshot else None,
+        "age_seconds": round(snapshot.age(), 3) if snapshot else None,
+        "max_staleness_seconds": REPLICA_MAX_STALENESS_SECONDS,
+        "rows": dict(snapshot.rows) if snapshot else {},
+        "routed": routed,
+        "fallback": fallback,
+        "routed_ratio": routed / (routed + fallback) if routed + fallback else None,
+    }
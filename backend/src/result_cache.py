@@ -0,0 +1,111 @@
+"""
+Caches for analyses and charts, keyed by a fingerprint of the query result.
+
+The same SQL over the same data (a dashboard reloaded, a question asked
+twice) yields the same result, so its analysis and chart can be reused
+instead of calling the LLM and drawing again. Results are identified by a
+content hash of their column buffers, combined with the question or chart
+configuration. Each cache evicts least-recently-used entries beyond its byte
+budget or entry limit and expires entries after a TTL.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from src import metrics
+
+CACHE_TTL_SECONDS = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", "3600"))
+CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024
+CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "1024"))
+
+
+def fingerprint(df):
+    """
+    Content hash of a DataFrame: column names, dtypes and values.
+
+    Numeric and datetime columns are hashed straight from their NumPy buffers;
+    other columns go through pandas' vectorized per-value hashing.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(df.shape).encode())
+    for col in df.columns:
+        series = df[col]
+        digest.update(f"{col}\0{series.dtype}\0".encode())
+        values = series.to_numpy()
+        if values.dtype.kind in "biufcmM":
+            digest.update(values.tobytes())
+        else:
+            digest.update(pd.util.hash_pandas_object(series, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _size(value):
+    # Cached values are JSON-like dicts (analysis text, chart specs, base64 images)
+    return len(json.dumps(value, default=str))
+
+
+class ResultCache:
+    """Thread-safe LRU cache with a TTL, an entry limit and a byte budget."""
+
+    def __init__(self, name, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, df, *parts):
+        """Cache key for a result plus anything else the cached value depends on."""
+        extra = json.dumps(parts, sort_keys=True, default=str)
+        return fingerprint(df) + hashlib.blake2b(extra.encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                metrics.increment(f"cache_{self.name}_expired_total")
+                entry = None
+            if entry is None:
+                metrics.increment(f"cache_{self.name}_misses_total")
+                return None
+            self._entries.move_to_end(key)
+        metrics.increment(f"cache_{self.name}_hits_total")
+        # Callers may add to the dict they get back
+        return copy.deepcopy(entry[2])
+
+    def put(self, key, value):
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                metrics.increment(f"cache_{self.name}_evictions_total")
+            metrics.set_gauge(f"cache_{self.name}_bytes", self._bytes)
+            metrics.set_gauge(f"cache_{self.name}_entries", len(self._entries))
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+analysis_cache = ResultCache("analysis")
+chart_cache = ResultCache("chart")
@@ -0,0 +1,222 @@
+"""
+Compact statistical digest of a query result, used as the LLM analysis input.
+
+Instead of sending raw rows, the digest summarizes the full result with
+vectorized pandas/NumPy: per-column statistics, group totals, trends over date
+columns, top/bottom rows and outliers. Sections are added in priority order
+until the token budget is used up, so the prompt size stays flat however many
+rows the query returned.
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+DIGEST_TOKEN_BUDGET = int(os.environ.get("DIGEST_TOKEN_BUDGET", "1200"))
+
+# Results this small are included verbatim, they are cheaper than their statistics
+SMALL_RESULT_ROWS = 20
+
+TOP_K = 5
+MAX_GROUPS = 50
+MAX_CATEGORIES_SHOWN = 5
+
+# Integer columns named like identifiers are dimensions, not measures
+_ID_PATTERN = re.compile(r"(^|_)(id|key|code|no|number|store|dept)$", re.IGNORECASE)
+
+# Rough chars-per-token ratio of the model's tokenizer for English and numbers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _fmt(value):
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return "null"
+        return f"{value:.4g}"
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d") if value == value.normalize() else value.isoformat()
+    return str(value)
+
+
+def date_columns(df):
+    """Datetime columns plus text columns whose name says date/time and that parse as dates."""
+    dates = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            dates[col] = series
+        elif series.dtype == object and any(key in str(col).lower() for key in ("date", "time", "week", "month")):
+            # ISO dates first, then the day/month/year format of the retail tables
+            for options in ({"format": "ISO8601"}, {"dayfirst": True}):
+                parsed = pd.to_datetime(series, errors="coerce", **options)
+                if parsed.notna().mean() > 0.9:
+                    dates[col] = parsed
+                    break
+    return dates
+
+
+def split_columns(df, date_cols):
+    """Split the non-date columns into numeric measures and categorical dimensions."""
+    numeric = [
+        c for c in df.select_dtypes(include="number").columns
+        if c not in date_cols and not (pd.api.types.is_integer_dtype(df[c]) and _ID_PATTERN.search(str(c)))
+    ]
+    categorical = [c for c in df.columns if c not in numeric and c not in date_cols]
+    return numeric, categorical
+
+
+def _column_stats(df, numeric, categorical, dates):
+    lines = []
+    if numeric:
+        values = df[numeric]
+        stats = pd.DataFrame({
+            "nulls": values.isna().sum(),
+            "min": values.min(),
+            "median": values.median(),
+            "mean": values.mean(),
+            "max": values.max(),
+            "std": values.std(),
+            "sum": values.sum(),
+        })
+        for col, row in stats.iterrows():
+            lines.append(f"- {col} (numeric): " + ", ".join(f"{k}={_fmt(v)}" for k, v in row.items()))
+    for col, series in dates.items():
+        lines.append(f"- {col} (date): from {_fmt(series.min())} to {_fmt(series.max())}, {series.nunique()} distinct")
+    for col in categorical:
+        counts = df[col].value_counts(dropna=False)
+        top = ", ".join(f"{_fmt(k)} ({v})" for k, v in counts.head(MAX_CATEGORIES_SHOWN).items())
+        lines.append(f"- {col} (categorical): {len(counts)} distinct, most frequent: {top}")
+    return "Column statistics:\n" + "\n".join(lines) if lines else ""
+
+
+def _group_totals(df, numeric, categorical):
+    sections = []
+    for col in categorical:
+        if not 1 < df[col].nunique() <= MAX_GROUPS:
+            continue
+        totals = df.groupby(col, dropna=False)[numeric].sum()
+        share = totals[numeric[0]] / totals[numeric[0]].sum() if totals[numeric[0]].sum() else None
+        totals = totals.sort_values(numeric[0], ascending=False)
+        lines = []
+        for key, row in totals.head(TOP_K * 2).iterrows():
+            pct = f" ({share[key]:.1%} of {numeric[0]})" if share is not None else ""
+            lines.append(f"  {_fmt(key)}: " + ", ".join(f"{m}={_fmt(v)}" for m, v in row.items()) + pct)
+        if len(totals) > TOP_K * 2:
+            lines.append(f"  ... {len(totals) - TOP_K * 2} more groups")
+        sections.append(f"Totals by {col}:\n" + "\n".join(lines))
+    return "\n".join(sections)
+
+
+def _trends(df, numeric, dates):
+    lines = []
+    for date_col, parsed in dates.items():
+        frame = df[numeric].assign(_date=parsed).dropna(subset=["_date"])
+        # Aggregate first so repeated dates (one row per store/dept) do not skew the slope
+        series = frame.groupby("_date")[numeric].sum().sort_index()
+        if len(series) < 3:
+            continue
+        days = (series.index - series.index[0]).days.to_numpy(dtype=float)
+        for measure in numeric:
+            y = series[measure].to_numpy(dtype=float)
+            mask = ~np.isnan(y)
+            if mask.sum() < 3:
+                continue
+            slope = np.polyfit(days[mask], y[mask], 1)[0]
+            first, last = y[mask][0], y[mask][-1]
+            change = f", {((last - first) / abs(first)):+.1%} first to last" if first else ""
+            peak = series[measure].idxmax()
+            lines.append(
+                f"- {measure} over {date_col}: slope {_fmt(slope * 7)} per week{change}, "
+                f"peak {_fmt(series[measure].max())} on {_fmt(peak)}"
+            )
+    return "Trends:\n" + "\n".join(lines) if lines else ""
+
+
+def _top_bottom(df, numeric, categorical):
+    measure = numeric[0]
+    label_cols = categorical[:2]
+    ordered = df.dropna(subset=[measure]).sort_values(measure)
+    if len(ordered) <= TOP_K * 2:
+        return ""
+
+    def describe(rows):
+        return "; ".join(
+            ", ".join(f"{c}={_fmt(r[c])}" for c in label_cols + [measure]) for _, r in rows.iterrows()
+        )
+
+    return (
+        f"Top {TOP_K} rows by {measure}: {describe(ordered.tail(TOP_K).iloc[::-1])}\n"
+        f"Bottom {TOP_K} rows by {measure}: {describe(ordered.head(TOP_K))}"
+    )
+
+
+def _outliers(df, numeric):
+    values = df[numeric]
+    q1, q3 = values.quantile(0.25), values.quantile(0.75)
+    iqr = q3 - q1
+    mask = (values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)
+    counts = mask.sum()
+    lines = []
+    for col in numeric:
+        if counts[col]:
+            extreme = values.loc[mask[col], col]
+            most_extreme = extreme.loc[(extreme - values[col].median()).abs().idxmax()]
+            lines.append(
+                f"- {col}: {counts[col]} outliers outside [{_fmt(q1[col] - 1.5 * iqr[col])}, "
+                f"{_fmt(q3[col] + 1.5 * iqr[col])}], most extreme {_fmt(most_extreme)}"
+            )
+    return "Outliers (1.5 IQR rule):\n" + "\n".join(lines) if lines else ""
+
+
+def build_digest(df, token_budget=None):
+    """
+    Summarize a query result for the analysis prompt.
+
+    Args:
+        df (pd.DataFrame): The full query result
+        token_budget (int, optional): Approximate token limit, DIGEST_TOKEN_BUDGET by default
+
+    Returns:
+        str: The digest text
+    """
+    token_budget = token_budget or DIGEST_TOKEN_BUDGET
+    rows, cols = df.shape
+    header = f"Result: {rows} rows x {cols} columns ({', '.join(map(str, df.columns))})"
+    if rows == 0:
+        return header + "\nThe query returned no rows."
+
+    dates = date_columns(df)
+    numeric, categorical = split_columns(df, dates)
+
+    # Sections in priority order, each built only if there is budget left for it
+    builders = []
+    if rows <= SMALL_RESULT_ROWS:
+        builders.append(lambda: "Rows:\n" + df.to_csv(index=False).strip())
+    if rows > 1:
+        builders.append(lambda: _column_stats(df, numeric, categorical, dates))
+    if numeric:
+        builders.append(lambda: _trends(df, numeric, dates))
+        builders.append(lambda: _group_totals(df, numeric, categorical))
+        builders.append(lambda: _top_bottom(df, numeric, categorical))
+        builders.append(lambda: _outliers(df, numeric))
+
+    parts = [header]
+    used = estimate_tokens(header)
+    for build in builders:
+        section = build()
+        if not section:
+            continue
+        cost = estimate_tokens(section)
+        if used + cost > token_budget:
+            remaining = (token_budget - used) * CHARS_PER_TOKEN
+            if remaining > 200:
+                parts.append(section[:remaining].rsplit("\n", 1)[0] + "\n...")
+            break
+        parts.append(section)
+        used += cost
+    return "\n\n".join(parts)
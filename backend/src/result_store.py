@@ -0,0 +1,260 @@
+"""
+Server-side store of query results, served in pages and as streamed downloads.
+
+Every query result gets a result id. Clients then page, sort and filter the
+stored result (`/results/{id}`) or download it (`/results/{id}.csv`, `.arrow`,
+`.parquet`) without
+the warehouse being queried again and without the whole table travelling in
+the query response. Results are kept as DataFrames up to a memory budget;
+beyond it the least recently used ones spill to Parquet and are read back
+with DuckDB only for the rows a request needs. Results expire after a TTL.
+
+The store lives in the worker process, so a result id is only valid on the
+worker that ran the query.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import metrics
+from src.out_of_core import connect, new_dataset_dir, register_tables, remove_dataset
+
+RESULT_STORE_MEMORY_BYTES = int(os.environ.get("RESULT_STORE_MEMORY_MB", "512")) * 1024 * 1024
+RESULT_STORE_TTL_SECONDS = float(os.environ.get("RESULT_STORE_TTL_SECONDS", "3600"))
+RESULT_STORE_MAX_ENTRIES = int(os.environ.get("RESULT_STORE_MAX_ENTRIES", "1000"))
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = int(os.environ.get("RESULT_MAX_PAGE_SIZE", "10000"))
+STREAM_BATCH_ROWS = 50000
+
+# Filter operators accepted as `column:op:value`
+_FILTER_OPERATORS = {
+    "eq": "{col} = ?",
+    "ne": "{col} <> ?",
+    "lt": "{col} < ?",
+    "le": "{col} <= ?",
+    "gt": "{col} > ?",
+    "ge": "{col} >= ?",
+    "contains": "CAST({col} AS VARCHAR) ILIKE '%' || ? || '%'",
+}
+
+
+class ResultNotFound(KeyError):
+    """Raised for an unknown or expired result id."""
+
+
+class _Entry:
+    def __init__(self, df):
+        self.df = df
+        self.parquet_dir = None
+        self.columns = [str(col) for col in df.columns]
+        self.rows = len(df)
+        self.spilling = False
+        self.bytes = int(df.memory_usage(index=False, deep=True).sum())
+        self.expires_at = time.monotonic() + RESULT_STORE_TTL_SECONDS
+
+    @property
+    def source(self):
+        # What register_tables accepts: the DataFrame, or the Parquet directory once spilled
+        return self.df if self.df is not None else self.parquet_dir
+
+
+class ResultStore:
+    """Results by id, in memory up to a byte budget and spilled to Parquet beyond it."""
+
+    def __init__(self, memory_budget=RESULT_STORE_MEMORY_BYTES):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, df):
+        """Store a result and return its id."""
+        result_id = uuid.uuid4().hex
+        entry = _Entry(df)
+        to_spill = []
+        with self._lock:
+            self._entries[result_id] = entry
+            self._memory_bytes += entry.bytes
+            to_remove = self._expire()
+            # Least recently used first, the new result last
+            memory = self._memory_bytes
+            for key, other in self._entries.items():
+                if memory <= self.memory_budget:
+                    break
+                if other.df is not None and not other.spilling:
+                    other.spilling = True
+                    to_spill.append(key)
+                    memory -= other.bytes
+        for key in to_spill:
+            self._spill(key)
+        remove_dataset(*to_remove)
+        metrics.increment("result_store_puts_total")
+        self._report()
+        return result_id
+
+    def _expire(self):
+        """Drop expired entries and those over the entry limit; returns the Parquet dirs to delete."""
+        now = time.monotonic()
+        paths = []
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if entry.expires_at < now or len(self._entries) > RESULT_STORE_MAX_ENTRIES:
+                del self._entries[key]
+                if entry.df is not None:
+                    self._memory_bytes -= entry.bytes
+                paths.append(entry.parquet_dir)
+        return paths
+
+    def _spill(self, result_id):
+        with self._lock:
+            entry = self._entries.get(result_id)
+            df = entry.df if entry is not None else None
+        if df is None:
+            return
+        parquet_dir = new_dataset_dir()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, os.path.join(parquet_dir, "part-0.parquet"), compression="zstd")
+        with self._lock:
+            if self._entries.get(result_id) is not entry:
+                # Expired while it was being written
+                stale = parquet_dir
+            else:
+                entry.parquet_dir = parquet_dir
+                entry.df = None
+                self._memory_bytes -= entry.bytes
+                stale = None
+        remove_dataset(stale)
+        metrics.increment("result_store_spills_total")
+
+    def _report(self):
+        with self._lock:
+            metrics.set_gauge("result_store_entries", len(self._entries))
+            metrics.set_gauge("result_store_memory_bytes", self._memory_bytes)
+
+    def get(self, result_id):
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is None or entry.expires_at < time.monotonic():
+                raise ResultNotFound(result_id)
+            self._entries.move_to_end(result_id)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            paths = [entry.parquet_dir for entry in self._entries.values()]
+            self._entries.clear()
+            self._memory_bytes = 0
+        remove_dataset(*paths)
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _parse_filters(filters, columns):
+    """
+    Turn `column:op:value` filters into a WHERE clause with bound parameters.
+
+    Raises:
+        ValueError: On a malformed filter, an unknown column or operator
+    """
+    clauses, params = [], []
+    for spec in filters or []:
+        parts = spec.split(":", 2)
+        if len(parts) != 3:
+            raise ValueError(f"Filter '{spec}' must look like column:op:value")
+        column, op, value = parts
+        if column not in columns:
+            raise ValueError(f"Unknown column '{column}'")
+        if op not in _FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator '{op}'; choose from {', '.join(_FILTER_OPERATORS)}")
+        clauses.append(_FILTER_OPERATORS[op].format(col=_quote(column)))
+        params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _select(entry, sort=None, descending=False, filters=None):
+    where, params = _parse_filters(filters, entry.columns)
+    order = ""
+    if sort:
+        if sort not in entry.columns:
+            raise ValueError(f"Unknown sort column '{sort}'")
+        order = f" ORDER BY {_quote(sort)} {'DESC' if descending else 'ASC'} NULLS LAST"
+    return where, order, params
+
+
+def query_page(result_id, offset=0, limit=None, sort=None, descending=False, filters=None):
+    """
+    One page of a stored result, optionally sorted and filtered.
+
+    Returns:
+        tuple: (page DataFrame, number of rows matching the filters)
+    """
+    entry = store.get(result_id)
+    limit = min(max(1, limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+    where, order, params = _select(entry, sort, descending, filters)
+    conn = connect()
+    try:
+        register_tables(conn, {"result": entry.source})
+        if where:
+            total = conn.execute(f"SELECT count(*) FROM result{where}", params).fetchone()[0]
+        else:
+            total = entry.rows
+        page = conn.execute(
+            f"SELECT * FROM result{where}{order} LIMIT ? OFFSET ?", params + [limit, max(0, offset)]
+        ).df()
+    finally:
+        conn.close()
+    metrics.increment("result_store_pages_total")
+    return page, total
+
+
+def result_table(result_id, sort=None, descending=False, filters=None):
+    """A stored result, optionally sorted and filtered, as an Arrow table."""
+    entry = store.get(result_id)
+    where, order, params = _select(entry, sort, descending, filters)
+    conn = connect()
+    try:
+        register_tables(conn, {"result": entry.source})
+        return conn.execute(f"SELECT * FROM result{where}{order}", params).fetch_arrow_table()
+    finally:
+        conn.close()
+
+
+def iter_csv(result_id, sort=None, descending=False, filters=None):
+    """
+    Stream a stored result as CSV text, one batch of rows at a time.
+
+    The result id, sort and filters are validated before the first chunk is produced, so
+    errors surface before a streaming response starts.
+    """
+    entry = store.get(result_id)
+    where, order, params = _select(entry, sort, descending, filters)
+    source = entry.source
+
+    def chunks():
+        conn = connect()
+        try:
+            register_tables(conn, {"result": source})
+            reader = conn.execute(f"SELECT * FROM result{where}{order}", params).fetch_record_batch(STREAM_BATCH_ROWS)
+            header = True
+            for batch in reader:
+                yield batch.to_pandas().to_csv(index=False, header=header)
+                header = False
+            if header:
+                # No matching rows, still send the column names
+                yield ",".join(reader.schema.names) + "\n"
+        finally:
+            conn.close()
+        metrics.increment("result_store_downloads_total")
+
+    return chunks()
+
+
+store = ResultStore()
@@ -0,0 +1,587 @@
+"""
+Pre-aggregated rollups of SALES and the query rewrite that uses them.
+
+Most questions aggregate SALES by store, department, store type and week.
+With ROLLUPS_ENABLED=1 the rollups configured in ROLLUPS_PATH (rollups.yml
+next to this module by default) are kept locally. `query()` rewrites a
+generated query to read the smallest rollup that covers it and runs it on
+the query pool. The rollup has thousands of rows instead of the hundreds of
+thousands in SALES.
+
+A query is covered when it is a single SELECT over the source table, joined
+to the configured tables on the configured keys, and:
+
+- every column it filters or groups on is a dimension of the rollup;
+- every measure appears only inside SUM, COUNT, MIN, MAX or AVG;
+- it has at least one aggregate (COUNT(*) and COUNT(DISTINCT dimension)
+  count).
+
+Sampled, time-travel and pivoted tables, QUALIFY and subqueries are not
+covered. The base is left joined to the configured tables and keeps a
+<TABLE>__MATCHED flag per join, so an inner join reads only the rows it
+would have matched.
+
+Anything else goes to the replica or to Snowflake, as before.
+
+Refresh is incremental. The rollups are derived from one base aggregate at
+the grain of all their dimensions together. Each refresh asks Snowflake for
+a fingerprint of every partition of the source (HASH_AGG per DATE). Only new
+or changed partitions are re-aggregated in the warehouse and transferred.
+The base is kept in ROLLUP_DIR, so a restarted worker continues from it.
+Rollups older than ROLLUP_MAX_STALENESS_SECONDS are not used.
+
+`/metrics` reports hits and misses (with reasons), the hit ratio, the rows
+not scanned and an estimate of the warehouse time saved, taken from the
+warehouse stage's recent service time. `/rollups` gives the state of each
+rollup.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from src import admission, cancellation, metrics, query_pool, tracing
+from src.out_of_core import connect
+
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "0") == "1"
+ROLLUPS_PATH = os.environ.get(
+    "ROLLUPS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rollups.yml")
+)
+ROLLUP_DIR = os.environ.get("ROLLUP_DIR", os.path.join(tempfile.gettempdir(), "phaser_rollups"))
+ROLLUP_REFRESH_SECONDS = float(os.environ.get("ROLLUP_REFRESH_SECONDS", "900"))
+ROLLUP_MAX_STALENESS_SECONDS = float(os.environ.get("ROLLUP_MAX_STALENESS_SECONDS", "3600"))
+
+# Stored column of each kept statistic of a measure, and the function merging it
+_STATISTICS = {"SUM": "SUM", "COUNT": "SUM", "MIN": "MIN", "MAX": "MAX"}
+ROWS_COLUMN = "_ROWS"
+
+# Clauses a covered query may use; anything else (QUALIFY, LATERAL, ...) is not rewritten
+_SELECT_ARGS = {"expressions", "from_", "joins", "where", "group", "having", "order", "limit", "offset", "distinct"}
+# Table arguments besides the name and alias; sampling, time travel and pivots read other rows
+_TABLE_ARGS = {"this", "db", "catalog", "alias"}
+
+logger = logging.getLogger(__name__)
+
+
+def _stored(measure, statistic):
+    return f"{measure}__{statistic}"
+
+
+def _matched(table):
+    # Dimension flagging source rows that have a row in the joined table
+    return f"{table}__MATCHED"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class RollupConfig:
+    """The parsed rollups.yml."""
+
+    def __init__(self, document):
+        self.source = document["source"].upper()
+        self.partition_column = document["partition_column"].upper()
+        self.measures = [m.upper() for m in document.get("measures") or []]
+        # Join table -> (key columns, dimension columns taken from it)
+        self.joins = {
+            join["table"].upper(): ([c.upper() for c in join["keys"]], [c.upper() for c in join.get("columns") or []])
+            for join in document.get("joins") or []
+        }
+        self.rollups = {r["name"].upper(): [d.upper() for d in r["dimensions"]] for r in document.get("rollups") or []}
+        # Dimension -> table it is read from
+        self.dimension_tables = {}
+        for dimensions in self.rollups.values():
+            for dimension in dimensions:
+                table = next((t for t, (_, cols) in self.joins.items() if dimension in cols), self.source)
+                self.dimension_tables[dimension] = table
+        self.dimension_tables.setdefault(self.partition_column, self.source)
+        # The base keeps every dimension, so each rollup can be derived from it
+        self.base_dimensions = list(self.dimension_tables)
+        # The base is left joined; these flags let inner joins drop unmatched source rows
+        self.join_flags = [_matched(table) for table in self.joins]
+        # Changes with the configuration and with the layout of the base
+        canonical = json.dumps([document, self.base_sql()], sort_keys=True, default=str)
+        self.version = hashlib.blake2b(canonical.encode(), digest_size=8).hexdigest()
+
+    def _from(self):
+        aliases = {self.source: "s", **{table: f"j{i}" for i, table in enumerate(self.joins)}}
+        sql = f"FROM {self.source} s"
+        for table, (keys, _) in self.joins.items():
+            condition = " AND ".join(f"s.{key} = {aliases[table]}.{key}" for key in keys)
+            # Left join: queries over the source alone see all of its rows
+            sql += f" LEFT JOIN {table} {aliases[table]} ON {condition}"
+        return sql, aliases
+
+    def fingerprint_sql(self):
+        """Warehouse query: one row per partition with a hash of everything the base is built from."""
+        from_sql, aliases = self._from()
+        columns = [f"{aliases[self.dimension_tables[d]]}.{d}" for d in self.base_dimensions]
+        columns += [f"{aliases[table]}.{key}" for table, (keys, _) in self.joins.items() for key in keys]
+        columns += [f"s.{m}" for m in self.measures]
+        partition = f"s.{self.partition_column}"
+        return f"SELECT {partition} AS P, HASH_AGG({', '.join(columns)}) AS H {from_sql} GROUP BY {partition}"
+
+    def base_sql(self, partitions=None):
+        """Warehouse query aggregating the source at the base grain, for the given partitions or all."""
+        from_sql, aliases = self._from()
+        select = [f"{aliases[self.dimension_tables[d]]}.{d} AS {d}" for d in self.base_dimensions]
+        for table, (keys, _) in self.joins.items():
+            matched = " AND ".join(f"{aliases[table]}.{key} IS NOT NULL" for key in keys)
+            select.append(f"({matched}) AS {_matched(table)}")
+        grouped = len(select)
+        for measure in self.measures:
+            for statistic in _STATISTICS:
+                select.append(f"{statistic}(s.{measure}) AS {_stored(measure, statistic)}")
+        select.append(f"COUNT(*) AS {ROWS_COLUMN}")
+        sql = f"SELECT {', '.join(select)} {from_sql}"
+        if partitions is not None:
+            sql += f" WHERE s.{self.partition_column} IN ({', '.join(_literal(p) for p in partitions)})"
+        return sql + f" GROUP BY {', '.join(str(i + 1) for i in range(grouped))}"
+
+    def rollup_sql(self, name):
+        """DuckDB query deriving a rollup from the table `base`."""
+        dimensions = ", ".join(_quote(d) for d in self.rollups[name] + self.join_flags)
+        merged = [
+            f"{_STATISTICS[statistic]}({_quote(_stored(m, statistic))}) AS {_quote(_stored(m, statistic))}"
+            for m in self.measures for statistic in _STATISTICS
+        ]
+        merged.append(f"SUM({_quote(ROWS_COLUMN)}) AS {_quote(ROWS_COLUMN)}")
+        return f"SELECT {dimensions}, {', '.join(merged)} FROM base GROUP BY {dimensions}"
+
+
+class State:
+    """The base aggregate, its partition fingerprints and the rollups derived from it; treat as immutable."""
+
+    def __init__(self, base, fingerprints, tables, refreshed_at):
+        self.base = base
+        self.fingerprints = fingerprints
+        # Rollup name -> Arrow table
+        self.tables = tables
+        self.rows = {name: table.num_rows for name, table in tables.items()}
+        self.refreshed_at = refreshed_at
+
+    def age(self):
+        return time.time() - self.refreshed_at
+
+
+def load_config(path=None):
+    import yaml
+
+    with open(path or ROLLUPS_PATH, "rb") as file:
+        return RollupConfig(yaml.safe_load(file))
+
+
+def rewrite(sql, config, rows):
+    """
+    The query rewritten to read a rollup, if one covers it.
+
+    Args:
+        sql (str): Snowflake SQL
+        config (RollupConfig): The rollup configuration
+        rows (dict): Rollup name -> row count; the smallest covering rollup is chosen
+
+    Returns:
+        tuple: (rollup name, DuckDB SQL), or None if no rollup covers the query
+    """
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ErrorLevel, SqlglotError
+    from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="snowflake") if s is not None]
+    except SqlglotError:
+        return None
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        return None
+    tree = normalize_identifiers(statements[0], dialect="snowflake")
+    if any(value for arg, value in tree.args.items() if arg not in _SELECT_ARGS):
+        return None
+    if tree.find(exp.CTE) or tree.find(exp.Window) or any(s is not tree for s in tree.find_all(exp.Select)):
+        return None
+    if any(isinstance(e, exp.Star) for e in tree.expressions):
+        return None
+
+    # Tables: the source once, and configured joins on their keys
+    aliases = {}
+    for table in tree.find_all(exp.Table):
+        name = table.name.upper()
+        if name != config.source and name not in config.joins:
+            return None
+        if any(value for arg, value in table.args.items() if arg not in _TABLE_ARGS):
+            return None
+        alias = (table.alias or table.name).upper()
+        if alias in aliases:
+            return None
+        aliases[alias] = name
+    if config.source not in aliases.values():
+        return None
+    source_alias = next(alias for alias, name in aliases.items() if name == config.source)
+    first = tree.find(exp.From).this
+    # Joined tables whose unmatched source rows the query drops
+    inner = []
+    for join in tree.args.get("joins") or []:
+        table = join.this
+        if not isinstance(table, exp.Table) or join.kind not in ("", "INNER", "OUTER"):
+            return None
+        if table.name.upper() == config.source:
+            # FROM STORES JOIN SALES: only an inner join keeps the rows of SALES alone
+            table = first
+            if join.side:
+                return None
+        elif join.side not in ("", "LEFT"):
+            return None
+        keys = config.joins[table.name.upper()][0]
+        join_alias = (table.alias or table.name).upper()
+        if not join.side:
+            inner.append(table.name.upper())
+        if join.args.get("using"):
+            if sorted(i.name.upper() for i in join.args["using"]) != sorted(keys):
+                return None
+            continue
+        conditions = list(join.args["on"].flatten()) if isinstance(join.args.get("on"), exp.And) else [join.args.get("on")]
+        pairs = set()
+        for condition in conditions:
+            if not isinstance(condition, exp.EQ):
+                return None
+            left, right = condition.this, condition.expression
+            if not (isinstance(left, exp.Column) and isinstance(right, exp.Column) and left.name == right.name):
+                return None
+            pairs.add((frozenset((left.table.upper(), right.table.upper())), left.name.upper()))
+        if pairs != {(frozenset((source_alias, join_alias)), key) for key in keys}:
+            return None
+
+    def table_of(column):
+        if column.table:
+            return aliases.get(column.table.upper())
+        name = column.name.upper()
+        if name in config.measures:
+            return config.source
+        return config.dimension_tables.get(name)
+
+    def dimension(column):
+        name = column.name.upper()
+        table = table_of(column)
+        if name in config.dimension_tables and table == config.dimension_tables[name]:
+            return name
+        # A join key read from the joined table equals the source's
+        if table in config.joins and name in config.joins[table][0] and config.dimension_tables.get(name) == config.source:
+            return name
+        return None
+
+    used = set()
+    replacements = []
+    for aggregate in tree.find_all(exp.AggFunc):
+        argument = aggregate.this
+        if isinstance(aggregate, exp.Count) and isinstance(argument, exp.Star):
+            replacements.append((aggregate, f"CAST(SUM({_quote(ROWS_COLUMN)}) AS BIGINT)"))
+            continue
+        if isinstance(aggregate, exp.Count) and isinstance(argument, exp.Distinct):
+            columns = argument.expressions
+            if not columns or not all(isinstance(c, exp.Column) and dimension(c) for c in columns):
+                return None
+            used.update(dimension(c) for c in columns)
+            continue
+        if not isinstance(argument, exp.Column) or argument.name.upper() not in config.measures:
+            return None
+        if table_of(argument) != config.source:
+            return None
+        measure = argument.name.upper()
+        if isinstance(aggregate, exp.Avg):
+            replacement = (
+                f"(SUM({_quote(_stored(measure, 'SUM'))}) / NULLIF(SUM({_quote(_stored(measure, 'COUNT'))}), 0))"
+            )
+        elif isinstance(aggregate, (exp.Sum, exp.Count, exp.Min, exp.Max)):
+            statistic = type(aggregate).__name__.upper()
+            replacement = f"{_STATISTICS[statistic]}({_quote(_stored(measure, statistic))})"
+            if statistic == "COUNT":
+                # Counts stay integers, as in Snowflake
+                replacement = f"CAST({replacement} AS BIGINT)"
+        else:
+            return None
+        replacements.append((aggregate, replacement))
+    if not replacements and not used:
+        return None
+
+    # Every other column must be a dimension (or an output alias, as in ORDER BY total)
+    outputs = {e.alias.upper() for e in tree.expressions if e.alias}
+    for column in tree.find_all(exp.Column):
+        if column.find_ancestor(exp.AggFunc) or column.find_ancestor(exp.Join):
+            continue
+        name = dimension(column)
+        if name is None:
+            if column.table or column.name.upper() not in outputs:
+                return None
+            continue
+        used.add(name)
+
+    covering = [name for name, dimensions in config.rollups.items() if used <= set(dimensions) and name in rows]
+    if not covering:
+        return None
+    rollup = min(covering, key=lambda name: rows[name])
+
+    # Unnamed aggregates keep the column name Snowflake would give them
+    tree.set("expressions", [
+        exp.alias_(e, e.sql(dialect="snowflake").upper(), quoted=True, copy=False)
+        if not e.alias and e.find(exp.AggFunc) else e
+        for e in tree.expressions
+    ])
+    for aggregate, replacement in replacements:
+        aggregate.replace(sqlglot.parse_one(replacement, read="duckdb"))
+    for column in list(tree.find_all(exp.Column)):
+        column.set("table", None)
+    tree.set("joins", None)
+    tree.find(exp.From).this.replace(exp.Table(this=exp.to_identifier(rollup, quoted=True)))
+    for table in inner:
+        tree.where(exp.column(_matched(table), quoted=True), copy=False)
+    try:
+        return rollup, tree.sql(dialect="duckdb", unsupported_level=ErrorLevel.RAISE)
+    except SqlglotError:
+        return None
+
+
+_lock = threading.Lock()
+_config = None
+_state = None
+_stop = threading.Event()
+_thread = None
+
+
+def config():
+    """The rollup configuration, loaded on first use."""
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = load_config()
+    return _config
+
+
+def _base_path(cfg):
+    return os.path.join(ROLLUP_DIR, f"base-{cfg.version}.parquet")
+
+
+def _load_base(cfg):
+    # The base and fingerprints a previous refresh saved, so this one can be incremental
+    import pyarrow.parquet as pq
+
+    path = _base_path(cfg)
+    try:
+        with open(path + ".json") as file:
+            fingerprints = {key: value for key, value in json.load(file)}
+        return pq.read_table(path), fingerprints
+    except (OSError, ValueError):
+        return None, {}
+
+
+def _save_base(cfg, base, fingerprints):
+    import pyarrow.parquet as pq
+
+    os.makedirs(ROLLUP_DIR, exist_ok=True)
+    path = _base_path(cfg)
+    # Written aside and renamed, so other workers never read a partial file
+    suffix = f".{os.getpid()}.tmp"
+    pq.write_table(base, path + suffix, compression="zstd")
+    with open(path + ".json" + suffix, "w") as file:
+        json.dump([[key, value] for key, value in fingerprints.items()], file, default=str)
+    os.replace(path + suffix, path)
+    os.replace(path + ".json" + suffix, path + ".json")
+
+
+def _derive(cfg, base):
+    conn = connect()
+    try:
+        conn.register("base", base)
+        return {name: conn.sql(cfg.rollup_sql(name)).fetch_arrow_table() for name in cfg.rollups}
+    finally:
+        conn.close()
+
+
+def _merge(cfg, base, delta, replaced):
+    # The base without the replaced partitions, plus their new aggregates
+    conn = connect()
+    try:
+        conn.register("base", base)
+        conn.execute("CREATE TEMP TABLE replaced (p VARCHAR)")
+        conn.executemany("INSERT INTO replaced VALUES (?)", [[str(p)] for p in replaced])
+        partition = _quote(cfg.partition_column)
+        kept = f"SELECT * FROM base WHERE CAST({partition} AS VARCHAR) NOT IN (SELECT p FROM replaced)"
+        if delta is None:
+            return conn.sql(kept).fetch_arrow_table()
+        conn.register("delta", delta)
+        return conn.sql(f"{kept} UNION ALL BY NAME SELECT * FROM delta").fetch_arrow_table()
+    finally:
+        conn.close()
+
+
+def refresh():
+    """Bring the base up to date with the warehouse, re-aggregating changed partitions only, and rebuild the rollups."""
+    global _state
+    # The Snowflake connector and boto3 are imported on the first refresh
+    from src.call_snowflake import fetch_arrow
+    from src.connection import get_secret, get_snowflake_connection
+
+    cfg = config()
+    previous = _state
+    if previous is not None:
+        base, fingerprints = previous.base, previous.fingerprints
+    else:
+        base, fingerprints = _load_base(cfg)
+    refreshed_at = time.time()
+    started = time.perf_counter()
+    try:
+        with admission.stage("warehouse"):
+            conn = get_snowflake_connection(get_secret())
+            try:
+                remote = {row["P"]: row["H"] for row in fetch_arrow(conn, cfg.fingerprint_sql()).to_pylist()}
+                changed = [p for p, h in remote.items() if fingerprints.get(p) != h]
+                removed = [p for p in fingerprints if p not in remote]
+                # Everything on the first refresh, the changed partitions afterwards
+                full = base is None or len(changed) == len(remote)
+                delta = None
+                if changed:
+                    delta = fetch_arrow(conn, cfg.base_sql(None if full else changed))
+            finally:
+                conn.close()
+    except Exception:
+        metrics.increment("rollup_refresh_errors_total")
+        raise
+    if full:
+        base = delta
+    elif changed or removed:
+        base = _merge(cfg, base, delta, changed + removed)
+    if base is None:
+        raise RuntimeError(f"{cfg.source} is empty, no rollups to build")
+    if full or changed or removed:
+        _save_base(cfg, base, remote)
+    state = State(base, remote, _derive(cfg, base), refreshed_at)
+    _state = state
+    seconds = time.perf_counter() - started
+    metrics.increment("rollup_refreshes_total")
+    metrics.increment("rollup_partitions_refreshed_total", len(changed) + len(removed))
+    metrics.observe("rollup_refresh_seconds", seconds)
+    metrics.set_gauge("rollup_base_rows", base.num_rows)
+    metrics.set_gauge("rollup_age_seconds", 0.0)
+    logger.info(
+        "Rollups refreshed in %.1fs, %d of %d partitions changed: %s",
+        seconds, len(changed) + len(removed), len(remote), state.rows,
+    )
+    return state
+
+
+def _refresh_loop():
+    while not _stop.is_set():
+        try:
+            refresh()
+        except Exception as e:
+            # Queries keep using the last rollups until they are too stale
+            logger.warning("Rollup refresh failed: %s", e)
+        _stop.wait(ROLLUP_REFRESH_SECONDS)
+
+
+def start():
+    """Start refreshing the rollups in the background, if ROLLUPS_ENABLED."""
+    global _thread
+    if not ROLLUPS_ENABLED or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_refresh_loop, name="rollup-refresh", daemon=True)
+    _thread.start()
+
+
+def stop():
+    """Stop refreshing; the saved base stays for the next start."""
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+        _thread = None
+
+
+def _report():
+    hits = metrics.get_counter("rollup_hits_total")
+    total = hits + metrics.get_counter("rollup_misses_total")
+    if total:
+        metrics.set_gauge("rollup_hit_ratio", hits / total)
+
+
+def _miss(reason):
+    metrics.increment("rollup_misses_total")
+    metrics.increment(f"rollup_miss_{reason}_total")
+    _report()
+    return None
+
+
+def query(sql):
+    """
+    The result of a warehouse query, answered from a rollup.
+
+    Returns:
+        pd.DataFrame: The result, or None when no fresh rollup covers the query
+    """
+    if not ROLLUPS_ENABLED:
+        return None
+    state = _state
+    if state is None:
+        return _miss("missing")
+    age = state.age()
+    metrics.set_gauge("rollup_age_seconds", round(age, 3))
+    if age > ROLLUP_MAX_STALENESS_SECONDS:
+        return _miss("stale")
+    cfg = config()
+    rewritten = rewrite(sql, cfg, state.rows)
+    if rewritten is None:
+        return _miss("uncovered")
+    rollup, local_sql = rewritten
+    started = time.perf_counter()
+    with tracing.span("rollup.query", rollup=rollup, sql=local_sql):
+        try:
+            result = query_pool.run_query(local_sql, {rollup: state.tables[rollup]})
+        except cancellation.Cancelled:
+            raise
+        except Exception as e:
+            logger.info("Rollup query on %s failed, running the original: %s", rollup, e)
+            return _miss("error")
+    if result.attrs.get("truncated"):
+        return _miss("truncated")
+    seconds = time.perf_counter() - started
+    metrics.increment("rollup_hits_total")
+    metrics.increment(f"rollup_{rollup.lower()}_hits_total")
+    metrics.observe("rollup_query_seconds", seconds)
+    metrics.increment("rollup_rows_avoided_total", max(0, state.base.num_rows - state.rows[rollup]))
+    expected = admission.stages["warehouse"].expected_service_seconds()
+    if expected is not None:
+        metrics.increment("rollup_latency_saved_seconds", max(0.0, expected - seconds))
+    tracing.annotate(rollup=rollup)
+    _report()
+    return result
+
+
+def status():
+    """The rollups' state for `/rollups`."""
+    state = _state
+    hits = metrics.get_counter("rollup_hits_total")
+    misses = metrics.get_counter("rollup_misses_total")
+    return {
+        "enabled": ROLLUPS_ENABLED,
+        "refreshed_at": state.refreshed_at if state else None,
+        "age_seconds": round(state.age(), 3) if state else None,
+        "max_staleness_seconds": ROLLUP_MAX_STALENESS_SECONDS,
+        "base_rows": state.base.num_rows if state else None,
+        "partitions": len(state.fingerprints) if state else None,
+        "rows": dict(state.rows) if state else {},
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        "latency_saved_seconds": metrics.get_counter("rollup_latency_saved_seconds"),
+    }
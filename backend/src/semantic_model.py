@@ -0,0 +1,206 @@
+"""
+The semantic model: the description of the warehouse tables the LLM writes SQL against.
+
+Read from SEMANTIC_MODEL_PATH (semantic.yml next to this module by default)
+and compiled once into a `SemanticModel`. The model holds:
+
+- the schema text already rendered for each prompt style;
+- a synonym -> column index;
+- the column types;
+- the join-key graph, from the YAML `relationships`, or from column names the
+  tables share when none are given.
+
+The file is watched: `current()` checks its modification time at most every
+SEMANTIC_MODEL_CHECK_SECONDS. A changed file is compiled and swapped in
+atomically, so requests in flight keep the model they started with. A file
+that fails to compile leaves the previous model in place. Every model carries
+a `version` hash of its content, and caches whose values depend on the schema
+include it in their keys.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from src import metrics
+
+SEMANTIC_MODEL_PATH = os.environ.get(
+    "SEMANTIC_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "semantic.yml")
+)
+SEMANTIC_MODEL_CHECK_SECONDS = float(os.environ.get("SEMANTIC_MODEL_CHECK_SECONDS", "2"))
+
+# Prompt styles the schema is rendered in
+PROMPT_STYLES = ("sql", "analysis")
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticModel:
+    """A parsed and precompiled semantic model; treat as immutable."""
+
+    def __init__(self, document, version):
+        self.document = document
+        self.version = version
+        self.name = document.get("name", "")
+        # table -> column -> {"type", "kind", "comment", "synonyms"}
+        self.tables = {}
+        for table in document.get("tables") or []:
+            columns = {}
+            for kind in ("facts", "dimensions", "time_dimensions"):
+                for column in table.get(kind) or []:
+                    columns[column["name"]] = {
+                        "type": column.get("data_type", "UNKNOWN"),
+                        "kind": kind[:-1],
+                        "comment": column.get("comment", ""),
+                        "synonyms": list(column.get("synonyms") or []),
+                    }
+            self.tables[table["name"]] = columns
+        self.column_types = {
+            table: {name: column["type"] for name, column in columns.items()}
+            for table, columns in self.tables.items()
+        }
+        self.synonyms = self._synonym_index()
+        self.joins = self._join_graph(document.get("relationships") or [])
+        self._prompts = {style: self._render(style) for style in PROMPT_STYLES}
+
+    def _synonym_index(self):
+        # Lower-cased column name or synonym -> every (table, column) it may refer to
+        index = defaultdict(list)
+        for table, columns in self.tables.items():
+            for name, column in columns.items():
+                for term in [name, *column["synonyms"]]:
+                    key = str(term).lower()
+                    if (table, name) not in index[key]:
+                        index[key].append((table, name))
+        return dict(index)
+
+    def _join_graph(self, relationships):
+        # table -> other table -> [(column, other column)]
+        graph = defaultdict(dict)
+        if relationships:
+            for rel in relationships:
+                pairs = [(c["left_column"], c["right_column"]) for c in rel.get("relationship_columns") or []]
+                graph[rel["left_table"]][rel["right_table"]] = pairs
+                graph[rel["right_table"]][rel["left_table"]] = [(r, l) for l, r in pairs]
+        else:
+            names = list(self.tables)
+            for i, left in enumerate(names):
+                for right in names[i + 1:]:
+                    shared = [col for col in self.tables[left] if col in self.tables[right]]
+                    if shared:
+                        graph[left][right] = [(col, col) for col in shared]
+                        graph[right][left] = [(col, col) for col in shared]
+        return dict(graph)
+
+    def _render(self, style):
+        lines = []
+        if self.document.get("comment"):
+            lines.append(self.document["comment"])
+        for table, columns in self.tables.items():
+            lines.append(f"Table {table}:")
+            for name, column in columns.items():
+                line = f"  - {name} ({column['type']}): {column['comment']}"
+                # Synonyms help map the user's words to columns when writing SQL
+                if style == "sql" and column["synonyms"]:
+                    line += f" Synonyms: {', '.join(map(str, column['synonyms']))}."
+                lines.append(line)
+        if self.joins:
+            lines.append("Join keys:")
+            seen = set()
+            for left, others in self.joins.items():
+                for right, pairs in others.items():
+                    if (right, left) in seen:
+                        continue
+                    seen.add((left, right))
+                    condition = " AND ".join(f"{left}.{l} = {right}.{r}" for l, r in pairs)
+                    lines.append(f"  - {left} to {right}: {condition}")
+        return "\n".join(lines)
+
+    def prompt(self, style="sql"):
+        """The schema as text for a prompt: 'sql' includes synonyms, 'analysis' is more compact."""
+        return self._prompts[style]
+
+    def resolve(self, term):
+        """Columns a word may refer to, as (table, column) pairs."""
+        return list(self.synonyms.get(str(term).lower(), []))
+
+    def column_type(self, table, column):
+        return self.column_types.get(table, {}).get(column)
+
+
+def compile_model(source):
+    """Compile YAML text (bytes or str) into a SemanticModel."""
+    import yaml
+
+    document = yaml.safe_load(source) or {}
+    # Hash of the content, not the text: reformatting or comments keep the version and caches
+    canonical = json.dumps(document, sort_keys=True, default=str)
+    version = hashlib.blake2b(canonical.encode(), digest_size=8).hexdigest()
+    return SemanticModel(document, version)
+
+
+_lock = threading.Lock()
+_model = None
+_stat = None
+_checked_at = 0.0
+
+
+def _file_stat():
+    stat = os.stat(SEMANTIC_MODEL_PATH)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _reload():
+    # Called with _lock held
+    global _model, _stat
+    stat = _file_stat()
+    if _model is not None and stat == _stat:
+        return
+    with open(SEMANTIC_MODEL_PATH, "rb") as file:
+        source = file.read()
+    try:
+        model = compile_model(source)
+    except Exception as e:
+        if _model is None:
+            raise
+        metrics.increment("semantic_model_reload_errors_total")
+        logger.warning("Keeping semantic model %s, %s failed to compile: %s", _model.version, SEMANTIC_MODEL_PATH, e)
+        _stat = stat
+        return
+    _stat = stat
+    if _model is not None and model.version == _model.version:
+        return
+    if _model is not None:
+        metrics.increment("semantic_model_reloads_total")
+        logger.info("Semantic model reloaded, version %s -> %s", _model.version, model.version)
+    # A single reference assignment: readers see either the old model or the new one
+    _model = model
+    metrics.set_gauge("semantic_model_version", model.version)
+
+
+def current():
+    """
+    The current compiled semantic model, reloaded if its file changed.
+
+    Take it once per request and use that object throughout, so one request never mixes
+    two versions.
+    """
+    global _checked_at
+    model = _model
+    now = time.monotonic()
+    if model is not None and now - _checked_at < SEMANTIC_MODEL_CHECK_SECONDS:
+        return model
+    with _lock:
+        if _model is None or now - _checked_at >= SEMANTIC_MODEL_CHECK_SECONDS:
+            try:
+                _reload()
+            except OSError as e:
+                if _model is None:
+                    raise
+                # The file is being replaced or went missing, keep serving the loaded model
+                logger.warning("Cannot read semantic model %s: %s", SEMANTIC_MODEL_PATH, e)
+            _checked_at = now
+        return _model
@@ -0,0 +1,138 @@
+"""
+Single-flight coalescing of identical requests that are in flight at the same time.
+
+When a dashboard loads, many clients ask the same question within the same
+second. Without coalescing, each one makes its own LLM call, warehouse query
+and chart render. Identical work is coalesced at three stages:
+
+- question: the whole pipeline for a question (LLM, SQL, analysis), keyed
+  by the question, its conversation history and the previous result it
+  could refine;
+- sql: a warehouse query, keyed by its SQL text (rollups and the replica
+  included);
+- render: a chart, keyed like the chart cache (result content, chart
+  configuration and output format).
+
+The first request for a key does the work. Identical requests that arrive
+while it runs wait for the same future and get its result, or its error.
+Nothing is kept once the work finishes; repeats after that are for the
+caches (src/result_cache.py).
+
+A waiting request whose client disconnects stops waiting. The work is not
+cancelled for it. If the leading request is cancelled, the others do not
+fail with it: one of them starts the work again.
+
+`/metrics` counts coalesced requests in total and per stage.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from src import cancellation, metrics, tracing
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+
+def key(*parts):
+    """Key for work that depends on `parts` (JSON-serializable, anything else by its str)."""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class SingleFlight:
+    """In-flight work by key, shared by event loop callers (`run`) and worker threads (`do`)."""
+
+    def __init__(self, name, share=None):
+        self.name = name
+        # Copy of the leader's result handed to each waiting request, so they can change it
+        self.share = share or (lambda result: result)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _join(self, flight_key):
+        # (future, True) for the request that does the work, (future, False) for the ones waiting on it
+        with self._lock:
+            future = self._flights.get(flight_key)
+            if future is not None:
+                return future, False
+            future = self._flights[flight_key] = Future()
+            return future, True
+
+    def _finish(self, flight_key, future, result=None, error=None):
+        # Later requests start new work; those already waiting get this result
+        with self._lock:
+            del self._flights[flight_key]
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, (cancellation.Cancelled, asyncio.CancelledError)):
+            # Abandoned, not failed: a waiting request takes over
+            future.cancel()
+        else:
+            future.set_exception(error)
+
+    def _coalesced(self):
+        metrics.increment("coalesced_requests_total")
+        metrics.increment(f"coalesced_{self.name}_total")
+        tracing.annotate(coalesced=self.name)
+
+    def do(self, flight_key, fn, *args, **kwargs):
+        """`fn(*args, **kwargs)`, or the result of the identical call already running."""
+        if not SINGLE_FLIGHT_ENABLED:
+            return fn(*args, **kwargs)
+        token = cancellation.current()
+        while True:
+            future, leader = self._join(flight_key)
+            if leader:
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    self._finish(flight_key, future, error=e)
+                    raise
+                self._finish(flight_key, future, result)
+                return result
+            self._coalesced()
+            done = threading.Event()
+            future.add_done_callback(lambda _: done.set())
+            with token.on_cancel(done.set):
+                done.wait()
+            token.check()
+            if not future.cancelled():
+                return self.share(future.result())
+
+    async def run(self, flight_key, fn, *args, **kwargs):
+        """`await fn(*args, **kwargs)`, or the result of the identical call already running."""
+        if not SINGLE_FLIGHT_ENABLED:
+            return await fn(*args, **kwargs)
+        token = cancellation.current()
+        loop = asyncio.get_running_loop()
+        while True:
+            future, leader = self._join(flight_key)
+            if leader:
+                try:
+                    result = await fn(*args, **kwargs)
+                except BaseException as e:
+                    self._finish(flight_key, future, error=e)
+                    raise
+                self._finish(flight_key, future, result)
+                return result
+            self._coalesced()
+            # Shielded: a waiting request that goes away must not cancel the shared future
+            waiter = asyncio.shield(asyncio.wrap_future(future))
+            try:
+                with token.on_cancel(lambda: loop.call_soon_threadsafe(waiter.cancel)):
+                    result = await waiter
+            except asyncio.CancelledError:
+                token.check()
+                if not future.cancelled():
+                    raise
+                continue
+            return self.share(result)
+
+
+questions = SingleFlight("question", share=dict)
+# Shallow copies: columns added or replaced by one request are not seen by the others
+queries = SingleFlight("sql", share=lambda df: df.copy(deep=False))
+renders = SingleFlight("render", share=dict)
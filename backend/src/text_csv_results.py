@@ -6,68 +6,48 @@ pip install langchain langchain-aws boto3 pydantic
 """
 import os
 import json
-import yaml
-from langchain_aws import BedrockLLM
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.chat_models.bedrock import BedrockChat
-from langchain.chains import LLMChain
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+import logging
 from typing import Optional
 import pandas as pd
 from src.call_snowflake import get_data
 from typing import List, Dict
 from src.output_analysis import output_analyser
-from pandasql import sqldf
-from sqlalchemy import create_engine
+from src import query_pool
+from src.csv_tables import describe_tables
+from src import admission, cancellation, conversations, tracing
+from src.llm import chat_model
 
 def run_query(q):
+    # pandasql pulls in SQLAlchemy, only imported if this is ever used
+    from pandasql import sqldf
     return sqldf(q, globals())
 
-with open("/home/nishantkumar.jha/projects/experiments/phaser/backend/src/semantic.yml", "r") as file:
-        semantic = yaml.safe_load(file)
+logger = logging.getLogger(__name__)
 
 
-def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str, str]] = None):
+def text_csv_results(data, query: str, chat_history: List[Dict[str, str]] = None, history: Optional[str] = None):
     """
     Process user query to generate SQL or conversational responses, with chat history context.
     l
     Args:
-        data (pd.DataFrame): The DataFrame to query
+        data (pd.DataFrame | pa.Table | str | dict): The DataFrame or Arrow table to query, the
+            directory of a Parquet dataset for uploads that are queried in place, or a dict of
+            table name -> any of those when several files were uploaded
         query (str): The user's current query
         chat_history (List[Dict[str, str]], optional): List of previous messages with 'role' and 'content'
+        history (str, optional): Conversation history already rendered for the prompt (see
+            src/conversations.py); replaces chat_history when given
     
     Returns:
         dict: Response containing response_type and appropriate content
     """
-    # Initialize chat history if None
-    if chat_history is None:
-        chat_history = []
-    
-    # Create memory for LLM context
-    memory = ConversationBufferMemory()
-    print("Data , query , chat_history", data, query, chat_history)
-    # Process recent history (last 4 messages to avoid token limits)
-    recent_history = chat_history[-4:] if chat_history else []
-    
-    # Add messages to memory
-    for msg in recent_history:
-        role = msg.get('role', '').lower()
-        content = msg.get('content', '')
-        
-        if content:  # Skip empty messages
-            if role == 'user':
-                memory.chat_memory.add_user_message(content)
-            elif role == 'assistant':
-                memory.chat_memory.add_ai_message(content)
-    
-    # Format history for prompt
-    history_text = ""
-    for msg in recent_history:
-        role = msg.get('role', '').upper()
-        content = msg.get('content', '')
-        if role and content:
-            history_text += f"{role}: {content}\n\n"
+    # LangChain is imported on the first question, not when the app starts
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+
+    # Token-bounded history: the server-side conversation's, else built from the client's messages
+    history_text = history if history is not None else conversations.format_messages(chat_history)
 
     # Define response schemas
     response_schemas = [
@@ -90,17 +70,10 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
     format_instructions = parser.get_format_instructions()
 
     # Initialize the Bedrock LLM
-    llm = BedrockChat(
-            model_id="anthropic.claude-3-5-sonnet-20240620-v1:0",  
-            model_kwargs={
-                "temperature": 0.4,
-                "max_tokens": 2000,  
-                "top_p": 0.7,
-            },
-            region_name="us-east-1"
-        )
+    llm = chat_model()
     
-    schema = data.describe(include='all')
+    tables = data if isinstance(data, dict) else {"df": data}
+    schema = describe_tables(tables)
 
     prompt = PromptTemplate(
         input_variables=["user_input", "history"],
@@ -108,7 +81,7 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
 
         DATAFRAME SCHEMA:
         "The dataframe schema is as follows:\n{schema}\n"
-        Consider the name of the table as 'df'
+        Use the table names exactly as given above. If there are several tables, join them on the candidate join keys when the question needs columns from more than one table, and only select the columns you need.
 
         CONVERSATION HISTORY(it may help you understand the previous context, if in current user input there is no context to history, you can ignore it):
         {history}
@@ -124,7 +97,7 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
         - Set response_type to "sql"
         - Generate a correct, optimized SQL-like query in the content field
         - Explain what the query does in the explanation field
-        - Use proper SQL syntax that can be executed on a pandas DataFrame
+        - Use proper DuckDB SQL syntax, the query is executed with DuckDB on the uploaded tables
 
         2. If the input is a normal conversational question (like greetings, basic math, basic general knowledge):
         - Set response_type to "conversation"
@@ -136,8 +109,8 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
         - Set content to "I am not authorized to answer this question."
         - Leave explanation as an empty string
 
-        ## SQL BEST PRACTICES (When generating SQL for pandas):
-        - Use pandas-compatible syntax
+        ## SQL BEST PRACTICES (When generating SQL for DuckDB):
+        - Use DuckDB-compatible syntax
         - Ensure column names are correctly referenced
         - Avoid modifying the original DataFrame
         - Use clear and concise filtering and aggregation methods
@@ -151,7 +124,6 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
 
     # Create a chain
     chain = LLMChain(llm=llm, prompt=prompt)
-    engine = create_engine('sqlite:///src/test')
 
     
     for i in range(5):
@@ -163,10 +135,15 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
         
         # Run the chain with user input and chat history
         
-        raw_output = chain.run(user_input=query, history=history_text)
-        
-        # Parse the output
-        parsed_output = parser.parse(raw_output)
+        with tracing.span("llm.generate_sql", attempt=i + 1):
+            with admission.stage("llm"):
+                raw_output = chain.run(
+                    user_input=query, history=history_text, callbacks=cancellation.llm_callbacks()
+                )
+            
+            # Parse the output
+            parsed_output = parser.parse(raw_output)
+            tracing.annotate(response_type=parsed_output.get('response_type'), sql=parsed_output.get('content'))
         
         # Handle conversational response
         if parsed_output['response_type'] == 'conversation' or parsed_output['response_type'] == 'unauthorized':
@@ -180,13 +157,8 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
             sql_query = parsed_output['content']
             # Execute SQL query and get results
             try:
-                print("SQL Query:", sql_query)
-                # Execute the SQL query on the DataFrame
-                # sql_result = data.query(sql_query)
-                data.to_sql(name='df', con=engine, if_exists='replace', index=False)
-                sql_result = pd.read_sql(sql_query, engine)
-
-                print("SQL Result:", type(sql_result) , sql_result)
+                # Execute the SQL query on the DataFrame in an isolated, resource-limited database
+                sql_result = query_pool.run_query(sql_query, tables)
 
                 analysis_results = output_analyser(sql_result , sql_query , query )
                 return {
@@ -196,9 +168,12 @@ def text_csv_results(data: pd.DataFrame, query: str, chat_history: List[Dict[str
                     "sql_result": sql_result,
                     "analysis": analysis_results
                 }
+            except (admission.Overloaded, cancellation.Cancelled):
+                # Not a problem with the SQL, retrying would only add load
+                raise
             except Exception as e:
-                print("Error post final result is: ", e)
-                history_text += "ai: " + sql_query + "\n\n" + "human: I am getting this error- " + str(e) + "Please fix this and give correct snowflake sql query.\n\n"
+                logger.info("Query attempt %d failed, asking for a corrected query: %s", i + 1, e)
+                history_text += "ai: " + sql_query + "\n\n" + "human: I am getting this error- " + str(e) + "Please fix this and give correct DuckDB sql query.\n\n"
                 continue
         
         # Fallback for unexpected response types
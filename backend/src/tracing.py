@@ -0,0 +1,220 @@
+"""
+Per-request traces and the slow-request log.
+
+`TracingMiddleware` starts a trace for every HTTP request and returns its id
+in the `X-Trace-Id` header. Pipeline code opens spans with `span()`, one each
+for an LLM attempt, the warehouse query, the analysis, a chart render and the
+serialization. Spans record their duration and the attributes given to them
+or added with `annotate()`: the generated SQL, the Snowflake query id, rows
+and bytes, and the time spent waiting for a stage slot. The trace and the
+current span live in context variables, so spans opened on the pipeline
+executor's threads land in the right trace.
+
+When the response is complete, the trace is written as one JSON line to a
+rotating slow log if it took at least SLOW_REQUEST_SECONDS. Faster requests
+are written only for a TRACE_SAMPLE_RATE sample. Writing goes through a queue
+to a background thread, so requests never wait on the file.
+"""
+import contextvars
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import orjson
+
+from src import metrics
+
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "5"))
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+SLOW_LOG_PATH = os.environ.get("SLOW_LOG_PATH", os.path.join(tempfile.gettempdir(), "phaser_slow_requests.jsonl"))
+SLOW_LOG_MAX_BYTES = int(os.environ.get("SLOW_LOG_MAX_MB", "50")) * 1024 * 1024
+SLOW_LOG_BACKUPS = int(os.environ.get("SLOW_LOG_BACKUPS", "5"))
+
+# Long attribute values (SQL, error messages) are cut to this many characters
+MAX_ATTRIBUTE_CHARS = 4000
+
+
+def _clip(value):
+    if isinstance(value, str) and len(value) > MAX_ATTRIBUTE_CHARS:
+        return value[:MAX_ATTRIBUTE_CHARS] + "..."
+    return value
+
+
+class Trace:
+    """Spans and attributes of one request."""
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.attributes = {}
+        self.spans = []
+        self._span_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    def record(self, **attributes):
+        with self._lock:
+            self.attributes.update({k: _clip(v) for k, v in attributes.items()})
+
+    def to_dict(self, status):
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration_ms": round(self.elapsed_ms(), 3),
+                "status": status,
+                "attributes": dict(self.attributes),
+                "spans": list(self.spans),
+            }
+
+
+class _Span:
+    def __init__(self, trace, name, parent, attributes):
+        self.trace = trace
+        self.span_id = next(trace._span_ids)
+        self.name = name
+        self.parent = parent
+        self.attributes = {k: _clip(v) for k, v in attributes.items()}
+        self.start_ms = trace.elapsed_ms()
+
+    def finish(self, error=None):
+        record = {
+            "id": self.span_id,
+            "parent": self.parent,
+            "name": self.name,
+            "start_ms": round(self.start_ms, 3),
+            "duration_ms": round(self.trace.elapsed_ms() - self.start_ms, 3),
+            "attributes": self.attributes,
+        }
+        if error is not None:
+            record["error"] = _clip(f"{type(error).__name__}: {error}")
+        with self.trace._lock:
+            self.trace.spans.append(record)
+
+
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+
+
+def current_trace():
+    """The trace of the request being processed, or None outside a request."""
+    return _trace.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the block as a span of the current trace; a no-op outside a request."""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    parent = _span.get()
+    current = _Span(trace, name, parent.span_id if parent else None, attributes)
+    token = _span.set(current)
+    try:
+        yield
+    except BaseException as e:
+        current.finish(e)
+        raise
+    else:
+        current.finish()
+    finally:
+        _span.reset(token)
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, or to the trace itself outside any span."""
+    current = _span.get()
+    if current is not None:
+        current.attributes.update({k: _clip(v) for k, v in attributes.items()})
+    elif _trace.get() is not None:
+        _trace.get().record(**attributes)
+
+
+_log_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+_slow_log = logging.getLogger("phaser.slow_requests")
+_slow_log.propagate = False
+_slow_log.setLevel(logging.INFO)
+_slow_log.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            os.makedirs(os.path.dirname(os.path.abspath(SLOW_LOG_PATH)), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                SLOW_LOG_PATH, maxBytes=SLOW_LOG_MAX_BYTES, backupCount=SLOW_LOG_BACKUPS, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _listener = logging.handlers.QueueListener(_log_queue, handler)
+            _listener.start()
+
+
+def finish(trace, status):
+    """Write a finished trace to the slow log if it was slow or sampled."""
+    duration = trace.elapsed_ms() / 1000
+    metrics.observe("request_seconds", duration)
+    slow = duration >= SLOW_REQUEST_SECONDS
+    if not slow and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    metrics.increment("traces_slow_total" if slow else "traces_sampled_total")
+    record = trace.to_dict(status)
+    record["slow"] = slow
+    _start_listener()
+    _slow_log.info(orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS, default=str).decode())
+
+
+def close():
+    """Flush the slow log and stop its writer thread."""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+class TracingMiddleware:
+    """ASGI middleware giving each HTTP request a trace, finished once the response has been sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        _trace.set(trace)
+        _span.set(None)
+        status = None
+
+        async def traced_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, traced_send)
+        except BaseException as e:
+            trace.record(error=f"{type(e).__name__}: {e}")
+            finish(trace, status or 500)
+            raise
+        finish(trace, status)
@@ -0,0 +1,195 @@
+"""
+Format detection and native readers for uploaded data files.
+
+Besides plain CSV, uploads can be Parquet, Arrow IPC (file or stream), Feather,
+gzip/zstd/zip compressed CSV or Excel (.xlsx). Columnar formats are never re-encoded: Parquet
+is queried in place and Arrow/Feather files are memory-mapped, so they reach
+the query engine without a copy. Every reader returns a table source that
+`query_pool.run_query` and `csv_tables.describe_tables` accept.
+"""
+import os
+import zipfile
+from xml.etree.ElementTree import ParseError
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from openpyxl.utils.exceptions import InvalidFileException
+
+from src.out_of_core import is_oversized, save_upload, csv_to_parquet, new_dataset_dir, remove_dataset, PARQUET_ROOT
+
+
+class UnsupportedUpload(ValueError):
+    """Raised for an upload in a format that cannot be read; reported to the client as a 400."""
+
+
+# Magic bytes at the start of each supported format
+_MAGIC = [
+    (b"PAR1", "parquet"),
+    (b"ARROW1", "arrow_file"),
+    (b"FEA1", "arrow_file"),
+    (b"\xff\xff\xff\xff", "arrow_stream"),
+    (b"\x1f\x8b", "csv_gzip"),
+    (b"\x28\xb5\x2f\xfd", "csv_zstd"),
+    # An .xlsx workbook or a zipped CSV, told apart by the archive's contents
+    (b"PK\x03\x04", "zip"),
+    (b"\xd0\xcf\x11\xe0", "xls"),
+]
+
+# What the readers raise for a file that is not what its magic bytes or extension claim
+_READ_ERRORS = (
+    pa.ArrowInvalid,
+    zipfile.BadZipFile,
+    InvalidFileException,
+    ParseError,
+    pd.errors.ParserError,
+    pd.errors.EmptyDataError,
+    UnicodeDecodeError,
+    duckdb.Error,
+)
+
+_EXTENSIONS = {
+    ".parquet": "parquet",
+    ".arrow": "arrow_file",
+    ".feather": "arrow_file",
+    ".ipc": "arrow_file",
+    ".arrows": "arrow_stream",
+    ".gz": "csv_gzip",
+    ".zst": "csv_zstd",
+    ".zstd": "csv_zstd",
+    ".xlsx": "excel",
+    ".xlsm": "excel",
+    ".xls": "xls",
+    ".zip": "csv_zip",
+}
+
+
+def detect_format(head, filename=None):
+    """
+    Detect the format of an upload from its first bytes, falling back to the file extension.
+
+    Returns:
+        str: One of 'csv', 'csv_gzip', 'csv_zstd', 'zip', 'csv_zip', 'parquet', 'arrow_file',
+        'arrow_stream', 'excel', 'xls'; 'zip' is resolved by `_zip_format`
+    """
+    for magic, file_format in _MAGIC:
+        if head.startswith(magic):
+            return file_format
+    ext = os.path.splitext(filename or "")[1].lower()
+    return _EXTENSIONS.get(ext, "csv")
+
+
+def _zip_format(file_obj):
+    """'excel' for an Office Open XML workbook, 'csv_zip' for any other zip archive."""
+    try:
+        with zipfile.ZipFile(file_obj) as archive:
+            names = archive.namelist()
+    except zipfile.BadZipFile as e:
+        raise UnsupportedUpload(f"The upload looks like a zip archive but cannot be read: {e}") from e
+    finally:
+        file_obj.seek(0)
+    if "[Content_Types].xml" in names and any(name.startswith("xl/") for name in names):
+        return "excel"
+    return "csv_zip"
+
+
+def _extract_zipped_csv(file_obj):
+    """Stream the single CSV in a zip archive to disk; returns its path."""
+    with zipfile.ZipFile(file_obj) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+        ]
+        if len(members) != 1:
+            raise UnsupportedUpload(
+                f"A zip upload must contain exactly one CSV file, this one has {len(members)} files"
+            )
+        with archive.open(members[0]) as member:
+            return save_upload(member, ".csv", directory=PARQUET_ROOT)
+
+
+def _load(file_obj, filename, size, paths):
+    # Temporary files and directories are appended to `paths` as soon as they exist
+    file_obj.seek(0)
+    head = file_obj.read(8)
+    file_obj.seek(0)
+    file_format = detect_format(head, filename)
+    if file_format == "zip":
+        file_format = _zip_format(file_obj)
+
+    if file_format == "xls":
+        # Reading the binary Excel 97-2003 format would need xlrd
+        raise UnsupportedUpload("Excel 97-2003 (.xls) workbooks are not supported, save the sheet as .xlsx or CSV")
+
+    if file_format == "parquet":
+        # Queried in place with projection and predicate pushdown; only the footer is read here
+        parquet_dir = new_dataset_dir()
+        paths.append(parquet_dir)
+        pq.read_metadata(save_upload(file_obj, ".parquet", directory=parquet_dir))
+        return parquet_dir
+
+    if file_format in ("arrow_file", "arrow_stream"):
+        path = save_upload(file_obj, ".arrow")
+        paths.append(path)
+        if file_format == "arrow_file":
+            return feather.read_table(path, memory_map=True)
+        with pa.ipc.open_stream(pa.memory_map(path)) as reader:
+            return reader.read_all()
+
+    if file_format == "excel":
+        return pd.read_excel(file_obj, engine="openpyxl")
+
+    if file_format == "csv_zip":
+        # Extracted first: its real size decides between pandas and the Parquet path
+        csv_path = _extract_zipped_csv(file_obj)
+        paths.append(csv_path)
+        if is_oversized(os.path.getsize(csv_path)):
+            parquet_dir = csv_to_parquet(csv_path)
+            paths.append(parquet_dir)
+            return parquet_dir
+        return pd.read_csv(csv_path)
+
+    # The compressed size says nothing about the decompressed one (a few MB of gzip can expand
+    # to gigabytes), so compressed CSV is always streamed through DuckDB into Parquet
+    suffix = {"csv_gzip": ".csv.gz", "csv_zstd": ".csv.zst"}.get(file_format)
+    if suffix or is_oversized(size):
+        # Too large for pandas, or of unknown size: spool to disk and query it as Parquet instead
+        upload_path = save_upload(file_obj, suffix or ".csv")
+        paths.append(upload_path)
+        parquet_dir = csv_to_parquet(upload_path)
+        paths.append(parquet_dir)
+        return parquet_dir
+    return pd.read_csv(file_obj)
+
+
+def load_upload(file_obj, filename=None, size=None):
+    """
+    Read an uploaded file into something the query engine can scan.
+
+    Args:
+        file_obj: Binary file object of the upload
+        filename (str, optional): Original file name, used when the magic bytes are inconclusive
+        size (int, optional): Upload size in bytes, oversized CSVs are converted to Parquet
+
+    Returns:
+        tuple: (table source, list of temporary paths to remove after the request), where the
+        source is a pandas DataFrame, an Arrow table or a Parquet dataset directory
+
+    Raises:
+        UnsupportedUpload: For .xls workbooks, zip archives that do not hold a single CSV and
+        files the reader for their format cannot parse; nothing is left on disk
+    """
+    paths = []
+    try:
+        source = _load(file_obj, filename, size, paths)
+    except BaseException as e:
+        remove_dataset(*paths)
+        if isinstance(e, duckdb.Error):
+            # DuckDB's message names the file on the server
+            raise UnsupportedUpload("The uploaded file could not be read as CSV") from e
+        if isinstance(e, _READ_ERRORS):
+            raise UnsupportedUpload(f"The uploaded file could not be read: {e}") from e
+        raise
+    return source, paths
@@ -0,0 +1,73 @@
+"""
+Warm-up of the parts of a worker that are loaded on first use.
+
+LangChain, the AWS SDK, the Snowflake connector and the chart rendering
+processes are not loaded when the app starts, which keeps worker boot fast
+and idle workers small. `/warmup` loads them ahead of the first question, for
+a deploy hook or readiness probe to call once the worker is up.
+"""
+import time
+
+from src import metrics
+from src.render_graph import CHART_OUTPUT
+
+COMPONENTS = ("semantic", "llm", "warehouse", "render")
+
+
+def _semantic():
+    from src import semantic_model
+
+    semantic_model.current()
+
+
+def _llm():
+    from src.llm import chat_model
+
+    chat_model()
+    import langchain.chains  # noqa: F401
+    import langchain.output_parsers  # noqa: F401
+    import langchain.prompts  # noqa: F401
+
+
+def _warehouse():
+    import src.connection  # noqa: F401
+
+
+def _render():
+    from src.render_pool import get_render_pool
+
+    get_render_pool()
+
+
+_WARMERS = {"semantic": _semantic, "llm": _llm, "warehouse": _warehouse, "render": _render}
+
+
+def default_components():
+    """Everything except the render processes, which are only needed when charts are drawn server-side."""
+    components = ["semantic", "llm", "warehouse"]
+    if CHART_OUTPUT == "png":
+        components.append("render")
+    return components
+
+
+def warm(components=None):
+    """
+    Load the given components, all but 'render' by default.
+
+    Raises:
+        ValueError: If an unknown component is requested
+
+    Returns:
+        dict: Component -> seconds it took to load (close to 0 once loaded)
+    """
+    components = components or default_components()
+    unknown = [name for name in components if name not in _WARMERS]
+    if unknown:
+        raise ValueError(f"Unknown component(s) {', '.join(unknown)}; choose from {', '.join(COMPONENTS)}")
+    timings = {}
+    for name in components:
+        start = time.perf_counter()
+        _WARMERS[name]()
+        timings[name] = round(time.perf_counter() - start, 3)
+        metrics.set_gauge(f"warmup_{name}_seconds", timings[name])
+    return timings
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src import follow_up
+
+PREVIOUS = SimpleNamespace(columns=["STORE", "TYPE", "TOTAL_SALES"])
+
+
+class Semantic:
+    """Synonyms of the semantic layer: "kind" means TYPE."""
+
+    def resolve(self, term):
+        return [("STORES", "TYPE")] if term == "kind" else []
+
+
+REFINEMENTS = [
+    ("now only for store 2", 'SELECT * FROM previous_result WHERE "STORE" = 2'),
+    ("just the kind a", "SELECT * FROM previous_result WHERE LOWER(CAST(\"TYPE\" AS VARCHAR)) = LOWER('a')"),
+    ("sort that by sales", 'SELECT * FROM previous_result ORDER BY "TOTAL_SALES" ASC NULLS LAST'),
+    ("rank them by total sales", 'SELECT * FROM previous_result ORDER BY "TOTAL_SALES" DESC NULLS LAST'),
+    ("top 5 by sales", 'SELECT * FROM previous_result ORDER BY "TOTAL_SALES" DESC NULLS LAST LIMIT 5'),
+    # Filter phrasings whose "column" is not one of the result's fall through to top-N
+    ("only the top 2", "SELECT * FROM previous_result LIMIT 2"),
+    ("just the first 3.", "SELECT * FROM previous_result LIMIT 3"),
+    ("ok, only the bottom 4 by sales", 'SELECT * FROM previous_result ORDER BY "TOTAL_SALES" ASC NULLS LAST LIMIT 4'),
+]
+
+NOT_REFINEMENTS = [
+    "only for region west",
+    "sort by profit",
+    "the last 3",
+    "what were sales in 2011?",
+]
+
+
+@pytest.mark.parametrize("question, sql", REFINEMENTS)
+def test_local_refinement(question, sql):
+    assert follow_up.local_refinement(question, PREVIOUS, Semantic()) == sql
+
+
+@pytest.mark.parametrize("question", NOT_REFINEMENTS)
+def test_not_a_local_refinement(question):
+    assert follow_up.local_refinement(question, PREVIOUS, Semantic()) is None
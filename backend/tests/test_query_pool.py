@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src import out_of_core, query_pool
+
+
+@pytest.fixture
+def tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(out_of_core, "PARQUET_ROOT", str(tmp_path))
+    parquet_dir = out_of_core.new_dataset_dir()
+    pd.DataFrame({"STORE": [1, 2, 3], "SALES": [10.0, 20.0, 30.0]}).to_parquet(os.path.join(parquet_dir, "part-0.parquet"))
+    return {"sales": parquet_dir, "stores": pd.DataFrame({"STORE": [1, 2], "TYPE": ["A", "B"]})}
+
+
+def test_select_on_registered_tables(tables):
+    result = query_pool.run_query(
+        "WITH s AS (SELECT * FROM sales) SELECT TYPE, SUM(SALES) AS total FROM s JOIN stores USING (STORE) "
+        "GROUP BY TYPE ORDER BY TYPE",
+        tables,
+    )
+    assert result.to_dict("list") == {"TYPE": ["A", "B"], "total": [10.0, 20.0]}
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM read_csv('/etc/hostname')",
+    "SELECT * FROM read_text('/etc/passwd')",
+    "SELECT * FROM read_parquet('{root}/../*.parquet')",
+])
+def test_files_outside_the_tables_are_refused(tables, sql):
+    with pytest.raises(Exception, match="Permission"):
+        query_pool.run_query(sql.format(root=tables["sales"]), tables)
+
+
+@pytest.mark.parametrize("sql", [
+    "COPY sales TO '/tmp/leak.csv'",
+    "COPY sales TO '{root}/leak.csv'",
+    "ATTACH '/tmp/other.duckdb'",
+    "CREATE TABLE copy AS SELECT * FROM sales",
+    "SET enable_external_access = true",
+    "SELECT 1; SELECT 2",
+])
+def test_statements_other_than_a_select_are_refused(tables, sql):
+    with pytest.raises(query_pool.QueryRejected):
+        query_pool.run_query(sql.format(root=tables["sales"]), tables)
+    assert not os.path.exists(os.path.join(tables["sales"], "leak.csv"))
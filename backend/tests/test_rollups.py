@@ -0,0 +1,131 @@
+import pandas as pd
+import pytest
+import sqlglot
+
+from src import rollups
+
+ROWS = {"SALES_BY_TYPE_WEEK": 10, "SALES_BY_STORE_WEEK": 20, "SALES_BY_DEPT_WEEK": 30, "SALES_BY_STORE_DEPT": 40}
+
+
+@pytest.fixture(scope="module")
+def config():
+    return rollups.load_config()
+
+
+COVERED = [
+    (
+        "SELECT st.TYPE, SUM(s.WEEKLY_SALES) AS total FROM SALES s JOIN STORES st ON s.STORE = st.STORE "
+        "GROUP BY st.TYPE ORDER BY total DESC",
+        "SALES_BY_TYPE_WEEK",
+        'SELECT TYPE, SUM("WEEKLY_SALES__SUM") AS TOTAL FROM "SALES_BY_TYPE_WEEK" WHERE "STORES__MATCHED" '
+        "GROUP BY TYPE ORDER BY TOTAL DESC NULLS FIRST",
+    ),
+    (
+        "SELECT st.TYPE, SUM(s.WEEKLY_SALES) AS total FROM SALES s LEFT JOIN STORES st ON s.STORE = st.STORE "
+        "GROUP BY st.TYPE",
+        "SALES_BY_TYPE_WEEK",
+        'SELECT TYPE, SUM("WEEKLY_SALES__SUM") AS TOTAL FROM "SALES_BY_TYPE_WEEK" GROUP BY TYPE',
+    ),
+    (
+        "SELECT STORE, AVG(WEEKLY_SALES) FROM PET_PROD_DB.HACKBOT_DEMO_SCHEMA.SALES "
+        "WHERE DATE >= '2012-01-01' GROUP BY STORE",
+        "SALES_BY_STORE_WEEK",
+        'SELECT STORE, (SUM("WEEKLY_SALES__SUM") / NULLIF(SUM("WEEKLY_SALES__COUNT"), 0)) AS "AVG(WEEKLY_SALES)" '
+        "FROM \"SALES_BY_STORE_WEEK\" WHERE DATE >= '2012-01-01' GROUP BY STORE",
+    ),
+    (
+        "SELECT COUNT(*), COUNT(WEEKLY_SALES), COUNT(DISTINCT DEPT) FROM SALES WHERE ISHOLIDAY",
+        "SALES_BY_DEPT_WEEK",
+        'SELECT CAST(SUM("_ROWS") AS BIGINT) AS "COUNT(*)", CAST(SUM("WEEKLY_SALES__COUNT") AS BIGINT) '
+        'AS "COUNT(WEEKLY_SALES)", COUNT(DISTINCT DEPT) AS "COUNT(DISTINCT DEPT)" FROM "SALES_BY_DEPT_WEEK" '
+        "WHERE ISHOLIDAY",
+    ),
+    (
+        "SELECT st.STORE, MIN(s.WEEKLY_SALES), MAX(s.WEEKLY_SALES) FROM STORES st JOIN SALES s "
+        "ON st.STORE = s.STORE GROUP BY st.STORE",
+        "SALES_BY_STORE_WEEK",
+        'SELECT STORE, MIN("WEEKLY_SALES__MIN") AS "MIN(S.WEEKLY_SALES)", MAX("WEEKLY_SALES__MAX") '
+        'AS "MAX(S.WEEKLY_SALES)" FROM "SALES_BY_STORE_WEEK" WHERE "STORES__MATCHED" GROUP BY STORE',
+    ),
+    (
+        "SELECT DEPT, SUM(WEEKLY_SALES) FROM SALES s JOIN STORES USING (STORE) "
+        "WHERE TYPE = 'A' OR ISHOLIDAY GROUP BY DEPT",
+        "SALES_BY_DEPT_WEEK",
+        'SELECT DEPT, SUM("WEEKLY_SALES__SUM") AS "SUM(WEEKLY_SALES)" FROM "SALES_BY_DEPT_WEEK" '
+        "WHERE (TYPE = 'A' OR ISHOLIDAY) AND \"STORES__MATCHED\" GROUP BY DEPT",
+    ),
+]
+
+UNCOVERED = [
+    # Sampling, time travel and QUALIFY read or keep other rows
+    "SELECT SUM(WEEKLY_SALES) FROM SALES SAMPLE (10)",
+    "SELECT SUM(WEEKLY_SALES) FROM SALES AT(OFFSET => -60)",
+    "SELECT STORE, SUM(WEEKLY_SALES) FROM SALES GROUP BY STORE QUALIFY STORE > 1",
+    # Columns, tables and functions the rollups do not keep
+    "SELECT st.SIZE, SUM(s.WEEKLY_SALES) FROM SALES s JOIN STORES st ON s.STORE = st.STORE GROUP BY st.SIZE",
+    "SELECT f.DATE, SUM(s.WEEKLY_SALES) FROM SALES s JOIN FEATURES f ON s.STORE = f.STORE GROUP BY f.DATE",
+    "SELECT DEPT, SUM(WEEKLY_SALES) FROM SALES WHERE WEEKLY_SALES > 0 GROUP BY DEPT",
+    "SELECT MEDIAN(WEEKLY_SALES) FROM SALES",
+    "SELECT * FROM SALES",
+    "SELECT STORE FROM SALES GROUP BY STORE",
+    "SELECT STORE, SUM(WEEKLY_SALES) OVER (PARTITION BY STORE) FROM SALES",
+    "SELECT STORE, SUM(WEEKLY_SALES) FROM SALES WHERE STORE IN (SELECT STORE FROM STORES) GROUP BY STORE",
+    # Keeps stores without sales
+    "SELECT st.TYPE, SUM(s.WEEKLY_SALES) FROM STORES st LEFT JOIN SALES s ON st.STORE = s.STORE GROUP BY st.TYPE",
+    "SELECT st.TYPE, SUM(s.WEEKLY_SALES) FROM SALES s JOIN STORES st ON s.DEPT = st.STORE GROUP BY st.TYPE",
+]
+
+
+@pytest.mark.parametrize("sql, rollup, expected", COVERED)
+def test_rewrite_covered(config, sql, rollup, expected):
+    assert rollups.rewrite(sql, config, ROWS) == (rollup, expected)
+
+
+@pytest.mark.parametrize("sql", UNCOVERED)
+def test_rewrite_uncovered(config, sql):
+    assert rollups.rewrite(sql, config, ROWS) is None
+
+
+def test_rewrite_picks_smallest_rollup(config):
+    sql = "SELECT TYPE, SUM(WEEKLY_SALES) FROM SALES s JOIN STORES st ON s.STORE = st.STORE GROUP BY TYPE"
+    rows = dict(ROWS, SALES_BY_STORE_DEPT=5)
+    assert rollups.rewrite(sql, config, rows)[0] == "SALES_BY_STORE_DEPT"
+
+
+@pytest.fixture(scope="module")
+def tables():
+    # Store 9 has sales but no STORES row, store 3 has no TYPE
+    sales = pd.DataFrame({
+        "STORE": [1, 1, 2, 2, 3, 9, 9, 1],
+        "DEPT": [1, 2, 1, 2, 1, 1, 2, 1],
+        "DATE": ["2012-01-06", "2012-01-06", "2012-01-06", "2012-01-13", "2012-01-13", "2012-01-13",
+                 "2012-01-06", "2012-01-13"],
+        "ISHOLIDAY": [False, False, True, False, True, False, True, False],
+        "WEEKLY_SALES": [10.0, 20.0, 30.0, None, 50.0, 60.0, 70.0, 80.0],
+    })
+    stores = pd.DataFrame({"STORE": [1, 2, 3], "TYPE": ["A", "B", None], "SIZE": [100, 200, 300]})
+    return {"SALES": sales, "STORES": stores}
+
+
+@pytest.mark.parametrize("sql", [sql for sql, _, _ in COVERED])
+def test_rewritten_results_match(config, tables, sql):
+    conn = rollups.connect()
+    try:
+        for name, df in tables.items():
+            conn.register(name, df)
+        base = conn.sql(config.base_sql()).fetch_arrow_table()
+        derived = rollups._derive(config, base)
+        rollup, local_sql = rollups.rewrite(sql, config, {name: t.num_rows for name, t in derived.items()})
+        conn.register(rollup, derived[rollup])
+        got = conn.sql(local_sql).df()
+        original = sqlglot.transpile(sql.replace("PET_PROD_DB.HACKBOT_DEMO_SCHEMA.", ""), read="snowflake", write="duckdb")[0]
+        expected = conn.sql(original).df()
+    finally:
+        conn.close()
+    # DuckDB names unaliased columns differently; Snowflake's names are checked above
+    assert len(got.columns) == len(expected.columns)
+    pd.testing.assert_frame_equal(
+        got.set_axis(expected.columns, axis=1).sort_values(list(expected.columns)).reset_index(drop=True),
+        expected.sort_values(list(expected.columns)).reset_index(drop=True),
+        check_dtype=False,
+    )
@@ -0,0 +1,53 @@
+import gzip
+import io
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from src import out_of_core
+from src.upload_formats import UnsupportedUpload, load_upload
+
+
+@pytest.fixture(autouse=True)
+def parquet_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(out_of_core, "PARQUET_ROOT", str(tmp_path))
+    monkeypatch.setattr("src.upload_formats.PARQUET_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def _zip(**members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+def test_reads_csv_formats(parquet_root):
+    source, paths = load_upload(io.BytesIO(b"a,b\n1,2\n"), "data.csv", 8)
+    assert source.to_dict("list") == {"a": [1], "b": [2]} and paths == []
+
+    source, paths = load_upload(io.BytesIO(gzip.compress(b"a,b\n1,2\n")), "data.csv.gz", 30)
+    assert pd.read_parquet(source).to_dict("list") == {"a": [1], "b": [2]}
+    out_of_core.remove_dataset(*paths)
+    assert os.listdir(parquet_root) == []
+
+
+@pytest.mark.parametrize("filename, data", [
+    ("bad.parquet", b"PAR1garbage"),
+    ("bad.arrow", b"ARROW1garbage"),
+    ("bad.arrows", b"\xff\xff\xff\xffgarbage"),
+    ("bad.csv.gz", b"\x1f\x8bgarbagegarbage"),
+    ("bad.zip", b"PK\x03\x04broken"),
+    ("bad.xlsx", _zip(**{"[Content_Types].xml": "x", "xl/workbook.xml": "<bad"})),
+    ("two.zip", _zip(**{"a.csv": "a\n1\n", "b.csv": "b\n2\n"})),
+    ("bad.csv", b'a,b\n1,2,3,4\n"x'),
+    ("empty.csv", b""),
+    ("latin1.csv", b"a\n\xff\xfe\n"),
+])
+def test_unreadable_upload_is_rejected_and_removed(parquet_root, filename, data):
+    with pytest.raises(UnsupportedUpload):
+        load_upload(io.BytesIO(data), filename, len(data))
+    assert os.listdir(parquet_root) == []
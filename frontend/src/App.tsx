@@ -78,6 +78,7 @@ function App() {
         timestamp: new Date(),
       };
 
+      const conversationId = [...messageHistory].reverse().find(msg => msg.conversationId)?.conversationId;
       setMessageHistory(prev => [...prev, newMessage]);
       setLoading(true)
       const response = await fetch(`http://127.0.0.1:8000/get_user_data`, {
@@ -87,10 +88,15 @@ function App() {
         },
         body: JSON.stringify({
           query,
-          chat_history: messageHistory.map(msg => ({
-            role: msg.role,
-            content: msg.content
-          }))
+          // The server keeps the history; it is only sent until the server has given the chat an id
+          ...(conversationId
+            ? { conversation_id: conversationId }
+            : { chat_history: messageHistory.map(msg => ({
+                role: msg.role,
+                content: msg.content
+              })) }),
+          // The first page of rows; the table pages through /results/{id} and CSV downloads are streamed from /results/{id}.csv
+          formats: ["json"]
         }),
       });
 
@@ -111,10 +117,17 @@ function App() {
         content: data.output || data.sql_query,
         timestamp: new Date(),
         sqlQuery: data.sql_query,
-        table: data.table?.body ? JSON.parse(data.table.body) : null,
+        resultId: data?.result_id,
+        resultColumns: data?.columns,
+        resultRows: data?.result,
+        totalRows: data?.total_rows,
+        conversationId: data?.conversation_id,
+        table: data.table || null,
         chart: data.response_type === 'visualization' ? data : null,
         analysisStatement: data?.analysis_statement,
         analysisPlot: data?.analysis_plot,
+        // Rows for chart specs that reference the returned result instead of inlining data
+        chartRows: data?.analysis_plot?.spec?.data?.name ? data.result : null,
       };
 
       setMessageHistory(prev => [...prev, aiResponse]);
@@ -153,6 +153,7 @@ const convertFileToBase64 = (file) => {
           timestamp: new Date(),
         };
         
+        const conversationId = [...messageHistory].reverse().find(msg => msg.conversationId)?.conversationId;
         setMessageHistory(prev => [...prev, newMessage]);
         setLoading(true);
         
@@ -162,10 +163,15 @@ const convertFileToBase64 = (file) => {
         // Add the JSON data
         const jsonData = {
           query,
-          chat_history: messageHistory.map(msg => ({
-            role: msg.role,
-            content: msg.content
-          }))
+          // The server keeps the history; it is only sent until the server has given the chat an id
+          ...(conversationId
+            ? { conversation_id: conversationId }
+            : { chat_history: messageHistory.map(msg => ({
+                role: msg.role,
+                content: msg.content
+              })) }),
+          // The first page of rows; the table pages through /results/{id} and CSV downloads are streamed from /results/{id}.csv
+          formats: ["json"]
         };
         
         formData.append('json_data', JSON.stringify(jsonData));
@@ -204,7 +210,12 @@ const convertFileToBase64 = (file) => {
           content: data.output || data.sql_query,
           timestamp: new Date(),
           sqlQuery: data.sql_query,
-          table: data.table?.body ? JSON.parse(data.table.body) : null,
+          resultId: data?.result_id,
+          resultColumns: data?.columns,
+          resultRows: data?.result,
+          totalRows: data?.total_rows,
+          conversationId: data?.conversation_id,
+          table: data.table || null,
           chart: data.response_type === 'visualization' ? data : null,
           analysisStatement: data?.analysis_statement
         };
@@ -1,5 +1,7 @@
 import React, { useRef, useEffect, useState } from 'react';
 import { Send, User, Bot, AlertCircle, Mic, Download ,FileSpreadsheet ,Upload } from 'lucide-react';
+import VegaChart from './VegaChart';
+import ResultTable from './ResultTable';
 const ChatInterface = ({fileUploading , messages, onSubmitQuery , csvData , setCSVData , currentChat , setCurrentChat , chats , setChats}) => {
   const [input, setInput] = useState('');
   const [isListening, setIsListening] = useState(false);
@@ -74,6 +76,16 @@ const handleSubmit = async (e) => {
 };
 
   const exportToCSV = (message , csvData) => {
+    if (message.resultId) {
+      // Streamed by the server from the stored result
+      const link = document.createElement('a');
+      link.setAttribute("href", `http://127.0.0.1:8000/results/${message.resultId}.csv`);
+      link.setAttribute("download", "export.csv");
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
+      return;
+    }
     setCsvs(prevCsvs => {
       const newCsvEntry = { [message.id]: csvData };
             return [...prevCsvs, newCsvEntry];
@@ -186,7 +198,12 @@ const handleSubmit = async (e) => {
           </div>
         )}
         
-        {message?.analysisPlot? 
+        {message?.analysisPlot?.spec ?
+          <div>
+          <VegaChart spec={message.analysisPlot.spec} rows={message.chartRows} />
+          </div>
+          :
+          message?.analysisPlot? 
           <div>
           <img 
             src={`data:image/png;base64,${message?.analysisPlot?.image}`}
@@ -197,7 +214,15 @@ const handleSubmit = async (e) => {
           :
           <>{""}</>
         }
-        {message.table && renderTable(message , message.table)}
+        {message.resultId ? (
+          <ResultTable
+            resultId={message.resultId}
+            columns={message.resultColumns || []}
+            rows={message.resultRows}
+            totalRows={message.totalRows}
+            onExport={() => exportToCSV(message, csvData)}
+          />
+        ) : message.table && renderTable(message , message.table)}
         </div>
       </div>
 
@@ -0,0 +1,127 @@
+import React, { useEffect, useState } from 'react';
+import { ChevronLeft, ChevronRight, Download } from 'lucide-react';
+
+const PAGE_SIZE = 100;
+
+// A stored query result, paged and sorted on the server through /results/{id}. The query
+// response carries the first page, so nothing is fetched until the user moves or sorts.
+const ResultTable = ({ resultId, columns, rows, totalRows, onExport }) => {
+  const [page, setPage] = useState({ offset: 0, rows: rows || [] });
+  const [sort, setSort] = useState(null);
+  const [order, setOrder] = useState('asc');
+  const [loading, setLoading] = useState(false);
+  const [error, setError] = useState(null);
+
+  const loadPage = async (offset, sortColumn, sortOrder) => {
+    setLoading(true);
+    setError(null);
+    try {
+      const params = new URLSearchParams({ offset: String(offset), limit: String(PAGE_SIZE) });
+      if (sortColumn) {
+        params.set('sort', sortColumn);
+        params.set('order', sortOrder);
+      }
+      const response = await fetch(`http://127.0.0.1:8000/results/${resultId}?${params}`);
+      if (response.status === 404) {
+        throw new Error('This result has expired, ask the question again to see more rows.');
+      }
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      const data = await response.json();
+      setPage({ offset, rows: data.result || [] });
+    } catch (e) {
+      setError(e.message);
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  useEffect(() => {
+    setPage({ offset: 0, rows: rows || [] });
+    setSort(null);
+    setOrder('asc');
+  }, [resultId, rows]);
+
+  const sortBy = (column) => {
+    const nextOrder = sort === column && order === 'asc' ? 'desc' : 'asc';
+    setSort(column);
+    setOrder(nextOrder);
+    loadPage(0, column, nextOrder);
+  };
+
+  const first = totalRows ? page.offset + 1 : 0;
+  const last = page.offset + page.rows.length;
+
+  return (
+    <div className="mt-4">
+      <details>
+        <summary className="font-medium cursor-pointer bg-gray-50 dark:bg-gray-800 p-2 rounded-lg hover:bg-gray-100 dark:hover:bg-gray-700 transition-colors">
+          Show Data Table
+        </summary>
+        <div className="max-h-[500px] overflow-auto mt-1">
+          <table className="min-w-full divide-y divide-gray-200 dark:divide-gray-700 text-sm">
+            <thead className="bg-gray-50 dark:bg-gray-800 sticky top-0">
+              <tr>
+                {columns.map(column => (
+                  <th
+                    key={column}
+                    onClick={() => sortBy(column)}
+                    className="px-3 py-2 text-left font-medium cursor-pointer select-none whitespace-nowrap"
+                  >
+                    {column}{sort === column ? (order === 'asc' ? ' ▲' : ' ▼') : ''}
+                  </th>
+                ))}
+              </tr>
+            </thead>
+            <tbody className={`divide-y divide-gray-200 dark:divide-gray-700 ${loading ? 'opacity-50' : ''}`}>
+              {page.rows.map((row, i) => (
+                <tr key={page.offset + i}>
+                  {columns.map(column => (
+                    <td key={column} className="px-3 py-2 whitespace-nowrap">
+                      {row[column] === null || row[column] === undefined ? '' : String(row[column])}
+                    </td>
+                  ))}
+                </tr>
+              ))}
+            </tbody>
+          </table>
+        </div>
+        <div className="mt-2 flex items-center justify-between text-gray-600 dark:text-gray-400">
+          <span>
+            Rows {first.toLocaleString()}–{last.toLocaleString()} of {(totalRows || 0).toLocaleString()}
+          </span>
+          <div className="flex gap-2">
+            <button
+              onClick={() => loadPage(Math.max(0, page.offset - PAGE_SIZE), sort, order)}
+              disabled={loading || page.offset === 0}
+              className="p-1 rounded hover:bg-gray-200 dark:hover:bg-gray-700 disabled:opacity-40"
+            >
+              <ChevronLeft className="w-4 h-4" />
+            </button>
+            <button
+              onClick={() => loadPage(page.offset + PAGE_SIZE, sort, order)}
+              disabled={loading || last >= totalRows}
+              className="p-1 rounded hover:bg-gray-200 dark:hover:bg-gray-700 disabled:opacity-40"
+            >
+              <ChevronRight className="w-4 h-4" />
+            </button>
+          </div>
+        </div>
+        {error && <p className="mt-1 text-red-600">{error}</p>}
+      </details>
+
+      <div className="mt-4 text-center">
+        <button
+          onClick={onExport}
+          className="inline-flex items-center px-4 py-2 bg-indigo-600 hover:bg-indigo-700 text-white rounded-lg"
+        >
+          <Download className="w-4 h-4 mr-2" />
+          Export to CSV
+        </button>
+      </div>
+    </div>
+  );
+};
+
+export default ResultTable;
@@ -0,0 +1,29 @@
+import React, { useEffect, useRef } from 'react';
+import embed from 'vega-embed';
+
+// Renders a Vega-Lite spec from the backend. Specs that chart the result rows as
+// they are reference them through the "result" dataset instead of repeating them.
+const VegaChart = ({ spec, rows }) => {
+  const containerRef = useRef(null);
+
+  useEffect(() => {
+    if (!containerRef.current || !spec) return;
+    let view = null;
+    let cancelled = false;
+    const datasets = spec.data?.name ? { [spec.data.name]: rows || [] } : undefined;
+    embed(containerRef.current, datasets ? { ...spec, datasets } : spec, { actions: { export: true, source: false, compiled: false, editor: false } })
+      .then(result => {
+        if (cancelled) result.view.finalize();
+        else view = result.view;
+      })
+      .catch(error => console.error("Error rendering chart:", error));
+    return () => {
+      cancelled = true;
+      if (view) view.finalize();
+    };
+  }, [spec, rows]);
+
+  return <div ref={containerRef} className="chart-image w-full" />;
+};
+
+export default VegaChart;
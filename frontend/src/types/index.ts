@@ -14,6 +14,11 @@ export interface MessageHistory {
   content: string;
   timestamp: Date;
   sqlQuery?: string;
+  conversationId?: string;
+  resultId?: string;
+  resultColumns?: string[];
+  resultRows?: Record<string, unknown>[];
+  totalRows?: number;
   table?: string;
   chart?: any;
 }